@@ -4,6 +4,7 @@ from django.contrib import admin
 from .models import *
 admin.site.register(User)
 admin.site.register(Chat)
+admin.site.register(ChatReadState)
 admin.site.register(Message)
 admin.site.register(Reaction)
 admin.site.register(File)
@@ -0,0 +1,86 @@
+from django.conf import settings
+
+
+class InMemoryCallRegistry:
+    # Open sockets per user and channel_name -> user_id per room, one worker only
+
+    def __init__(self):
+        self.members = {}
+        self.rooms = {}
+
+    def join(self, room, user_id, channel_name):
+        self.rooms.setdefault(room, {})[channel_name] = user_id
+        members = self.members.setdefault(room, {})
+        members[user_id] = members.get(user_id, 0) + 1
+        return members[user_id] == 1
+
+    def leave(self, room, user_id, channel_name):
+        if self.rooms.get(room, {}).pop(channel_name, None) is None:
+            return False
+        members = self.members[room]
+        members[user_id] -= 1
+        if members[user_id] > 0:
+            return False
+        del members[user_id]
+        if not members:
+            del self.members[room]
+            del self.rooms[room]
+        return True
+
+    def channels(self, room):
+        return dict(self.rooms.get(room, {}))
+
+
+class RedisCallRegistry:
+    # Per room: a hash of open sockets per user and a hash channel_name -> user_id,
+    # shared by every ASGI worker. The scripts keep first / last socket detection atomic.
+
+    JOIN_SCRIPT = """
+        redis.call('HSET', KEYS[2], ARGV[2], ARGV[1])
+        local sockets = redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+        redis.call('EXPIRE', KEYS[1], ARGV[3])
+        redis.call('EXPIRE', KEYS[2], ARGV[3])
+        return sockets
+    """
+
+    LEAVE_SCRIPT = """
+        if redis.call('HDEL', KEYS[2], ARGV[2]) == 0 then
+            return 1
+        end
+        local sockets = redis.call('HINCRBY', KEYS[1], ARGV[1], -1)
+        if sockets <= 0 then
+            redis.call('HDEL', KEYS[1], ARGV[1])
+        end
+        return sockets
+    """
+
+    def __init__(self):
+        from django_redis import get_redis_connection
+        self.redis = get_redis_connection('default')
+        self.join_script = self.redis.register_script(self.JOIN_SCRIPT)
+        self.leave_script = self.redis.register_script(self.LEAVE_SCRIPT)
+
+    def keys(self, room):
+        return [f'call:{room}:members', f'call:{room}:channels']
+
+    def join(self, room, user_id, channel_name):
+        args = [user_id, channel_name, settings.CALL_REGISTRY_TTL]
+        return self.join_script(keys=self.keys(room), args=args) == 1
+
+    def leave(self, room, user_id, channel_name):
+        return self.leave_script(keys=self.keys(room), args=[user_id, channel_name]) <= 0
+
+    def channels(self, room):
+        return {
+            channel_name.decode(): user_id.decode()
+            for channel_name, user_id in self.redis.hgetall(self.keys(room)[1]).items()
+        }
+
+
+def build_registry():
+    if settings.CALL_REGISTRY_BACKEND == 'redis':
+        return RedisCallRegistry()
+    return InMemoryCallRegistry()
+
+
+call_registry = build_registry()
@@ -1,22 +1,65 @@
+import asyncio
 import json
+from channels.generic.http import AsyncHttpConsumer
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from .models import *
-import jwt
 from django.conf import settings
+from django.core import signing
+from django.utils import timezone
+from urllib.parse import parse_qs
+from rest_framework.exceptions import AuthenticationFailed
+from core.authentication import verify_authorization
+from core.codecs import CodecConsumerMixin, RawJSON
+from core.outbound import Coalesce
+from core.producer import producer
 secret_key = settings.SECRET_KEY
 import uuid
 from .serializers import *
-from django.db.models import F, Case, When
-
-
-class InboxConsumer(AsyncWebsocketConsumer):
+from .inbox import get_inbox_page, parse_cursor
+from .counters import get_inbox_count, mark_read
+from .history import cursor_for, get_message_page, load_export_chunk, parse_cursor as parse_message_cursor
+from .presence import merge_diffs, presence
+from .call_registry import call_registry
+from .db_executor import database_task
+from .room_cache import room_cache
+from .snapshots import chat_snapshots, compact_chats, describe, wants_compact
+from asgiref.sync import sync_to_async
+from django.db.models import F, Case, When, Prefetch
+
+
+def get_scope_user_id(scope):
+    # Verified by JWTAuthMiddleware when the socket sent ?token=
+    if 'user_id' in scope:
+        return scope['user_id']
+    # A token that failed verification must not be taken as a user id
+    query_string = scope['query_string'].decode('utf-8')
+    if settings.WEBSOCKET_REQUIRE_TOKEN or 'token' in parse_qs(query_string):
+        return None
+    # Legacy clients only send ?user=<uuid>, possibly with &resume= and others
+    user_id = parse_qs(query_string).get('user', [None])[0]
+    if user_id is not None:
+        print(f"Unauthenticated legacy ?user= socket for user {user_id} on {scope.get('path')}")
+    return user_id
+
+
+class InboxConsumer(CodecConsumerMixin, AsyncWebsocketConsumer):
+    # Bumps and counters carry the chat's latest state, a client that fell behind only needs the last one
+    outbound_policies = {
+        'inbox_bump': Coalesce('chat_id'),
+        'unread_changed': Coalesce('chat_id'),
+    }
 
     async def connect(self):
         # Get UserID
-        self.user_id = self.scope['query_string'].decode('utf-8').split('=')[1]
+        self.user_id = get_scope_user_id(self.scope)
         self.room_name = self.scope["url_route"]["kwargs"]["room_name"]
         self.room_group_name = "inbox_%s" % self.room_name
+        self.total_count = None
+        self.compact = wants_compact(self.scope)
+        if self.user_id is None:
+            await self.close()
+            return
         print(f'User {self.user_id} joined Websocket with Group name {self.room_group_name}')
 
         # Join room group
@@ -29,15 +72,23 @@ class InboxConsumer(AsyncWebsocketConsumer):
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
 
     # Receive message from WebSocket
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
+        text_data_json = self.decode(text_data, bytes_data)
         message_type = text_data_json['type']
         if message_type == 'get_inboxes':
-            # Fetch inboxes for user
-            start = int(text_data_json.get('start', 0))
-            count = int(text_data_json.get('count', 20))
-            inboxes_data = await self.get_inboxes(start, count)
-            # total_count = await self.get_inboxes_count()
+            # Fetch inboxes for user, keyset cursor takes precedence over offset
+            try:
+                start = int(text_data_json.get('start', 0))
+                count = int(text_data_json.get('count', 20))
+                cursor = parse_cursor(text_data_json.get('last_activity'), text_data_json.get('chat_id'))
+            except (TypeError, ValueError) as e:
+                # Same as InboxView's 400, a bad frame doesn't take the socket down
+                await self.send_data({'type': 'error', 'error': str(e)})
+                return
+            # The first page also reads the inbox total, in the same executor call
+            inboxes_data = await self.get_inboxes(cursor, count, start, with_total=self.total_count is None)
+            if 'total_count' in inboxes_data:
+                self.total_count = inboxes_data['total_count']
             # Send inboxes to WebSocket
             await self.send_inboxes(inboxes_data)
         # Send message to room group
@@ -50,70 +101,126 @@ class InboxConsumer(AsyncWebsocketConsumer):
                 }
             )
     
-    @database_sync_to_async
-    def get_inboxes(self, start, count):
-        chats = Chat.objects.filter(participants__uuid=self.user_id).order_by('-created_at').prefetch_related('participants')[start:start+count]
-        serialized_chats = ChatSerializer(chats, many=True).data
-        serialized_chats = self._add_participants_to_serialized_chats(serialized_chats)
-        return serialized_chats
-
-    def _add_participants_to_serialized_chats(self, serialized_chats):
-        user_ids = set()
-        for chat in serialized_chats:
-            for participant in chat['participants']:
-                user_ids.add(participant['uuid'])
-        
-        users = User.objects.filter(uuid__in=user_ids)
-        user_map = {user.uuid: user for user in users}
-        
-        for chat in serialized_chats:
-            chat['participants'] = [UserSerializer(user_map[participant['uuid']]).data for participant in chat['participants']]
-        
-        return serialized_chats
+    @database_task
+    def get_inboxes(self, cursor, count, start=0, with_total=False):
+        page = get_inbox_page(self.user_id, cursor, count, start)
+        # Large pages go to clients that opted in with one users table instead of repeated participants
+        budget = settings.CHAT_SNAPSHOT_BUDGET
+        if self.compact and budget and describe(page['results'])[0] > budget:
+            page['results'], page['users'] = compact_chats(page['results'])
+        if with_total:
+            page['total_count'] = get_inbox_count(self.user_id)
+        return page
     
-    @database_sync_to_async
+    @database_task
     def get_inboxes_count(self):
-        return Chat.objects.filter(participants__uuid=self.user_id).count()
+        # Maintained counter, no scan of the user's chats
+        return get_inbox_count(self.user_id)
+
+    async def get_total_count(self):
+        # Read once per socket, inbox_upsert events keep it current
+        if self.total_count is None:
+            self.total_count = await self.get_inboxes_count()
+        return self.total_count
 
     async def send_inboxes(self, inboxes_data):
-        total_count = await self.get_inboxes_count()
+        total_count = await self.get_total_count()
         message = {
             'type': 'user_inboxes',
-            'data': inboxes_data,
+            'data': inboxes_data['results'],
+            'next_cursor': inboxes_data['next_cursor'],
             'total_count': total_count
         }
-        await self.send(text_data=json.dumps(message))
+        if 'users' in inboxes_data:
+            message['users'] = inboxes_data['users']
+        await self.send_data(message)
 
     async def send_inboxes_from_view(self, inboxes_data):
-        total_count = await self.get_inboxes_count()
+        total_count = await self.get_total_count()
         message = {
             'type': 'user_inboxes_from_view',
             'data': inboxes_data,
             'total_count': total_count
         }
-        await self.send(text_data=json.dumps(message))
+        await self.send_data(message)
     
+    async def inbox_upsert(self, event):
+        if self.total_count is not None:
+            self.total_count += 1
+        await self.send_data({
+            'type': 'inbox_upsert',
+            'chat': event['chat'],
+        }, event)
+
+    async def inbox_bump(self, event):
+        await self.send_data({
+            'type': 'inbox_bump',
+            'chat_id': event['chat_id'],
+            'room_name': event['room_name'],
+            'last_activity': event['last_activity'],
+            'last_message': event['last_message'],
+            'last_message_sender': event['last_message_sender'],
+            'last_message_timestamp': event['last_message_timestamp'],
+            'message_id': event['message_id'],
+        }, event)
+
+    async def unread_changed(self, event):
+        await self.send_data({
+            'type': 'unread_changed',
+            'chat_id': event['chat_id'],
+            'unread_count': event['unread_count'],
+        }, event)
+
     async def chat_message(self, event):
         chat = event['data']
-        await self.send(text_data=json.dumps({
+        await self.send_data({
             'type': 'chat_message',
             'data': chat,
-        }))
+        }, event)
     
     async def send_message(self, event):
         message = event['message']
         # send message to websocket
-        await self.send(text_data=json.dumps({'message':message}))
+        await self.send_data({'message':message}, event)
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
+class ChatConsumer(CodecConsumerMixin, AsyncWebsocketConsumer):
+    # Chat messages, files and snapshot frames are KEEP, see disconnect_slow_consumer
+    outbound_policies = {
+        'presence_diff': Coalesce(merge=merge_diffs),
+        'online_participants': Coalesce(),
+        'poll_counts': Coalesce('poll_id'),
+        'messages_read': Coalesce('user_id'),
+    }
 
     async def connect(self):
+        self.in_presence = False
+        self.in_room_cache = False
+        # Digest of the last chat snapshot this socket got, the base of chat_diff frames
+        self.compact = wants_compact(self.scope)
+        self.chat_digest = None
+        # History cursor of the last chat message written to this socket
+        self.delivered_cursor = None
+        # (timestamp, id) of the newest message replayed by resume(), live ones up to it are dropped
+        self.replayed_until = None
         # Get UserID
-        self.user_id = self.scope['query_string'].decode('utf-8').split('=')[1]
+        self.user_id = get_scope_user_id(self.scope)
 
         self.room_name = self.scope["url_route"]["kwargs"]["room_name"]
         self.room_group_name = "chat_%s" % self.room_name
+        if self.user_id is None:
+            await self.close()
+            return
+
+        # Room context is read once per process, room_changed events refresh it
+        room_cache.acquire(self.room_name)
+        self.in_room_cache = True
+        if await self.load_room() is None:
+            # Unknown room: every later lookup of it would fail
+            self.in_room_cache = False
+            room_cache.release(self.room_name)
+            await self.close()
+            return
 
         # Join room group
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
@@ -121,6 +228,15 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
         await self.accept()
 
+        await self.join_presence()
+
+        # Reconnect of a socket disconnected as a slow consumer, replay what it missed.
+        # Group events are only dispatched once connect() returns, so live
+        # messages that arrived meanwhile are written after the resumed frame.
+        resume_token = parse_qs(self.scope['query_string'].decode()).get('resume')
+        if resume_token:
+            await self.resume(resume_token[0])
+
     async def disconnect(self, close_code):
         # # Leave room group
         # await self.remove_user_from_stream()
@@ -129,13 +245,17 @@ class ChatConsumer(AsyncWebsocketConsumer):
         # participants = await self.get_online_participants()
         # await self.send_online_participants(participants)
         print("Disconnect method called")
+        await self.leave_presence()
+        if getattr(self, 'in_room_cache', False):
+            self.in_room_cache = False
+            room_cache.release(self.room_name)
 
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
 
         # Close the WebSocket connection
         await self.close()
 
-    @database_sync_to_async
+    @database_task
     def set_user_chatroom_status(self, status):
         user = User.objects.get(uuid=self.user_id)
         chat = Chat.objects.get(room_name=self.room_name, room_group_name=self.room_group_name)
@@ -164,54 +284,52 @@ class ChatConsumer(AsyncWebsocketConsumer):
         )
 
     # Receive message from WebSocket
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
+        text_data_json = self.decode(text_data, bytes_data)
         message_type = text_data_json['type']
         # print(text_data_json)
         if message_type == 'user_connected':
-            # Fetch inboxes for user
+            # Snapshot for this socket only, the room gets a batched presence diff
+            await self.join_presence()
             participants = await self.get_online_participants()
-            await self.send_online_participants(participants)
+            await self.online_participants({'participants': participants})
             await self.forward_chat_info()
             
         elif message_type == 'user_disconnected':
-            # Fetch inboxes for user
-            participants = await self.get_online_participants()
-            await self.send_online_participants(participants)
-            await self.forward_chat_info()
+            await self.leave_presence()
 
         elif message_type == 'user_joined_video_room':
             # Update user's call status and add them to the stream
-            await self.add_user_to_stream()
-            await self.forward_chat_info()
-
-            participants = await self.get_online_participants()
-            await self.send_online_participants(participants)
+            chat_info = await self.join_stream()
+            await presence.join_call(self.room_name, self.user_id)
+            await self.forward_chat_info(chat_info)
 
         elif message_type == 'user_left_video_room':
             # Update user's call status and remove them from the stream
-            await self.remove_user_from_stream()
-            await self.forward_chat_info()
+            chat_info = await self.leave_stream()
+            await presence.leave_call(self.room_name, self.user_id)
+            await self.forward_chat_info(chat_info)
 
             participants = await self.get_online_participants()
-            await self.send_online_participants(participants)
-            await self.send_chat_data(participants)
+            await self.send_chat_data(participants, chat_info)
 
         elif message_type == 'video_call_started':
-            await self.add_user_to_stream()
-            chat = await self.get_chat_by_room_name()
+            chat_info = await self.join_stream()
+            await presence.join_call(self.room_name, self.user_id)
             await self.channel_layer.group_send(
                 self.room_group_name,
                 {
                     'type': 'video_call_started',
                     'user_id': text_data_json['user_id'],
-                    "chat": await self.get_chat_serialized_data(chat),
+                    "chat": chat_info['chat'],
+                    'chat_size': chat_info['chat_size'],
+                    'chat_digest': chat_info['chat_digest'],
                 }
             )
 
         elif message_type == 'leave_video_call':
-            await self.remove_user_from_stream()
-            chat = await self.get_chat_by_room_name()
+            chat_info = await self.leave_stream()
+            await presence.leave_call(self.room_name, self.user_id)
             participants_left = await self.get_online_participants()
             await self.channel_layer.group_send(
                 self.room_group_name,
@@ -219,10 +337,16 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     'type': 'video_call_ended',
                     'user_id': text_data_json['user_id'],
                     'participants_left': participants_left,
-                    "chat": await self.get_chat_serialized_data(chat),
+                    "chat": chat_info['chat'],
+                    'chat_size': chat_info['chat_size'],
+                    'chat_digest': chat_info['chat_digest'],
                 }
             )
 
+        elif message_type == 'mark_read':
+            # The room is told by a messages_read event once the watermark moved
+            await self.mark_read(text_data_json.get('message_id'))
+
         else:
             message = text_data_json["message"]
             await self.channel_layer.group_send(
@@ -232,84 +356,185 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 }
             )
 
-    @database_sync_to_async
-    def get_chat_serialized_data(self, chat):
-        return ChatSerializer(chat).data
+    @database_task
+    def load_room(self):
+        try:
+            return room_cache.get(self.room_name)
+        except Chat.DoesNotExist:
+            return None
+
+    def frame_written(self, event_type, event):
+        if event is not None and 'cursor' in event:
+            self.delivered_cursor = event['cursor']
+
+    async def resume_state(self, undelivered):
+        # Resume after the last message written, or from the first one given up
+        cursor = self.delivered_cursor
+        if cursor is None:
+            cursor = next((entry[2]['cursor'] for entry in undelivered if entry[2] and 'cursor' in entry[2]), None)
+            if cursor is not None:
+                timestamp, message_id = parse_message_cursor(cursor)
+                cursor = cursor_for(timestamp, message_id - 1)
+            else:
+                cursor = cursor_for(timezone.now(), 0)
+        token = signing.dumps({'r': self.room_name, 'u': self.user_id, 'c': cursor}, salt='chat.resume')
+        return {'resume_token': token}
+
+    async def resume(self, token):
+        """
+        Replays the chat messages missed since the token's cursor in one
+        resumed frame, with the chat's read watermarks, followed by an
+        online_participants snapshot. Other events given up with the queue
+        (poll_counts, file_ready, presence diffs) are not replayed: replayed
+        payloads carry their current poll counts and file statuses, messages
+        the client had before the disconnect are refreshed by reloading them
+        over the history endpoint.
+        """
+        page = await self.load_missed_messages(token)
+        if page is None:
+            # Expired or not this socket's, the client reloads the history over REST
+            await self.send_data({'type': 'resume_expired'})
+            return
+        if page['last_cursor'] is not None:
+            self.replayed_until = parse_message_cursor(page['last_cursor'])
+        await self.send_data(RawJSON('{"type": "resumed", "messages": [%s], "newer_cursor": %s, "read_states": %s}' % (
+            ', '.join(page['results']),
+            json.dumps(page['newer_cursor']),
+            json.dumps(page['read_states']),
+        )), {'type': 'resumed'})
+        await self.online_participants({'participants': await self.get_online_participants()})
+
+    @database_task
+    def load_missed_messages(self, token):
+        try:
+            state = signing.loads(token, salt='chat.resume', max_age=settings.OUTBOUND_RESUME_TTL)
+        except signing.BadSignature:
+            return None
+        if state.get('r') != self.room_name or state.get('u') != self.user_id:
+            return None
+        # newer_cursor continues the replay over the history endpoint when more was missed
+        try:
+            chat = room_cache.get(self.room_name).chat()
+        except Chat.DoesNotExist:
+            return None
+        return get_message_page(chat, after=parse_message_cursor(state['c']), count=settings.MESSAGE_MAX_PAGE_SIZE)
 
-    @database_sync_to_async
-    def get_chat_by_room_name(self):
-        return Chat.objects.get(room_name=self.room_name)
-    
-    @database_sync_to_async
-    def get_active_streams_count(self, chat):
-        return chat.stream.filter(is_active=True).count()
+    @database_task
+    def mark_read(self, message_id):
+        try:
+            chat = room_cache.get(self.room_name).chat()
+            return mark_read(self.user_id, chat, int(message_id) if message_id is not None else None)
+        except (Chat.DoesNotExist, TypeError, ValueError):
+            return None
+
+    # Each client event makes at most one executor call: the stream change and
+    # every read the replies need run together, on one connection.
+
+    def load_chat_info(self):
+        chat = Chat.objects.prefetch_related(
+            'participants',
+            Prefetch('stream', queryset=Stream.objects.select_related('user')),
+        ).get(room_name=self.room_name)
+        chat_data = ChatSerializer(chat).data
+        # Measured here, off the event loop, for the snapshot budget
+        size, digest = describe(chat_data)
+        return {
+            'count': sum(1 for stream in chat.stream.all() if stream.is_active),
+            'chat': chat_data,
+            'chat_size': size,
+            'chat_digest': digest,
+        }
+
+    @database_task
+    def get_chat_info(self):
+        return self.load_chat_info()
+
+    @database_task
+    def join_stream(self):
+        self.add_user_to_stream()
+        return self.load_chat_info()
+
+    @database_task
+    def leave_stream(self):
+        self.remove_user_from_stream()
+        return self.load_chat_info()
+
+    async def join_presence(self):
+        if not self.in_presence:
+            self.in_presence = True
+            await presence.connect(self.room_name, self.room_group_name, self.user_id)
+
+    async def leave_presence(self):
+        if getattr(self, 'in_presence', False):
+            self.in_presence = False
+            await presence.disconnect(self.room_name, self.user_id)
 
-    @database_sync_to_async
     def add_user_to_stream(self):
-        user = User.objects.get(uuid=self.user_id)
-        user.is_in_call = True
-        user.save()
-        
-        chat = Chat.objects.get(room_name=self.room_name)
-        stream, _ = Stream.objects.get_or_create(user=user, is_active=True)
-        chat.stream.add(stream)
+        # is_in_call is tracked by the presence service and persisted in batches
+        room = room_cache.get(self.room_name)
+        user_pk = room.participants.get(self.user_id)
+        if user_pk is None:
+            user_pk = User.objects.values_list('pk', flat=True).get(uuid=self.user_id)
+
+        stream, _ = Stream.objects.get_or_create(user_id=user_pk, is_active=True)
+        room.chat().stream.add(stream)
         # chat.connected_users.add(user)
-        chat.save()
 
-    @database_sync_to_async
     def remove_user_from_stream(self):
-        user = User.objects.get(uuid=self.user_id)
-        user.is_in_call = False
-        user.save()
-
-        chat = Chat.objects.get(room_name=self.room_name)
-        stream = chat.stream.filter(user=user, is_active=True).first()
-        if stream:
-            chat.stream.remove(stream)
+        room = room_cache.get(self.room_name)
+        chat = room.chat()
+        stream_id = room.stream_of(self.user_id)
+        if stream_id is None:
+            # Not in the cached context, it may have been added by another worker just now
+            stream_id = chat.stream.filter(user__uuid=self.user_id, is_active=True).values_list('id', flat=True).first()
+        if stream_id:
+            chat.stream.remove(stream_id)
             # chat.connected_users.remove(user)
-            chat.save()
-            stream.is_active = False
-            stream.save()
-    
-    @database_sync_to_async
-    def get_online_participants(self):
-        chat = Chat.objects.get(room_name=self.room_name, room_group_name=self.room_group_name)
-        online_users = User.objects.filter(connected_chats=chat, is_online=True)
-
-        # Use the UserSerializer to serialize the online_users queryset
-        serializer = UserSerializer(online_users, many=True)
-        participants = serializer.data
-        return participants
+            Stream.objects.filter(id=stream_id).update(is_active=False)
     
-    async def send_online_participants(self, participants):
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'online_participants',
-                'participants': participants,
-            }
-        )
+    async def get_online_participants(self):
+        # Served from the presence store, no database round trip
+        return await presence.snapshot(self.room_name)
 
-    async def send_chat_data(self, participants_left):
-        chat = await self.get_chat_by_room_name()
+    async def send_chat_data(self, participants_left, chat_info=None):
+        if chat_info is None:
+            chat_info = await self.get_chat_info()
         await self.channel_layer.group_send(
             self.room_group_name,
             {
                 'type': 'video_call_ended',
                 'user_id': self.user_id,
                 'participants_left': participants_left,
-                'chat': await self.get_chat_serialized_data(chat)
+                'chat': chat_info['chat'],
+                'chat_size': chat_info['chat_size'],
+                'chat_digest': chat_info['chat_digest'],
             }
         )
 
+    def chat_fields(self, chat, size=None, digest=None):
+        # The full snapshot, or a chat_diff against the last one this socket got
+        fields, variant = chat_snapshots.frame_fields(chat, size, digest, self.chat_digest, self.compact)
+        if digest is not None:
+            self.chat_digest = digest
+        return fields, variant
+
     async def online_participants(self, event):
         participants = event['participants']
-        await self.send(text_data=json.dumps({
+        await self.send_data({
             'type': 'online_participants',
             'participants': participants,
-        }))
+        })
+
+    async def presence_diff(self, event):
+        await self.send_data({
+            'type': 'presence_diff',
+            'online': event['online'],
+            'offline': event['offline'],
+            'joined_call': event['joined_call'],
+            'left_call': event['left_call'],
+        }, event)
     
-    @database_sync_to_async
+    @database_task
     def get_inboxes(self, start, count):
         chats = Chat.objects.filter(participants__uuid=self.user_id).order_by('-created_at').prefetch_related('participants')[start:start+count]
         serialized_chats = ChatSerializer(chats, many=True).data
@@ -318,81 +543,122 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
     # Receive message from room group
     async def chat_message(self, event):
+        if self.replayed_until is not None and 'cursor' in event:
+            if parse_message_cursor(event['cursor']) <= self.replayed_until:
+                # Sent while the socket was resuming and already in the resumed frame
+                return
+            # Past the replay, every later live message is newer
+            self.replayed_until = None
+        # Messages from views carry the cached JSON payload, splice it in as is
+        if 'payload' in event:
+            await self.send_data(RawJSON('{"type": "chat_message", "message": %s}' % event['payload']), event)
+            return
         message = event['message']
         # Send message to WebSocket
-        await self.send(text_data=json.dumps({
+        await self.send_data({
             'type': 'chat_message',
             'message': message
-        }))
+        }, event)
     
     async def send_poll_vote(self, event):
+        if 'payload' in event:
+            await self.send_data(RawJSON('{"type": "poll_vote", "message": %s}' % event['payload']), event)
+            return
         message = event['message']
         # Send message to WebSocket
-        await self.send(text_data=json.dumps({
+        await self.send_data({
             'type': 'poll_vote',
             'message': message
-        }))
+        }, event)
+
+    async def file_ready(self, event):
+        # An attachment of an already delivered message finished uploading
+        await self.send_data({
+            'type': 'file_ready',
+            'message_id': event['message_id'],
+            'file_id': event['file_id'],
+            'field': event['field'],
+            'status': event['status'],
+            'url': event['url'],
+        }, event)
+
+    async def room_changed(self, event):
+        # Participants or streams changed, every socket relays it but it's applied once
+        room_cache.invalidate(self.room_name, event['change_id'])
+
+    async def messages_read(self, event):
+        # A participant's read watermark, clients mark every message up to it as read by them
+        await self.send_data({
+            'type': 'messages_read',
+            'user_id': event['user_id'],
+            'last_read_message_id': event['last_read_message_id'],
+        }, event)
+
+    async def poll_counts(self, event):
+        # Coalesced vote counts, sent at most once per broadcast window
+        await self.send_data({
+            'type': 'poll_counts',
+            'poll_id': event['poll_id'],
+            'total_votes_count': event['total_votes_count'],
+            'options': event['options'],
+        }, event)
 
     async def user_status(self, event):
         user_id = event["user_id"]
         is_online = event["is_online"]
         print(f"User {user_id} is {'online' if is_online else 'offline'}")
 
-    async def forward_chat_info(self):
-        chat = await self.get_chat_by_room_name()
-        active_streams_count = await self.get_active_streams_count(chat)
+    async def forward_chat_info(self, chat_info=None):
+        if chat_info is None:
+            chat_info = await self.get_chat_info()
+        fields, _ = self.chat_fields(chat_info['chat'], chat_info['chat_size'], chat_info['chat_digest'])
         # Send the number of active streams to the user
-        await self.send(json.dumps({
+        await self.send_data({
             "type": "active_streams", 
-            "count": active_streams_count,
-            "chat": await self.get_chat_serialized_data(chat),
-        }))
+            "count": chat_info['count'],
+            **fields,
+        })
 
     async def video_call_started(self, event):
         user_id = event["user_id"]
-        chat = event["chat"]
+        fields, variant = self.chat_fields(event["chat"], event.get('chat_size'), event.get('chat_digest'))
 
         # Send the video call started status to the WebSocket
-        await self.send(text_data=json.dumps({
+        await self.send_data({
             "type": "video_call_started",
             "user_id": user_id,
-            "chat": chat
-        }))
+            **fields,
+        }, event, variant)
     
 
     async def video_call_ended(self, event):
         user_id = event["user_id"]
-        chat = event["chat"]
+        fields, variant = self.chat_fields(event["chat"], event.get('chat_size'), event.get('chat_digest'))
         participants_left = event["participants_left"]
 
         # Send the video call ended status to the WebSocket
-        await self.send(text_data=json.dumps({
+        await self.send_data({
             "type": "video_call_ended",
             "user_id": user_id,
             "participants_left": participants_left,
-            "chat": chat
-        }))
+            **fields,
+        }, event, variant)
 
 
 
 
-class VideoCallConsumer(AsyncWebsocketConsumer):
-    users_in_call = set()
+class VideoCallConsumer(CodecConsumerMixin, AsyncWebsocketConsumer):
+    outbound_policies = {
+        'update_users_list': Coalesce(),
+    }
+
     async def connect(self):
-        # Get UserID
-        token = self.scope["query_string"].decode().split("=")[1]
-        try:
-            payload = jwt.decode(token, secret_key, algorithms=["HS256"])
-            self.user_id = payload["user_id"]
-        except jwt.ExpiredSignatureError:
-            # Handle expired token error
-            await self.close()
-        except jwt.DecodeError:
-            # Handle invalid token error
-            await self.close()
-        except Exception:
-            # Handle other errors
+        self.in_call = False
+        # Get UserID, JWTAuthMiddleware verified ?token= (expired or invalid ones leave no user_id)
+        self.user_id = self.scope.get("user_id")
+        if self.user_id is None:
             await self.close()
+            return
 
         self.room_name = self.scope["url_route"]["kwargs"]["room_name"]
         self.room_group_name = "call_%s" % self.room_name
@@ -401,24 +667,67 @@ class VideoCallConsumer(AsyncWebsocketConsumer):
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
         print(f'User {self.user_id} connected to Video Call Channel with Room name: {self.room_name}')
 
-        # Add user to users_in_call and broadcast updated list
-        VideoCallConsumer.users_in_call.add(self.user_id)
-        await self.broadcast_users_list()
-
         await self.accept()
+
+        # Register in this room's call and send the current members to this socket only.
+        # Peers' channel names let answers, offers and candidates skip the group.
+        first = await sync_to_async(call_registry.join, thread_sensitive=False)(
+            self.room_name, self.user_id, self.channel_name
+        )
+        self.in_call = True
+        self.peer_channels = {}
+        channels = await sync_to_async(call_registry.channels, thread_sensitive=False)(self.room_name)
+        for channel_name, user_id in channels.items():
+            self.peer_channels.setdefault(user_id, set()).add(channel_name)
+        await self.forward_users_list({"users": sorted(self.peer_channels)})
+
+        # Pending trickle-ICE candidates per target user (None = whole room)
+        self.ice_batches = {}
+        self.ice_flush = None
+
+        if first:
+            producer.publish('call_joined', {'room_name': self.room_name, 'user_id': self.user_id})
+
+        # The rest of the room only gets the delta
+        await self.channel_layer.group_send(
+            self.room_group_name,
+            {
+                "type": "forward_user_joined",
+                "user_id": self.user_id,
+                "channel_name": self.channel_name,
+                "first": first,
+            },
+        )
     
     async def disconnect(self, close_code):
+        if not self.in_call:
+            return
         print(f'User {self.user_id} DISCONNECTED from Video Call Channel with Room name: {self.room_name}')
 
-        # Remove user from users_in_call and broadcast updated list
-        VideoCallConsumer.users_in_call.discard(self.user_id)
-        await self.broadcast_users_list()
+        if self.ice_flush is not None:
+            self.ice_flush.cancel()
+            await self.flush_ice_candidates()
 
+        self.in_call = False
+        last = await sync_to_async(call_registry.leave, thread_sensitive=False)(
+            self.room_name, self.user_id, self.channel_name
+        )
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        if last:
+            producer.publish('call_left', {'room_name': self.room_name, 'user_id': self.user_id})
+        await self.channel_layer.group_send(
+            self.room_group_name,
+            {
+                "type": "forward_user_left",
+                "user_id": self.user_id,
+                "channel_name": self.channel_name,
+                "last": last,
+            },
+        )
 
     # Handle incoming WebSocket messages
-    async def receive(self, text_data):
-        message = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
+        message = self.decode(text_data, bytes_data)
         message_type = message["type"]
         if message_type == "offer":
             await self.send_offer(message)
@@ -429,56 +738,160 @@ class VideoCallConsumer(AsyncWebsocketConsumer):
         else:
             print(f"Unhandled message: {message}")
 
+    async def send_to_peer(self, to_user_id, event):
+        # Straight to the target's sockets, the whole room only when the target is unknown
+        channels = self.peer_channels.get(to_user_id) if to_user_id else None
+        if not channels:
+            await self.channel_layer.group_send(self.room_group_name, event)
+            return
+        for channel_name in channels:
+            await self.channel_layer.send(channel_name, event)
+
     async def send_offer(self, message):
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                "type": "forward_offer",
-                "offer": message["offer"],
-                "from_user_id": self.user_id,
-            },
-        )
+        await self.send_to_peer(message.get("to_user_id"), {
+            "type": "forward_offer",
+            "offer": message["offer"],
+            "from_user_id": self.user_id,
+        })
 
     async def send_answer(self, message):
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                "type": "forward_answer",
-                "answer": message["answer"],
-                "from_user_id": self.user_id,
-                "to_user_id": message["to_user_id"],
-            },
-        )
+        await self.send_to_peer(message["to_user_id"], {
+            "type": "forward_answer",
+            "answer": message["answer"],
+            "from_user_id": self.user_id,
+            "to_user_id": message["to_user_id"],
+        })
 
     async def send_ice_candidate(self, message):
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                "type": "forward_ice_candidate",
-                "candidate": message["candidate"],
+        # Trickle-ICE produces bursts of candidates, batch them per target
+        self.ice_batches.setdefault(message.get("to_user_id"), []).append(message["candidate"])
+        if self.ice_flush is None:
+            self.ice_flush = asyncio.get_running_loop().call_later(
+                settings.ICE_BATCH_WINDOW,
+                lambda: asyncio.ensure_future(self.flush_ice_candidates()),
+            )
+
+    async def flush_ice_candidates(self):
+        batches, self.ice_batches = self.ice_batches, {}
+        self.ice_flush = None
+        for to_user_id, candidates in batches.items():
+            await self.send_to_peer(to_user_id, {
+                "type": "forward_ice_candidates",
+                "candidates": candidates,
                 "from_user_id": self.user_id,
-            },
-        )
+            })
 
-    async def broadcast_users_list(self):
-        users_list = list(VideoCallConsumer.users_in_call)
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                "type": "forward_users_list",
-                "users": users_list,
-            },
-        )
-    
     # These handlers will forward the messages to the respective clients
     async def forward_offer(self, event):
-        await self.send(json.dumps({"type": "offer", "offer": event["offer"], "from_user_id": event["from_user_id"]}))
+        await self.send_data({"type": "offer", "offer": event["offer"], "from_user_id": event["from_user_id"]})
 
     async def forward_answer(self, event):
-        await self.send(json.dumps({"type": "answer", "answer": event["answer"], "from_user_id": event["from_user_id"], "to_user_id": event["to_user_id"]}))
+        await self.send_data({"type": "answer", "answer": event["answer"], "from_user_id": event["from_user_id"], "to_user_id": event["to_user_id"]})
 
     async def forward_ice_candidate(self, event):
-        await self.send(json.dumps({"type": "ice_candidate", "candidate": event["candidate"], "from_user_id": event["from_user_id"]}))
+        await self.send_data({"type": "ice_candidate", "candidate": event["candidate"], "from_user_id": event["from_user_id"]})
+
+    async def forward_ice_candidates(self, event):
+        # A lone candidate keeps the original frame so older clients still work
+        if len(event["candidates"]) == 1:
+            await self.forward_ice_candidate({"candidate": event["candidates"][0], "from_user_id": event["from_user_id"]})
+            return
+        await self.send_data({"type": "ice_candidates", "candidates": event["candidates"], "from_user_id": event["from_user_id"]})
     
     async def forward_users_list(self, event):
-        await self.send(json.dumps({"type": "update_users_list", "users": event["users"]}))
\ No newline at end of file
+        await self.send_data({"type": "update_users_list", "users": event["users"]})
+
+    async def forward_user_joined(self, event):
+        # The joining socket already got the full list on connect
+        if event["channel_name"] == self.channel_name:
+            return
+        self.peer_channels.setdefault(event["user_id"], set()).add(event["channel_name"])
+        if event["first"]:
+            await self.send_data({"type": "user_joined_call", "user_id": event["user_id"]}, event)
+
+    async def forward_user_left(self, event):
+        channels = self.peer_channels.get(event["user_id"], set())
+        channels.discard(event["channel_name"])
+        if not channels:
+            self.peer_channels.pop(event["user_id"], None)
+        if event["last"]:
+            await self.send_data({"type": "user_left_call", "user_id": event["user_id"]}, event)
+
+
+
+class ExportMessagesConsumer(AsyncHttpConsumer):
+    """
+    Streams a chat's full history as NDJSON, one message per line, one
+    keyset chunk at a time.
+
+    HTTP is served through ASGI here and Django 3.2 iterates a
+    StreamingHttpResponse's generator on the event loop, where ORM calls
+    are refused, and a `.iterator(chunk_size)` server-side cursor can't
+    be held across database_sync_to_async's thread hops either (it also
+    drops prefetch_related on 3.2). So this is a consumer on the http
+    URLRouter that loads each chunk in a worker thread and sends it with
+    more_body; every other path falls through to the Django app.
+
+    Access is checked like the REST views: a Bearer access token through
+    CachedJWTAuthentication's checks, 404 for an unknown chat, 403 for a
+    non-participant, errors in StandardAPIView's envelope.
+    """
+
+    async def handle(self, body):
+        try:
+            payload = verify_authorization(self.get_header(b'authorization'))
+        except AuthenticationFailed as e:
+            return await self.send_json_error(401, str(e.detail))
+        if payload is None or 'user_id' not in payload:
+            return await self.send_json_error(401, 'Authentication credentials were not provided.')
+        user_id = str(payload['user_id'])
+
+        kwargs = self.scope['url_route']['kwargs']
+        chat = await self.get_chat(kwargs['room_name'], kwargs['room_group_name'], user_id)
+        if chat is None:
+            return await self.send_json_error(404, 'Chat not found')
+        chat_id, is_participant = chat
+        if not is_participant:
+            return await self.send_json_error(403, 'You do not have access to this chat')
+
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        try:
+            cursor = parse_message_cursor(query.get('after', [None])[0])
+        except ValueError as e:
+            return await self.send_json_error(400, str(e))
+
+        await self.send_headers(headers=[
+            (b'Content-Type', b'application/x-ndjson'),
+            (b'Content-Disposition', f'attachment; filename="chat-{chat_id}.ndjson"'.encode()),
+        ])
+        while True:
+            lines, cursor = await database_sync_to_async(load_export_chunk)(chat_id, cursor)
+            if not lines:
+                break
+            await self.send_body(''.join(lines).encode(), more_body=True)
+        await self.send_body(b'')
+
+    def get_header(self, name):
+        for header, value in self.scope.get('headers', []):
+            if header == name:
+                return value
+        return b''
+
+    async def send_json_error(self, status, error):
+        await self.send_response(
+            status,
+            json.dumps({'success': False, 'status': status, 'error': error}).encode(),
+            headers=[(b'Content-Type', b'application/json')],
+        )
+
+    @database_sync_to_async
+    def get_chat(self, room_name, room_group_name, user_id):
+        # (chat id, whether user_id takes part), None for an unknown chat
+        chat_id = (
+            Chat.objects.filter(room_name=room_name, room_group_name=room_group_name)
+            .values_list('id', flat=True)
+            .first()
+        )
+        if chat_id is None:
+            return None
+        return chat_id, Chat.participants.through.objects.filter(chat_id=chat_id, user__uuid=user_id).exists()
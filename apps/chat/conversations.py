@@ -0,0 +1,83 @@
+import hashlib
+from uuid import uuid4
+
+from django.db import IntegrityError, connection, transaction
+
+from .counters import add_participants
+from .models import Chat, User
+
+
+def pair_key(user_a, user_b):
+    # Same key whichever side starts the conversation
+    return hashlib.sha256('\n'.join(sorted([str(user_a), str(user_b)])).encode()).hexdigest()
+
+
+def upsert_users(usernames):
+    """
+    Inserts or renames every {uuid: username} in one statement and returns
+    {uuid: pk}. Postgres and SQLite (3.35+) get INSERT ... ON CONFLICT ...
+    RETURNING, other backends fall back to get_or_create.
+    """
+    if connection.vendor not in ('postgresql', 'sqlite'):
+        ids = {}
+        for uuid, username in usernames.items():
+            user, created = User.objects.get_or_create(uuid=uuid, defaults={'username': username})
+            if not created and user.username != username:
+                User.objects.filter(id=user.id).update(username=username)
+            ids[uuid] = user.id
+        return ids
+
+    # Raw SQL because Django 3.2 has no bulk_create(update_conflicts=...).
+    # Columns and values come from the model, the way Model.save() would insert
+    # them, so new fields get their defaults here too.
+    fields = [field for field in User._meta.concrete_fields if not field.primary_key]
+    users = [User(uuid=uuid, username=username) for uuid, username in usernames.items()]
+    params = [field.get_db_prep_save(field.pre_save(user, True), connection) for user in users for field in fields]
+    table = connection.ops.quote_name(User._meta.db_table)
+    columns = ', '.join(connection.ops.quote_name(field.column) for field in fields)
+    rows = ', '.join(['(%s)' % ', '.join(['%s'] * len(fields))] * len(users))
+    uuid_column = connection.ops.quote_name(User._meta.get_field('uuid').column)
+    username_column = connection.ops.quote_name(User._meta.get_field('username').column)
+    pk_column = connection.ops.quote_name(User._meta.pk.column)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {table} ({columns}) VALUES {rows} '
+            f'ON CONFLICT ({uuid_column}) DO UPDATE SET {username_column} = excluded.{username_column} '
+            f'RETURNING {pk_column}, {uuid_column}',
+            params,
+        )
+        return {uuid: pk for pk, uuid in cursor.fetchall()}
+
+
+def get_or_create_direct_chat(from_user, from_username, to_user, to_username):
+    """
+    Returns (chat, created) for the one-to-one chat between two users. An
+    existing chat costs one lookup on the unique pair_key; creating it is a
+    user upsert plus two inserts inside a savepoint, and a concurrent request
+    that wins the pair_key race makes this one return its chat instead.
+    Usernames are only refreshed when the chat is created, as before the
+    pair key existed.
+    """
+    key = pair_key(from_user, to_user)
+    chat = Chat.objects.filter(pair_key=key).first()
+    if chat is not None:
+        return chat, False
+
+    user_ids = upsert_users({from_user: from_username, to_user: to_username})
+    room_name = str(uuid4())
+    try:
+        with transaction.atomic():
+            chat = Chat.objects.create(
+                name='conversation',
+                room_name=room_name,
+                room_group_name=f'chat_{room_name}',
+                pair_key=key,
+            )
+            Chat.participants.through.objects.bulk_create([
+                Chat.participants.through(chat_id=chat.id, user_id=user_id)
+                for user_id in set(user_ids.values())
+            ])
+            add_participants(chat, user_ids.values())
+    except IntegrityError:
+        return Chat.objects.get(pair_key=key), False
+    return chat, True
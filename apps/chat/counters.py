@@ -0,0 +1,89 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models import F, Q
+
+from core.producer import producer
+
+from .inbox import send_unread_changed
+from .models import Chat, ChatReadState, Message, User
+
+
+def add_participants(chat, user_ids):
+    """
+    Creates the read state of every new participant and bumps their inbox
+    totals; users that already have a read state in the chat are left alone.
+    Runs in the caller's transaction, so the counters commit or roll back
+    together with the membership rows, and holds the chat row so concurrent
+    calls for the same chat can't both count a user as new.
+    """
+    list(Chat.objects.select_for_update().filter(id=chat.id).values_list('id', flat=True))
+    existing = set(ChatReadState.objects.filter(chat_id=chat.id, user_id__in=set(user_ids)).values_list('user_id', flat=True))
+    new_user_ids = set(user_ids) - existing
+    created = ChatReadState.objects.bulk_create(
+        [ChatReadState(chat_id=chat.id, user_id=user_id) for user_id in new_user_ids],
+        ignore_conflicts=True,
+    )
+    User.objects.filter(id__in=new_user_ids).update(inbox_count=F('inbox_count') + 1)
+    return created
+
+
+def count_unread(message, chat):
+    # One UPDATE for every recipient, the new counts are pushed after commit
+    states = ChatReadState.objects.filter(chat_id=chat.id).exclude(user_id=message.sender_id)
+    states.update(unread_count=F('unread_count') + 1)
+    unread_counts = dict(states.values_list('user__uuid', 'unread_count'))
+    transaction.on_commit(lambda: send_unread_changed(chat.id, unread_counts))
+
+
+def mark_read(user_uuid, chat, message_id=None):
+    """
+    Moves the user's read watermark in `chat` forward to message_id, or to the
+    latest message. However long the backlog, this is a single UPDATE of the
+    user's read state, and the room gets one messages_read event. Returns the
+    new watermark, or None when it didn't move (already read further, empty
+    chat, or not a participant).
+    """
+    messages = Message.objects.filter(chat_id=chat.id)
+    if message_id is None:
+        message_id = messages.order_by('-id').values_list('id', flat=True).first()
+        if message_id is None:
+            return None
+    elif not messages.filter(id=message_id).exists():
+        raise ValueError('Message not found in this chat.')
+
+    with transaction.atomic():
+        # The row lock orders this with count_unread's UPDATE: a message it
+        # counts either is in the count below or is added on top of it
+        state = (
+            ChatReadState.objects.select_for_update()
+            .filter(user__uuid=user_uuid, chat_id=chat.id)
+            .filter(Q(last_read_message__isnull=True) | Q(last_read_message_id__lt=message_id))
+            .first()
+        )
+        if state is None:
+            return None
+        # Reading up to an older message leaves the newer ones of the others unread
+        unread_count = messages.filter(id__gt=message_id).exclude(sender__uuid=user_uuid).count()
+        ChatReadState.objects.filter(id=state.id).update(last_read_message_id=message_id, unread_count=unread_count)
+        transaction.on_commit(lambda: send_read(user_uuid, chat, message_id, unread_count))
+    return message_id
+
+
+def send_read(user_uuid, chat, message_id, unread_count):
+    send_unread_changed(chat.id, {user_uuid: unread_count})
+    async_to_sync(get_channel_layer().group_send)(f'chat_{chat.room_name}', {
+        'type': 'messages_read',
+        'user_id': user_uuid,
+        'last_read_message_id': message_id,
+    })
+    producer.publish('message_read', {
+        'chat_id': chat.id,
+        'room_name': chat.room_name,
+        'user_id': user_uuid,
+        'last_read_message_id': message_id,
+    })
+
+
+def get_inbox_count(user_uuid):
+    return User.objects.filter(uuid=user_uuid).values_list('inbox_count', flat=True).first() or 0
@@ -0,0 +1,110 @@
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+
+class DatabaseExecutor:
+    """
+    Runs the consumers' ORM work on a dedicated pool of CONSUMER_DB_WORKERS
+    threads instead of asgiref's single thread-sensitive thread, so one slow
+    query no longer queues every socket of the worker behind it. Each pool
+    thread keeps its own database connection for up to CONN_MAX_AGE seconds;
+    the close_old_connections() around every call only drops it once it's
+    older than that or broken by an error. Time spent waiting for a free
+    thread and time spent running are recorded separately.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='chat-db')
+        self.lock = threading.Lock()
+        # Calls handed to the pool / picked up by a thread, queued is the difference
+        self.submitted = 0
+        self.started = 0
+        self.reset_metrics()
+
+    async def run(self, func, *args, **kwargs):
+        submitted = time.monotonic()
+        state = {'started': False, 'withdrawn': False}
+        with self.lock:
+            self.submitted += 1
+
+        def call():
+            started = time.monotonic()
+            with self.lock:
+                state['started'] = True
+                if not state['withdrawn']:
+                    self.started += 1
+            close_old_connections()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                with self.lock:
+                    self.stats['errors'] += 1
+                raise
+            finally:
+                close_old_connections()
+                self.record(started - submitted, time.monotonic() - started)
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.pool, call)
+        finally:
+            # Cancelled while waiting for a thread, the pool drops the call
+            with self.lock:
+                if not state['started']:
+                    state['withdrawn'] = True
+                    self.submitted -= 1
+
+    def record(self, wait, elapsed):
+        with self.lock:
+            self.stats['calls'] += 1
+            self.stats['wait_total'] += wait
+            self.stats['wait_max'] = max(self.stats['wait_max'], wait)
+            self.stats['exec_total'] += elapsed
+            self.stats['exec_max'] = max(self.stats['exec_max'], elapsed)
+
+    def reset_metrics(self):
+        self.stats = {
+            'calls': 0,
+            'errors': 0,
+            'wait_total': 0.0,
+            'wait_max': 0.0,
+            'exec_total': 0.0,
+            'exec_max': 0.0,
+        }
+
+    def metrics(self):
+        with self.lock:
+            stats = dict(self.stats)
+            queued = self.submitted - self.started
+        calls = stats['calls']
+        return {
+            'workers': self.workers,
+            'queued': queued,
+            'calls': calls,
+            'errors': stats['errors'],
+            'wait_avg_ms': stats['wait_total'] / calls * 1000 if calls else 0.0,
+            'wait_max_ms': stats['wait_max'] * 1000,
+            'exec_avg_ms': stats['exec_total'] / calls * 1000 if calls else 0.0,
+            'exec_max_ms': stats['exec_max'] * 1000,
+        }
+
+
+executor = DatabaseExecutor(settings.CONSUMER_DB_WORKERS) if settings.CONSUMER_DB_WORKERS else None
+
+
+def database_task(func):
+    # Drop-in for database_sync_to_async, on the sized executor unless CONSUMER_DB_WORKERS is 0
+    if executor is None:
+        return database_sync_to_async(func)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await executor.run(func, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,189 @@
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+from core.producer import InMemoryMessage, producer
+
+from .models import User
+
+# Message key (the JSON-quoted event name) -> handler taking every payload of the batch
+handlers = {}
+
+
+def handler(*keys):
+    def register(func):
+        for key in keys:
+            handlers[key] = func
+        return func
+    return register
+
+
+@handler('user_registered', 'user_updated')
+def sync_users(events):
+    # Last event per user wins, one SELECT + one bulk UPDATE + one bulk INSERT per batch
+    usernames = {}
+    for event in events:
+        user_id = event.get('user_id') or event.get('id')
+        if user_id is not None:
+            usernames[str(user_id)] = event.get('username')
+
+    users = list(User.objects.filter(uuid__in=usernames))
+    changed = [user for user in users if user.username != usernames[user.uuid]]
+    for user in changed:
+        user.username = usernames[user.uuid]
+    User.objects.bulk_update(changed, ['username'], batch_size=500)
+
+    known = {user.uuid for user in users}
+    User.objects.bulk_create(
+        [User(uuid=uuid, username=username) for uuid, username in usernames.items() if uuid not in known],
+        batch_size=500,
+        ignore_conflicts=True,
+    )
+
+
+def run_handler(func, events):
+    # Runs in a pool worker, which owns its own database connection
+    close_old_connections()
+    try:
+        func(events)
+    finally:
+        close_old_connections()
+
+
+def init_process_worker():
+    import django
+    django.setup()
+    # Forked workers must not share the parent's connection
+    connection.close()
+
+
+class EventProcessor:
+    """
+    Consumes events in batches of up to EVENT_BATCH_SIZE, groups them by
+    handler, in the order they were consumed, and runs each handler once per
+    batch on a worker pool, so keys sharing a handler never race each other.
+    Offsets are committed only after every handler of the batch succeeded; on
+    failure the partitions are rewound to the start of the batch and it is
+    retried, up to EVENT_MAX_RETRIES times in a row. Past that the events of
+    the failing handlers go to EVENT_DEAD_LETTER_TOPIC and the batch is
+    committed.
+    """
+
+    def __init__(self, consumer, batch_size=None, workers=None, mode=None):
+        self.consumer = consumer
+        self.batch_size = batch_size or settings.EVENT_BATCH_SIZE
+        workers = workers or settings.EVENT_WORKERS
+        if (mode or settings.EVENT_WORKER_MODE) == 'process':
+            self.pool = ProcessPoolExecutor(max_workers=workers, initializer=init_process_worker)
+        else:
+            self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='event-worker')
+        self.running = True
+        self.processed = 0
+        self.failures = 0
+        self.dead_lettered = 0
+
+    def run(self, stop_when_idle=False):
+        while self.running:
+            messages = self.consumer.consume(num_messages=self.batch_size, timeout=settings.EVENT_BATCH_TIMEOUT)
+            if not messages:
+                if stop_when_idle:
+                    return
+                continue
+            self.process(messages)
+
+    def process(self, messages):
+        batches = {}
+        for msg in messages:
+            if msg.error():
+                print(f'Error: {msg.error()}')
+                continue
+            try:
+                key = json.loads(msg.key()) if msg.key() else None
+                value = json.loads(msg.value())
+            except ValueError:
+                print(f'Skipping undecodable event at {msg.topic()}[{msg.partition()}]@{msg.offset()}')
+                continue
+            if key in handlers:
+                batches.setdefault(handlers[key], []).append((key, value))
+
+        futures = {
+            func: self.pool.submit(run_handler, func, [value for key, value in events])
+            for func, events in batches.items()
+        }
+        failed = []
+        for func, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f'Event handler {func.__name__} failed: {e}')
+                failed.append(func)
+
+        if failed:
+            self.failures += 1
+            if self.failures <= settings.EVENT_MAX_RETRIES:
+                self.rewind(messages)
+                time.sleep(settings.EVENT_RETRY_BACKOFF)
+                return
+            for func in failed:
+                self.dead_letter(batches[func])
+
+        self.failures = 0
+        self.consumer.commit(asynchronous=False)
+        self.processed += len(messages)
+
+    def dead_letter(self, events):
+        # Parked with their original key, so they can be replayed onto the events topic
+        print(f'Event batch failed {self.failures} times, {len(events)} events sent to {settings.EVENT_DEAD_LETTER_TOPIC}')
+        for key, value in events:
+            producer.publish(key, value, topic=settings.EVENT_DEAD_LETTER_TOPIC)
+        self.dead_lettered += len(events)
+
+    def rewind(self, messages):
+        from confluent_kafka import TopicPartition
+        first = {}
+        for msg in messages:
+            if msg.error():
+                continue
+            tp = (msg.topic(), msg.partition())
+            first[tp] = min(first.get(tp, msg.offset()), msg.offset())
+        for (topic, partition), offset in first.items():
+            self.consumer.seek(TopicPartition(topic, partition, offset))
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        self.consumer.close()
+
+
+class InMemoryConsumer:
+    # Stand-in for confluent_kafka.Consumer: one partition, manual commits, seekable
+
+    def __init__(self, topic='messages'):
+        self.topic = topic
+        self.log = []
+        self.position = 0
+        self.committed = 0
+
+    def append(self, key, value):
+        self.log.append(InMemoryMessage(
+            self.topic, json.dumps(key).encode(), json.dumps(value).encode(), offset=len(self.log)
+        ))
+
+    def consume(self, num_messages=1, timeout=-1):
+        messages = self.log[self.position:self.position + num_messages]
+        self.position += len(messages)
+        return messages
+
+    def commit(self, asynchronous=True):
+        self.committed = self.position
+
+    def seek(self, partition):
+        self.position = partition.offset
+
+    def close(self):
+        pass
@@ -0,0 +1,134 @@
+import base64
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from .message_cache import get_message_payloads, payload_queryset, read_states_for
+from .models import ChatReadState, Message
+from .serializers import MessageSerializer
+
+
+def encode_cursor(message):
+    return cursor_for(message.timestamp, message.id)
+
+
+def cursor_for(timestamp, message_id):
+    value = f'{timestamp.isoformat()},{message_id}'
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def parse_cursor(cursor):
+    # Opaque to clients: base64 of "<timestamp>,<id>" of a message in a previous page
+    if cursor is None:
+        return None
+    try:
+        timestamp, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit(',', 1)
+        parsed = parse_datetime(timestamp)
+        message_id = int(message_id)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError('Invalid message cursor.')
+    if parsed is None:
+        raise ValueError('Invalid message cursor.')
+    return parsed, message_id
+
+
+def messages_after(messages, cursor):
+    # The plain range on timestamp lets the (chat, timestamp, id) index seek
+    # straight to the cursor, the OR only breaks ties within one timestamp
+    timestamp, message_id = cursor
+    return messages.filter(timestamp__gte=timestamp).filter(
+        Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=message_id)
+    )
+
+
+def read_watermarks(chat_id):
+    # Same shape as the messages_read events, clients derive read_by from them
+    states = ChatReadState.objects.filter(chat_id=chat_id, last_read_message__isnull=False)
+    return [
+        {'user_id': user_id, 'last_read_message_id': message_id}
+        for user_id, message_id in states.values_list('user__uuid', 'last_read_message_id')
+    ]
+
+
+def get_message_page(chat, before=None, after=None, count=None):
+    """
+    Keyset page of a chat's history on (timestamp, id), oldest first.
+    Without a cursor the latest messages are returned. The page costs the
+    same number of queries however deep in the history it is, and carries
+    the chat's read watermarks.
+    """
+    if before is not None and after is not None:
+        raise ValueError('Use either before or after, not both.')
+    count = count or settings.MESSAGE_PAGE_SIZE
+    count = max(1, min(int(count), settings.MESSAGE_MAX_PAGE_SIZE))
+
+    messages = chat.messages.all()
+    if after is not None:
+        messages = messages_after(messages, after).order_by('timestamp', 'id')
+    else:
+        if before is not None:
+            timestamp, message_id = before
+            # Same seek as messages_after, walking backwards
+            messages = messages.filter(timestamp__lte=timestamp).filter(
+                Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id)
+            )
+        messages = messages.order_by('-timestamp', '-id')
+
+    # Only the keyset columns are needed here, payloads come from the cache
+    messages = list(messages.only('id', 'chat', 'timestamp')[:count + 1])
+    has_more = len(messages) > count
+    messages = messages[:count]
+    if after is None:
+        messages.reverse()
+
+    older_cursor = newer_cursor = None
+    if messages:
+        if after is not None or has_more:
+            older_cursor = encode_cursor(messages[0])
+        if before is not None or (after is not None and has_more):
+            newer_cursor = encode_cursor(messages[-1])
+
+    return {
+        'results': get_message_payloads(messages),
+        'older_cursor': older_cursor,
+        'newer_cursor': newer_cursor,
+        # Cursor of the newest message in the page, whatever the direction
+        'last_cursor': encode_cursor(messages[-1]) if messages else None,
+        'read_states': read_watermarks(chat.id),
+    }
+
+
+def load_export_chunk(chat_id, after=None, count=None):
+    """
+    Serializes the next `count` messages after the (timestamp, id) cursor as
+    NDJSON lines. Returns the lines and the cursor to continue from, or an
+    empty list once the history is exhausted. Payloads skip the message
+    cache so a full export doesn't evict the hot pages.
+    """
+    count = count or settings.MESSAGE_EXPORT_CHUNK_SIZE
+    messages = Message.objects.filter(chat_id=chat_id)
+    if after is not None:
+        messages = messages_after(messages, after)
+    keys = list(messages.order_by('timestamp', 'id').values_list('timestamp', 'id')[:count])
+    if not keys:
+        return [], after
+
+    loaded = payload_queryset().in_bulk([message_id for _, message_id in keys])
+    context = {'read_states': read_states_for([chat_id])}
+    lines = [
+        json.dumps(MessageSerializer(loaded[message_id], context=context).data, cls=DjangoJSONEncoder) + '\n'
+        for _, message_id in keys if message_id in loaded
+    ]
+    return lines, keys[-1]
+
+
+def iter_export_lines(chat_id, after=None, count=None):
+    # One bounded keyset query per chunk, memory stays flat whatever the history size
+    while True:
+        lines, after = load_export_chunk(chat_id, after, count)
+        if not lines:
+            return
+        yield from lines
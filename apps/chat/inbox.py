@@ -0,0 +1,131 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models import OuterRef, Prefetch, Q, Subquery
+from django.utils.dateparse import parse_datetime
+
+from .models import Chat, ChatReadState, Message, Stream
+from .serializers import InboxSerializer
+
+INBOX_PAGE_SIZE = 20
+INBOX_MAX_PAGE_SIZE = 100
+
+
+def summary_queryset():
+    # Last message content, sender and timestamp are resolved by correlated
+    # subqueries so the page needs no per-chat queries.
+    last_message = Message.objects.filter(chat=OuterRef('pk')).order_by('-timestamp', '-id')
+    return (
+        Chat.objects.annotate(
+            last_message_content=Subquery(last_message.values('content')[:1]),
+            last_message_sender=Subquery(last_message.values('sender__uuid')[:1]),
+            last_message_timestamp=Subquery(last_message.values('timestamp')[:1]),
+        )
+        .prefetch_related(
+            'participants',
+            Prefetch('stream', queryset=Stream.objects.select_related('user')),
+        )
+    )
+
+
+def inbox_queryset(user_id):
+    # The user's own unread counter, one index lookup per chat of the page
+    unread_count = ChatReadState.objects.filter(chat=OuterRef('pk'), user__uuid=user_id).values('unread_count')[:1]
+    return (
+        summary_queryset()
+        .filter(participants__uuid=user_id)
+        .annotate(unread_count=Subquery(unread_count))
+        .order_by('-last_activity', '-id')
+    )
+
+
+def parse_cursor(last_activity, chat_id):
+    # Both parts of the keyset are required, a half cursor is rejected
+    if last_activity is None and chat_id is None:
+        return None
+    if last_activity is None or chat_id is None:
+        raise ValueError('Cursor requires both last_activity and chat_id.')
+    parsed = parse_datetime(str(last_activity))
+    if parsed is None:
+        raise ValueError('Invalid last_activity cursor.')
+    return parsed, int(chat_id)
+
+
+def get_inbox_page(user_id, cursor=None, count=INBOX_PAGE_SIZE, start=0):
+    count = max(1, min(int(count), INBOX_MAX_PAGE_SIZE))
+    chats = inbox_queryset(user_id)
+    if cursor is not None:
+        last_activity, chat_id = cursor
+        chats = chats.filter(
+            Q(last_activity__lt=last_activity) | Q(last_activity=last_activity, id__lt=chat_id)
+        )[:count + 1]
+    else:
+        # Legacy offset paging, kept for clients that still send `start`
+        chats = chats[start:start + count + 1]
+
+    chats = list(chats)
+    has_more = len(chats) > count
+    chats = chats[:count]
+
+    next_cursor = None
+    if has_more:
+        last = chats[-1]
+        next_cursor = {
+            'last_activity': last.last_activity.isoformat(),
+            'chat_id': last.id,
+        }
+
+    return {
+        'results': InboxSerializer(chats, many=True).data,
+        'next_cursor': next_cursor,
+    }
+
+
+# Incremental inbox events: clients patch the chat they already have instead
+# of downloading the first page again.
+
+def send_to_inboxes(user_ids, event):
+    async def send_all():
+        channel_layer = get_channel_layer()
+        for user_id in user_ids:
+            await channel_layer.group_send(f'inbox_{user_id}', event)
+    async_to_sync(send_all)()
+
+
+def send_inbox_upsert(chat, user_ids):
+    # New chat (or one the user can't have yet): the full summary, once, after commit
+    chat = summary_queryset().get(id=chat.id)
+    event = {
+        'type': 'inbox_upsert',
+        'chat': InboxSerializer(chat).data,
+    }
+    transaction.on_commit(lambda: send_to_inboxes(user_ids, event))
+
+
+def send_inbox_bump(message, chat, sender_id):
+    # New message: only what moved, to every participant, after commit
+    user_ids = list(chat.participants.values_list('uuid', flat=True))
+    event = {
+        'type': 'inbox_bump',
+        'chat_id': chat.id,
+        'room_name': chat.room_name,
+        'last_activity': message.timestamp.isoformat(),
+        'last_message': message.content,
+        'last_message_sender': sender_id,
+        'last_message_timestamp': message.timestamp.isoformat(),
+        'message_id': message.id,
+    }
+    transaction.on_commit(lambda: send_to_inboxes(user_ids, event))
+
+
+def send_unread_changed(chat_id, unread_counts):
+    # {user uuid: unread count}, each user only gets their own count
+    async def send_all():
+        channel_layer = get_channel_layer()
+        for user_id, unread_count in unread_counts.items():
+            await channel_layer.group_send(f'inbox_{user_id}', {
+                'type': 'unread_changed',
+                'chat_id': chat_id,
+                'unread_count': unread_count,
+            })
+    async_to_sync(send_all)()
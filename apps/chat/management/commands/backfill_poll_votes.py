@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError, transaction
+from django.db.models import Count
+
+from apps.chat.models import Poll, PollOption, PollVote
+
+
+class Command(BaseCommand):
+    # Migration 0013 runs the same backfill on deploy, this re-runs it on demand
+    help = 'Links legacy poll votes to their poll and option and recomputes the vote counters'
+
+    def handle(self, *args, **options):
+        linked, skipped = 0, 0
+
+        # Legacy votes only hang off PollOption.votes, resolve poll and option from it
+        legacy_options = (
+            PollOption.objects.filter(votes__option__isnull=True)
+            .distinct()
+            .prefetch_related('poll_options')
+        )
+        for option in legacy_options.iterator():
+            poll = next(iter(option.poll_options.all()), None)
+            vote_ids = list(option.votes.filter(option__isnull=True).values_list('id', flat=True))
+            for vote_id in vote_ids:
+                try:
+                    with transaction.atomic():
+                        PollVote.objects.filter(id=vote_id).update(poll=poll, option=option)
+                    linked += 1
+                except IntegrityError:
+                    # The voter already has a ballot in this poll
+                    skipped += 1
+
+        options_updated = self.recount(PollOption.objects.annotate(counted=Count('ballots')))
+        polls_updated = self.recount(Poll.objects.annotate(counted=Count('ballots')))
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Linked {linked} votes ({skipped} duplicates skipped), '
+            f'fixed {options_updated} option and {polls_updated} poll counters'
+        ))
+
+    def recount(self, queryset):
+        stale = []
+        for obj in queryset.iterator():
+            if obj.vote_count != obj.counted:
+                obj.vote_count = obj.counted
+                stale.append(obj)
+        queryset.model.objects.bulk_update(stale, ['vote_count'], batch_size=500)
+        return len(stale)
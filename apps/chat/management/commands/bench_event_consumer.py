@@ -0,0 +1,46 @@
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+
+from apps.chat.events import EventProcessor, InMemoryConsumer
+from apps.chat.models import User
+
+PREFIX = 'bench-events-'
+
+
+class Command(BaseCommand):
+    help = 'Measures consumer.py throughput (events per second) against an in-memory broker'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=50000)
+        parser.add_argument('--users', type=int, default=5000)
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--mode', choices=['thread', 'process'], default='thread')
+        parser.add_argument('--cleanup', action='store_true', help='Delete the users created by previous runs and exit')
+
+    def handle(self, *args, **options):
+        if options['cleanup']:
+            User.objects.filter(uuid__startswith=PREFIX).delete()
+            return
+
+        run = uuid.uuid4().hex[:6]
+        consumer = InMemoryConsumer()
+        for i in range(options['events']):
+            user = i % options['users']
+            consumer.append('user_updated', {'user_id': f'{PREFIX}{run}-{user}', 'username': f'user {user} v{i}'})
+
+        processor = EventProcessor(consumer, options['batch_size'], options['workers'], options['mode'])
+        started = time.perf_counter()
+        try:
+            processor.run(stop_when_idle=True)
+        finally:
+            processor.close()
+        elapsed = time.perf_counter() - started
+
+        synced = User.objects.filter(uuid__startswith=f'{PREFIX}{run}-').count()
+        self.stdout.write(
+            f'{processor.processed} events in {elapsed:.2f}s: {processor.processed / elapsed:.0f} events/s, '
+            f'{synced} users synced, committed offset {consumer.committed}'
+        )
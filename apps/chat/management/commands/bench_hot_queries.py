@@ -0,0 +1,103 @@
+import random
+import statistics
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from apps.chat.models import Chat, Message, Stream, User
+
+PREFIX = 'bench-idx-'
+
+
+class Command(BaseCommand):
+    help = (
+        'Seeds a large local dataset and reports latencies of the room / message / '
+        'participant hot-path queries. Run it once on the previous migration '
+        '(migrate chat 0006) and once on the latest to compare.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chats', type=int, default=10000)
+        parser.add_argument('--messages', type=int, default=50, help='Messages per chat')
+        parser.add_argument('--iterations', type=int, default=200)
+        parser.add_argument('--no-seed', action='store_true', help='Reuse previously seeded rows')
+        parser.add_argument('--cleanup', action='store_true', help='Delete the seeded rows and exit')
+
+    def handle(self, *args, **options):
+        if options['cleanup']:
+            Chat.objects.filter(name__startswith=PREFIX).delete()
+            User.objects.filter(uuid__startswith=PREFIX).delete()
+            return
+
+        if not options['no_seed']:
+            self.seed(options['chats'], options['messages'])
+
+        rooms = list(Chat.objects.filter(name__startswith=PREFIX).values_list('id', 'room_name', 'room_group_name'))
+        users = list(User.objects.filter(uuid__startswith=PREFIX).values_list('id', 'uuid'))
+        if not rooms:
+            self.stderr.write('Nothing seeded, run without --no-seed first')
+            return
+
+        queries = {
+            'chat by room_name': lambda: Chat.objects.get(room_name=random.choice(rooms)[1]),
+            'chat by room + group': lambda: Chat.objects.filter(
+                room_name=random.choice(rooms)[1], room_group_name__isnull=False
+            ).first(),
+            'latest 20 messages': lambda: list(
+                Message.objects.filter(chat_id=random.choice(rooms)[0]).order_by('-timestamp')[:20]
+            ),
+            'participant by uuid': lambda: User.objects.get(uuid=random.choice(users)[1]),
+            'active streams of user': lambda: list(
+                Stream.objects.filter(user_id=random.choice(users)[0], is_active=True)
+            ),
+            'online users': lambda: User.objects.filter(is_online=True).count(),
+        }
+
+        self.stdout.write(f'{"query":<24} {"p50 ms":>8} {"p95 ms":>8}')
+        for name, query in queries.items():
+            timings = []
+            for _ in range(options['iterations']):
+                started = time.perf_counter()
+                query()
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            p95 = timings[int(len(timings) * 0.95) - 1]
+            self.stdout.write(f'{name:<24} {statistics.median(timings):>8.3f} {p95:>8.3f}')
+
+    @transaction.atomic
+    def seed(self, chats, messages):
+        run = uuid.uuid4().hex[:6]
+        users = User.objects.bulk_create([
+            User(uuid=f'{PREFIX}{run}-{i}', username=f'user {i}', is_online=i % 50 == 0)
+            for i in range(chats // 5 + 2)
+        ], batch_size=1000)
+        users = list(User.objects.filter(uuid__startswith=f'{PREFIX}{run}-'))
+
+        Stream.objects.bulk_create([
+            Stream(user=user, is_active=i % 10 == 0) for i, user in enumerate(users)
+        ], batch_size=1000)
+
+        room_names = [uuid.uuid4().hex for _ in range(chats)]
+        Chat.objects.bulk_create([
+            Chat(name=f'{PREFIX}{run}', room_name=room, room_group_name=f'chat_{room}')
+            for room in room_names
+        ], batch_size=1000)
+        chat_ids = list(Chat.objects.filter(name=f'{PREFIX}{run}').values_list('id', flat=True))
+
+        Participant = Chat.participants.through
+        Participant.objects.bulk_create([
+            Participant(chat_id=chat_id, user_id=users[(i + offset) % len(users)].id)
+            for i, chat_id in enumerate(chat_ids) for offset in (0, 1)
+        ], batch_size=5000)
+
+        batch = []
+        for i, chat_id in enumerate(chat_ids):
+            for j in range(messages):
+                batch.append(Message(chat_id=chat_id, sender_id=users[(i + j % 2) % len(users)].id, content=f'message {j}'))
+            if len(batch) >= 10000:
+                Message.objects.bulk_create(batch, batch_size=5000)
+                batch = []
+        Message.objects.bulk_create(batch, batch_size=5000)
+        self.stdout.write(f'Seeded {len(chat_ids)} chats, {len(chat_ids) * messages} messages, {len(users)} users')
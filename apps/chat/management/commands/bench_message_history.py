@@ -0,0 +1,84 @@
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from apps.chat.history import get_message_page
+from apps.chat.message_cache import get_message_payloads
+from apps.chat.models import Chat, Message, User
+
+PREFIX = 'bench-history-'
+
+
+class Command(BaseCommand):
+    help = (
+        'Seeds one chat with a large history and compares keyset pages against '
+        'OFFSET pages at increasing depth (latency and query count per page).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000000)
+        parser.add_argument('--count', type=int, default=20, help='Messages per page')
+        parser.add_argument('--chat', type=int, help='Reuse a previously seeded chat id')
+        parser.add_argument('--cleanup', action='store_true', help='Delete the seeded rows and exit')
+
+    def handle(self, *args, **options):
+        if options['cleanup']:
+            Chat.objects.filter(name__startswith=PREFIX).delete()
+            User.objects.filter(uuid__startswith=PREFIX).delete()
+            return
+
+        if options['chat']:
+            chat = Chat.objects.get(id=options['chat'])
+        else:
+            chat = self.seed(options['messages'])
+        total = chat.messages.count()
+        count = options['count']
+
+        self.stdout.write(f'{"depth":>10} {"keyset ms":>10} {"queries":>8} {"offset ms":>10} {"queries":>8}')
+        for depth in sorted({0, total // 100, total // 10, total // 2, max(total - count, 0)}):
+            # Cursor of the message just above the wanted depth, as a client scrolling back would hold it
+            cursor = None
+            if depth:
+                anchor = chat.messages.order_by('-timestamp', '-id').values_list('timestamp', 'id')[depth - 1]
+                cursor = tuple(anchor)
+
+            keyset_ms, keyset_queries = self.measure(lambda: get_message_page(chat, before=cursor, count=count))
+            offset_ms, offset_queries = self.measure(
+                lambda: get_message_payloads(list(chat.messages.order_by('-timestamp', '-id')[depth:depth + count]))
+            )
+            self.stdout.write(
+                f'{depth:>10} {keyset_ms:>10.2f} {keyset_queries:>8} {offset_ms:>10.2f} {offset_queries:>8}'
+            )
+        self.stdout.write(f'Chat {chat.id} has {total} messages, rerun with --chat {chat.id} to skip seeding')
+
+    def measure(self, page):
+        # Second run, so both sides are measured with warm payload caches
+        page()
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            page()
+            elapsed = (time.perf_counter() - started) * 1000
+        return elapsed, len(queries.captured_queries)
+
+    @transaction.atomic
+    def seed(self, messages):
+        run = uuid.uuid4().hex[:6]
+        users = [
+            User.objects.create(uuid=f'{PREFIX}{run}-{i}', username=f'user {i}')
+            for i in range(2)
+        ]
+        room = uuid.uuid4().hex
+        chat = Chat.objects.create(name=f'{PREFIX}{run}', room_name=room, room_group_name=f'chat_{room}')
+        chat.participants.set(users)
+
+        batch = []
+        for i in range(messages):
+            batch.append(Message(chat=chat, sender=users[i % 2], content=f'message {i}'))
+            if len(batch) >= 10000:
+                Message.objects.bulk_create(batch, batch_size=5000)
+                batch = []
+        Message.objects.bulk_create(batch, batch_size=5000)
+        return chat
@@ -0,0 +1,77 @@
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from apps.chat.models import Poll, PollOption, PollVote, User
+
+
+def legacy_vote(poll, option, user):
+    # The pre-counter VotePollView write path
+    if poll.voters.filter(uuid=user.uuid).exists():
+        return
+    poll_vote = PollVote.objects.create(voter=user)
+    option.votes.add(poll_vote)
+    poll.voters.add(user)
+
+
+def counter_vote(poll, option, user):
+    try:
+        with transaction.atomic():
+            PollVote.objects.create(poll=poll, option=option, voter=user)
+            PollOption.objects.filter(id=option.id).update(vote_count=F('vote_count') + 1)
+            Poll.objects.filter(id=poll.id).update(vote_count=F('vote_count') + 1)
+    except IntegrityError:
+        pass
+
+
+def legacy_total(poll):
+    # The pre-counter Poll.total_votes_count
+    return sum(option.votes.count() for option in poll.options.all())
+
+
+class Command(BaseCommand):
+    help = 'Compares poll vote throughput of the legacy M2M path and the counter path'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--voters', type=int, default=500)
+        parser.add_argument('--options', type=int, default=4)
+
+    def handle(self, *args, **options):
+        run = uuid.uuid4().hex[:8]
+        User.objects.bulk_create([
+            User(uuid=f'bench-{run}-{i}', username=f'bench {i}') for i in range(options['voters'])
+        ])
+        users = list(User.objects.filter(uuid__startswith=f'bench-{run}-'))
+        try:
+            for name, vote, total in (
+                ('legacy', legacy_vote, legacy_total),
+                ('counters', counter_vote, lambda poll: Poll.objects.get(id=poll.id).total_votes_count()),
+            ):
+                poll, poll_options = self.make_poll(options['options'])
+                started = time.perf_counter()
+                for i, user in enumerate(users):
+                    vote(poll, poll_options[i % len(poll_options)], user)
+                elapsed = time.perf_counter() - started
+
+                started = time.perf_counter()
+                counted = total(poll)
+                read_elapsed = time.perf_counter() - started
+
+                self.stdout.write(
+                    f'{name:>8}: {len(users) / elapsed:8.0f} votes/s, '
+                    f'total={counted}, total count {read_elapsed * 1000:.1f} ms'
+                )
+                PollVote.objects.filter(voter__in=users).delete()
+                poll.delete()
+                PollOption.objects.filter(id__in=[o.id for o in poll_options]).delete()
+        finally:
+            User.objects.filter(uuid__startswith=f'bench-{run}-').delete()
+
+    def make_poll(self, count):
+        poll = Poll.objects.create(question='Benchmark poll')
+        poll_options = [PollOption.objects.create(option=f'Option {i}') for i in range(count)]
+        poll.options.add(*poll_options)
+        return poll, poll_options
@@ -0,0 +1,36 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.chat.history import iter_export_lines, parse_cursor
+from apps.chat.models import Chat
+
+
+class Command(BaseCommand):
+    help = 'Writes the full history of a chat as NDJSON (one message per line), for compliance exports and replays'
+
+    def add_arguments(self, parser):
+        parser.add_argument('room_name')
+        parser.add_argument('--output', '-o', help='File to write, stdout by default')
+        parser.add_argument('--after', help='Message cursor to resume from')
+        parser.add_argument('--chunk-size', type=int, help='Messages per query')
+
+    def handle(self, *args, **options):
+        chat_id = Chat.objects.filter(room_name=options['room_name']).values_list('id', flat=True).first()
+        if chat_id is None:
+            raise CommandError(f'Chat {options["room_name"]} not found')
+        try:
+            after = parse_cursor(options['after'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        output = open(options['output'], 'w') if options['output'] else sys.stdout
+        written = 0
+        try:
+            for line in iter_export_lines(chat_id, after, options['chunk_size']):
+                output.write(line)
+                written += 1
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        self.stderr.write(f'Exported {written} messages')
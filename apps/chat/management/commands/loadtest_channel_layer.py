@@ -0,0 +1,125 @@
+import asyncio
+import multiprocessing
+import time
+import uuid
+
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.core.management.base import BaseCommand, CommandError
+
+from core.channel_layers import ShardedRedisChannelLayer
+
+RECEIVE_TIMEOUT = 5
+
+
+def run_worker(groups, sockets, messages, ready, results):
+    # Runs in a spawned process, so it behaves like a separate ASGI worker
+    import django
+    django.setup()
+
+    async def main():
+        layer = get_channel_layer()
+        channels = []
+        for i in range(sockets):
+            channel = await layer.new_channel()
+            await layer.group_add(f'chat_loadtest_{i % groups}', channel)
+            channels.append(channel)
+        ready.put(True)
+
+        async def drain(channel):
+            received, finished = 0, time.perf_counter()
+            for _ in range(messages):
+                try:
+                    await asyncio.wait_for(layer.receive(channel), RECEIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    # Dropped over capacity, stop waiting for this socket
+                    break
+                received += 1
+                finished = time.perf_counter()
+            return received, finished
+
+        started = time.perf_counter()
+        drained = await asyncio.gather(*[drain(channel) for channel in channels])
+        elapsed = max(finished for _, finished in drained) - started
+
+        for i, channel in enumerate(channels):
+            await layer.group_discard(f'chat_loadtest_{i % groups}', channel)
+        results.put((sum(received for received, _ in drained), elapsed))
+
+    asyncio.run(main())
+
+
+class Command(BaseCommand):
+    help = 'Measures group_send fan-out throughput of the channel layer as ASGI workers scale'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', default='1,2,4', help='Comma separated worker counts to test')
+        parser.add_argument('--sockets', type=int, default=50, help='Subscribed sockets per worker')
+        parser.add_argument('--groups', type=int, default=10, help='Number of chat groups')
+        parser.add_argument('--messages', type=int, default=100, help='Messages sent to every group')
+        parser.add_argument(
+            '--placement', type=int, metavar='SHARDS',
+            help='Only report how chat_<uuid> groups spread over SHARDS nodes, and how many move to a new node; '
+                 'computed from the hash, no Redis needed',
+        )
+
+    def handle(self, *args, **options):
+        if options['placement']:
+            self.report_placement(options['placement'], options['groups'])
+            return
+        if isinstance(get_channel_layer(), InMemoryChannelLayer):
+            raise CommandError('The in-memory channel layer cannot span processes, set CHANNEL_REDIS_HOSTS.')
+
+        groups = options['groups']
+        messages = options['messages']
+        self.stdout.write('workers  sockets  sent  delivered  dropped  send_s  deliveries/s')
+
+        for workers in [int(w) for w in options['workers'].split(',')]:
+            ctx = multiprocessing.get_context('spawn')
+            ready, results = ctx.Queue(), ctx.Queue()
+            processes = [
+                ctx.Process(target=run_worker, args=(groups, options['sockets'], messages, ready, results))
+                for _ in range(workers)
+            ]
+            for process in processes:
+                process.start()
+            for _ in processes:
+                ready.get()
+
+            send_elapsed = asyncio.run(self.send_all(groups, messages))
+
+            delivered, elapsed = 0, 0.0
+            for _ in processes:
+                count, worker_elapsed = results.get()
+                delivered += count
+                elapsed = max(elapsed, worker_elapsed)
+            for process in processes:
+                process.join()
+
+            sockets = workers * options['sockets']
+            expected = sockets * messages
+            self.stdout.write(
+                f'{workers:>7}  {sockets:>7}  {groups * messages:>4}  {delivered:>9}  '
+                f'{expected - delivered:>7}  {send_elapsed:>6.2f}  {delivered / max(elapsed, 1e-9):>12.0f}'
+            )
+
+    def report_placement(self, shards, groups):
+        names = [f'chat_{uuid.uuid4()}' for _ in range(groups)]
+        layer = ShardedRedisChannelLayer(hosts=[f'redis://shard-{i}:6379' for i in range(shards)])
+        grown = ShardedRedisChannelLayer(hosts=[f'redis://shard-{i}:6379' for i in range(shards + 1)])
+        placed = [layer.consistent_hash(name) for name in names]
+        counts = [placed.count(shard) for shard in range(shards)]
+        moved = sum(1 for name, shard in zip(names, placed) if grown.consistent_hash(name) != shard)
+        self.stdout.write(f'{groups} groups over {shards} shards: {counts}')
+        self.stdout.write(
+            f'largest shard {max(counts) / (groups / shards):.3f}x the mean, '
+            f'{moved / groups:.1%} of the groups move when a shard is added (ideal {1 / (shards + 1):.1%})'
+        )
+
+    async def send_all(self, groups, messages):
+        layer = get_channel_layer()
+        payload = {'type': 'chat_message', 'message': {'content': 'x' * 256}}
+        started = time.perf_counter()
+        for _ in range(messages):
+            for group in range(groups):
+                await layer.group_send(f'chat_loadtest_{group}', payload)
+        return time.perf_counter() - started
@@ -0,0 +1,124 @@
+import asyncio
+import json
+import statistics
+import time
+import uuid
+
+import jwt
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.chat import db_executor
+from apps.chat.models import Chat, Stream, User
+from apps.chat.snapshots import chat_snapshots
+from core.payload_meter import payload_meter
+
+PREFIX = 'loadtest-db-'
+REPLY_TIMEOUT = 30
+
+# Client event -> frame type that completes it for the sending socket
+EVENTS = {
+    'user_connected': 'active_streams',
+    'user_joined_video_room': 'active_streams',
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Opens many ChatConsumer sockets in process and reports per-event latency '
+        'and the database executor queue wait vs. execution time. Compare runs '
+        'with CONSUMER_DB_WORKERS=0 (database_sync_to_async) and a sized pool. '
+        'Outbound frame sizes are reported per event type.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', type=int, default=1000)
+        parser.add_argument('--chats', type=int, default=100)
+        parser.add_argument('--rounds', type=int, default=3, help='Events sent by every socket')
+        parser.add_argument('--event', choices=sorted(EVENTS), default='user_connected')
+        parser.add_argument('--compact', action='store_true', help='Sockets opt in to chat diffs (?compact=1)')
+
+    def handle(self, *args, **options):
+        from core.asgi import application
+
+        run = uuid.uuid4().hex[:8]
+        rooms, users = self.seed(run, options['chats'], options['sockets'])
+        try:
+            latencies, elapsed = asyncio.run(self.run(
+                application, rooms, users, options['rounds'], options['event'], options['compact']
+            ))
+        finally:
+            Stream.objects.filter(user__uuid__startswith=f'{PREFIX}{run}').delete()
+            Chat.objects.filter(name=f'{PREFIX}{run}').delete()
+            User.objects.filter(uuid__startswith=f'{PREFIX}{run}').delete()
+
+        latencies.sort()
+        quantiles = statistics.quantiles(latencies, n=100)
+        self.stdout.write(
+            f'{options["sockets"]} sockets, {len(latencies)} {options["event"]} events in {elapsed:.2f}s '
+            f'({len(latencies) / elapsed:.0f}/s)'
+        )
+        self.stdout.write(
+            f'latency ms: p50 {quantiles[49] * 1000:.1f}  p95 {quantiles[94] * 1000:.1f}  '
+            f'p99 {quantiles[98] * 1000:.1f}  max {latencies[-1] * 1000:.1f}'
+        )
+        for event_type, sizes in sorted(payload_meter.metrics().items()):
+            self.stdout.write(
+                f'frames {event_type}: {sizes["frames"]} sent, avg {sizes["avg"]:.0f} / max {sizes["max"]} bytes, '
+                f'{sizes["over_budget"]} over budget'
+            )
+        snapshots = chat_snapshots.metrics()
+        self.stdout.write(
+            f'chat snapshots: {snapshots["full"]} full, {snapshots["diffs"]} diffs, {snapshots["bytes_saved"]} bytes saved'
+        )
+        if db_executor.executor is None:
+            self.stdout.write('executor: database_sync_to_async (CONSUMER_DB_WORKERS=0)')
+            return
+        metrics = db_executor.executor.metrics()
+        self.stdout.write(
+            f'executor: {metrics["workers"]} workers, {metrics["calls"]} calls, '
+            f'queue wait avg {metrics["wait_avg_ms"]:.1f} / max {metrics["wait_max_ms"]:.1f} ms, '
+            f'execution avg {metrics["exec_avg_ms"]:.1f} / max {metrics["exec_max_ms"]:.1f} ms'
+        )
+
+    def seed(self, run, chats, sockets):
+        users = User.objects.bulk_create([
+            User(uuid=f'{PREFIX}{run}-{i}', username=f'user {i}') for i in range(sockets)
+        ])
+        users = list(User.objects.filter(uuid__startswith=f'{PREFIX}{run}-'))
+        rooms = []
+        for i in range(chats):
+            room = str(uuid.uuid4())
+            chat = Chat.objects.create(name=f'{PREFIX}{run}', room_name=room, room_group_name=f'chat_{room}')
+            chat.participants.set(users[i::chats])
+            rooms.append(room)
+        return rooms, users
+
+    async def run(self, application, rooms, users, rounds, event, compact):
+        reply_type = EVENTS[event]
+        sockets = []
+        for i, user in enumerate(users):
+            token = jwt.encode({'user_id': user.uuid, 'token_type': 'access', 'exp': time.time() + 3600}, settings.SECRET_KEY, algorithm='HS256')
+            sockets.append(WebsocketCommunicator(application, f'/ws/chat/{rooms[i % len(rooms)]}/?token={token}{"&compact=1" if compact else ""}'))
+        await asyncio.gather(*[socket.connect() for socket in sockets])
+        if db_executor.executor is not None:
+            db_executor.executor.reset_metrics()
+        payload_meter.reset_metrics()
+
+        async def send(socket):
+            started = time.perf_counter()
+            await socket.send_to(text_data=json.dumps({'type': event}))
+            # Skip presence and other room traffic until this socket's own reply
+            while json.loads(await socket.receive_from(REPLY_TIMEOUT))['type'] != reply_type:
+                pass
+            return time.perf_counter() - started
+
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(rounds):
+            latencies.extend(await asyncio.gather(*[send(socket) for socket in sockets]))
+        elapsed = time.perf_counter() - started
+
+        await asyncio.gather(*[socket.disconnect() for socket in sockets])
+        return latencies, elapsed
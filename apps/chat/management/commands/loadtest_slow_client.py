@@ -0,0 +1,167 @@
+import asyncio
+import json
+import time
+import uuid
+
+import jwt
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.chat.history import encode_cursor, get_message_page, parse_cursor
+from apps.chat.message_cache import get_message_payloads
+from apps.chat.models import Chat, Message, User
+from core.outbound import SLOW_CONSUMER_CLOSE_CODE, outbound_metrics
+
+PREFIX = 'loadtest-slow-'
+RECEIVE_TIMEOUT = 30
+
+
+def slow_application(application, delay):
+    # A client reading `delay` seconds per frame: the server's send blocks that long
+    async def app(scope, receive, send):
+        async def slow_send(message):
+            if message['type'] == 'websocket.send':
+                await asyncio.sleep(delay)
+            await send(message)
+        return await application(scope, receive, slow_send)
+    return app
+
+
+class Command(BaseCommand):
+    help = (
+        'Sends a burst of chat messages, presence diffs and poll counts to a room '
+        'with one slow and one normal ChatConsumer socket, and reports what the '
+        'slow one got: coalesced and dropped events, the slow consumer disconnect '
+        'and the messages replayed when it reconnects with its resume token.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000)
+        parser.add_argument('--delay', type=float, default=0.005, help='Seconds the slow client takes per frame')
+        parser.add_argument('--interval', type=float, default=0.0005, help='Seconds between chat messages')
+        parser.add_argument('--state-every', type=int, default=5, help='A presence diff and poll count every N messages')
+
+    def handle(self, *args, **options):
+        from core.asgi import application
+
+        run = uuid.uuid4().hex[:8]
+        users = [User.objects.create(uuid=f'{PREFIX}{run}-{i}', username=f'user {i}') for i in range(2)]
+        room = str(uuid.uuid4())
+        chat = Chat.objects.create(name=f'{PREFIX}{run}', room_name=room, room_group_name=f'chat_{room}')
+        chat.participants.set(users)
+        try:
+            messages = Message.objects.bulk_create([
+                Message(chat=chat, sender=users[0], content=f'message {i}') for i in range(options['messages'])
+            ])
+            messages = list(chat.messages.order_by('timestamp', 'id'))
+            events = [
+                {'type': 'chat_message', 'payload': payload, 'cursor': encode_cursor(message)}
+                for message, payload in zip(messages, get_message_payloads(messages))
+            ]
+            outbound_metrics.reset_metrics()
+            report = asyncio.run(self.run(application, room, users, events, options))
+            # Past the first page the client follows newer_cursor over the history endpoint
+            cursor = report['newer_cursor']
+            while cursor is not None:
+                page = get_message_page(chat, after=parse_cursor(cursor), count=settings.MESSAGE_MAX_PAGE_SIZE)
+                report['replayed'].update(json.loads(payload)['id'] for payload in page['results'])
+                cursor = page['newer_cursor']
+        finally:
+            Chat.objects.filter(name=f'{PREFIX}{run}').delete()
+            User.objects.filter(uuid__startswith=f'{PREFIX}{run}').delete()
+
+        sent = {message.id for message in messages}
+        received, replayed = report['received'], report['replayed']
+        self.stdout.write(
+            f'{len(sent)} messages sent in {report["elapsed"]:.2f}s, normal socket got {report["normal"]}, '
+            f'slow socket got {len(received)} before {report["closed"]}'
+        )
+        self.stdout.write(f'slow socket frames: {report["frames"]}')
+        if report['resumed']:
+            missing = sent - received - replayed
+            self.stdout.write(f'resume replayed {len(replayed)} messages, {len(missing)} missing after replay')
+        metrics = outbound_metrics.metrics()
+        self.stdout.write(
+            f'outbound: max depth {metrics["max_depth"]}, {metrics["slow_disconnects"]} slow disconnects, '
+            f'{metrics["layer_dropped"]} dropped by the channel layer'
+        )
+        for event_type, stats in sorted(metrics['events'].items()):
+            self.stdout.write(
+                f'  {event_type}: {stats["queued"]} queued, {stats["sent"]} sent, '
+                f'{stats["coalesced"]} coalesced, {stats["dropped"]} dropped'
+            )
+
+    def path(self, room, user):
+        token = jwt.encode({'user_id': user.uuid, 'token_type': 'access', 'exp': time.time() + 3600}, settings.SECRET_KEY, algorithm='HS256')
+        return f'/ws/chat/{room}/?token={token}'
+
+    async def run(self, application, room, users, events, options):
+        slow = WebsocketCommunicator(slow_application(application, options['delay']), self.path(room, users[1]))
+        normal = WebsocketCommunicator(application, self.path(room, users[0]))
+        await slow.connect()
+        await normal.connect()
+
+        channel_layer = get_channel_layer()
+        started = time.perf_counter()
+        for i, event in enumerate(events):
+            await channel_layer.group_send(f'chat_{room}', event)
+            if i % options['state_every'] == 0:
+                online = [users[i // options['state_every'] % 2].uuid]
+                await channel_layer.group_send(f'chat_{room}', {
+                    'type': 'presence_diff', 'online': online, 'offline': [], 'joined_call': [], 'left_call': [],
+                })
+                await channel_layer.group_send(f'chat_{room}', {
+                    'type': 'poll_counts', 'poll_id': 1, 'total_votes_count': i, 'options': [],
+                })
+            await asyncio.sleep(options['interval'])
+        elapsed = time.perf_counter() - started
+
+        normal_count = 0
+        while normal_count < len(events):
+            if json.loads(await normal.receive_from(RECEIVE_TIMEOUT))['type'] == 'chat_message':
+                normal_count += 1
+
+        received, frames, token, closed = set(), {}, None, 'the burst ended'
+        while True:
+            output = await slow.receive_output(RECEIVE_TIMEOUT)
+            if output['type'] == 'websocket.close':
+                closed = f'close code {output.get("code")}'
+                break
+            data = json.loads(output['text'])
+            frames[data['type']] = frames.get(data['type'], 0) + 1
+            if data['type'] == 'chat_message':
+                received.add(data['message']['id'])
+                if len(received) == len(events):
+                    break
+            elif data['type'] == 'slow_consumer':
+                token = data.get('resume_token')
+
+        resumed, replayed, newer_cursor = False, set(), None
+        if token is not None and closed == f'close code {SLOW_CONSUMER_CLOSE_CODE}':
+            await slow.wait()
+            again = WebsocketCommunicator(application, f'{self.path(room, users[1])}&resume={token}')
+            await again.connect()
+            while True:
+                data = json.loads(await again.receive_from(RECEIVE_TIMEOUT))
+                if data['type'] == 'resumed':
+                    replayed = {message['id'] for message in data['messages']}
+                    resumed, newer_cursor = True, data['newer_cursor']
+                    break
+                if data['type'] == 'resume_expired':
+                    break
+            await again.disconnect()
+        else:
+            await slow.disconnect()
+        await normal.disconnect()
+        return {
+            'elapsed': elapsed,
+            'normal': normal_count,
+            'received': received,
+            'frames': frames,
+            'closed': closed,
+            'resumed': resumed,
+            'replayed': replayed,
+            'newer_cursor': newer_cursor,
+        }
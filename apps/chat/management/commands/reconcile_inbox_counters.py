@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Exists, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from apps.chat.models import Chat, ChatReadState, Message, User
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the per-user inbox totals and read states from chat membership and messages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--unread', action='store_true', help='Also recount unread messages from the read watermarks')
+
+    def handle(self, *args, **options):
+        Participant = Chat.participants.through
+
+        # Read states follow membership: one per participant, none for anyone else
+        missing = Participant.objects.filter(
+            ~Exists(ChatReadState.objects.filter(chat_id=OuterRef('chat_id'), user_id=OuterRef('user_id')))
+        ).values_list('chat_id', 'user_id')
+        created = len(ChatReadState.objects.bulk_create(
+            [ChatReadState(chat_id=chat_id, user_id=user_id) for chat_id, user_id in missing.iterator()],
+            batch_size=500,
+            ignore_conflicts=True,
+        ))
+        deleted, _ = ChatReadState.objects.filter(
+            ~Exists(Participant.objects.filter(chat_id=OuterRef('chat_id'), user_id=OuterRef('user_id')))
+        ).delete()
+
+        totals_fixed = self.recount(User.objects.annotate(counted=Count('chats')), 'inbox_count')
+
+        unread_fixed = 0
+        if options['unread']:
+            # Messages of the others after the user's watermark, the whole chat without one
+            unread = (
+                Message.objects.filter(chat_id=OuterRef('chat_id'), id__gt=Coalesce(OuterRef('last_read_message_id'), 0))
+                .exclude(sender_id=OuterRef('user_id'))
+                .order_by().values('chat_id').annotate(total=Count('id')).values('total')
+            )
+            unread_fixed = self.recount(
+                ChatReadState.objects.annotate(counted=Coalesce(Subquery(unread), 0)), 'unread_count'
+            )
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {created} and deleted {deleted} read states, '
+            f'fixed {totals_fixed} inbox totals and {unread_fixed} unread counters'
+        ))
+
+    def recount(self, queryset, field):
+        stale = []
+        for obj in queryset.iterator():
+            if getattr(obj, field) != obj.counted:
+                setattr(obj, field, obj.counted)
+                stale.append(obj)
+        queryset.model.objects.bulk_update(stale, [field], batch_size=500)
+        return len(stale)
@@ -0,0 +1,45 @@
+import os
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from apps.chat.models import File, Message
+from apps.chat.uploads import staged_path, upload
+
+
+class Command(BaseCommand):
+    help = 'Retries attachment uploads left pending or failed by a crashed or restarted worker'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=10, help='Minutes, skips uploads that may still be running')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(minutes=options['older_than'])
+        retried, lost = 0, 0
+
+        files = File.objects.filter(status__in=('pending', 'failed'), created_at__lt=cutoff).select_related('message__chat')
+        for file_obj in files.iterator():
+            if self.retry('file', file_obj.id, file_obj.message, file_obj.file.name):
+                retried += 1
+            else:
+                File.objects.filter(id=file_obj.id).update(status='failed')
+                lost += 1
+
+        messages = Message.objects.filter(
+            voice_message_status__in=('pending', 'failed'), created_at__lt=cutoff
+        ).select_related('chat')
+        for message in messages.iterator():
+            if self.retry('voice_message', message.id, message, message.voice_message.name):
+                retried += 1
+            else:
+                Message.objects.filter(id=message.id).update(voice_message_status='failed')
+                lost += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Retried {retried} uploads, {lost} without a staged copy'))
+
+    def retry(self, kind, object_id, message, key):
+        if not os.path.exists(staged_path(key)):
+            return False
+        upload(kind, object_id, message.id, key, f'chat_{message.chat.room_name}')
+        return True
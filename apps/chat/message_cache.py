@@ -0,0 +1,95 @@
+import json
+
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Prefetch
+
+from .models import ChatReadState, Message, PollVote
+from .serializers import MessagePayloadSerializer
+
+# Bump when MessagePayloadSerializer output changes so old payloads are never served
+PAYLOAD_FORMAT = 4
+PAYLOAD_TIMEOUT = 60 * 60 * 24
+
+
+def payload_queryset():
+    # Everything MessageSerializer touches, in a fixed number of queries per batch
+    return Message.objects.select_related('sender', 'gif', 'public_key', 'poll').prefetch_related(
+        'files',
+        'poll__options',
+        Prefetch('poll__ballots', queryset=PollVote.objects.select_related('voter')),
+    )
+
+
+def _version_key(message_id):
+    return f'chat:message:{message_id}:version'
+
+
+def _payload_key(message_id, version):
+    return f'chat:message:{message_id}:payload:{PAYLOAD_FORMAT}.{version}'
+
+
+def read_states_for(chat_ids):
+    # {chat id: [(last read message id, user)]}, what MessageSerializer derives read_by from in exports
+    read_states = {}
+    states = ChatReadState.objects.filter(chat_id__in=chat_ids, last_read_message__isnull=False).select_related('user')
+    for state in states:
+        read_states.setdefault(state.chat_id, []).append((state.last_read_message_id, state.user))
+    return read_states
+
+
+def get_message_payloads(messages):
+    """
+    Returns the serialized JSON of each message, in order. Payloads are built
+    once per (message id, version) and shared by every consumer and page;
+    they carry no read_by, so reads never invalidate them.
+    """
+    if not messages:
+        return []
+
+    version_keys = [_version_key(message.id) for message in messages]
+    versions = cache.get_many(version_keys)
+    payload_keys = [
+        _payload_key(message.id, versions.get(version_key, 0))
+        for message, version_key in zip(messages, version_keys)
+    ]
+    payloads = cache.get_many(payload_keys)
+
+    missing = [
+        (message, key) for message, key in zip(messages, payload_keys)
+        if key not in payloads
+    ]
+    if missing:
+        # Rebuild the misses from one batched load instead of lazy per-message relations
+        loaded = payload_queryset().in_bulk([message.id for message, _ in missing])
+        data = MessagePayloadSerializer([loaded.get(message.id, message) for message, _ in missing], many=True).data
+        built = {
+            key: json.dumps(item, cls=DjangoJSONEncoder)
+            for (_, key), item in zip(missing, data)
+        }
+        cache.set_many(built, PAYLOAD_TIMEOUT)
+        payloads.update(built)
+
+    return [payloads[key] for key in payload_keys]
+
+
+def get_message_payload(message):
+    return get_message_payloads([message])[0]
+
+
+def invalidate_message_payload(message_id):
+    # After commit: a reader seeing the new version earlier could rebuild it
+    # from the pre-commit row and cache that under the new version
+    transaction.on_commit(lambda: _bump(_version_key(message_id)))
+
+
+def _bump(key):
+    # A new version makes readers miss and rebuild, stale payloads just expire.
+    # The version key never expires, otherwise it could fall back onto a
+    # payload that is still cached under an old version.
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, None):
+            cache.incr(key)
@@ -0,0 +1,33 @@
+# Generated by Django 3.2.16 on 2026-10-18 10:37
+
+from django.db import migrations, models
+from django.db.models import Max
+from django.db.models.functions import Coalesce
+import django.utils.timezone
+
+
+def backfill_last_activity(apps, schema_editor):
+    Chat = apps.get_model('chat', 'Chat')
+    chats = Chat.objects.annotate(latest=Coalesce(Max('messages__timestamp'), 'created_at'))
+    for chat in chats.iterator():
+        Chat.objects.filter(id=chat.id).update(last_activity=chat.latest)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_breakoutroom'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='last_activity',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(backfill_last_activity, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(fields=['-last_activity', '-id'], name='chat_last_activity_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.2.16 on 2026-10-18 10:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_chat_last_activity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='poll',
+            name='vote_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='polloption',
+            name='vote_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='pollvote',
+            name='option',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='ballots', to='chat.polloption'),
+        ),
+        migrations.AddField(
+            model_name='pollvote',
+            name='poll',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='ballots', to='chat.poll'),
+        ),
+        migrations.AddConstraint(
+            model_name='pollvote',
+            constraint=models.UniqueConstraint(fields=('poll', 'voter'), name='unique_poll_voter'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 3.2.16 on 2026-10-18 10:45
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def check_room_names(apps, schema_editor):
+    # room_name becomes unique below. Blank names can't be joined by anyone and
+    # become NULL, a name shared by two chats can't be fixed without knowing
+    # which room its clients mean, so the migration stops and lists them.
+    Chat = apps.get_model('chat', 'Chat')
+    Chat.objects.filter(room_name='').update(room_name=None)
+    duplicates = list(
+        Chat.objects.exclude(room_name=None).values('room_name')
+        .annotate(chats=Count('id')).filter(chats__gt=1).values_list('room_name', flat=True)[:20]
+    )
+    if duplicates:
+        raise RuntimeError(
+            'Chat.room_name is becoming unique but these names are used by more than one chat, '
+            'rename or merge them and migrate again: %s' % ', '.join(duplicates)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_poll_vote_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_room_names, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='chat',
+            name='room_name',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='is_online',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddIndex(
+            model_name='stream',
+            index=models.Index(fields=['user', 'is_active'], name='stream_user_active_idx'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 3.2.16 on 2026-10-18 11:02
+
+import hashlib
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_pair_key(apps, schema_editor):
+    # Existing one-to-one conversations; when a pair has several, the oldest keeps the key
+    Chat = apps.get_model('chat', 'Chat')
+    chat_ids = (
+        Chat.objects.filter(name='conversation')
+        .annotate(participant_count=Count('participants'))
+        .filter(participant_count=2)
+        .values('id')
+    )
+    participants = {}
+    rows = Chat.participants.through.objects.filter(chat_id__in=chat_ids).values_list('chat_id', 'user__uuid')
+    for chat_id, uuid in rows.iterator():
+        participants.setdefault(chat_id, []).append(uuid)
+
+    seen = set()
+    for chat_id in sorted(participants):
+        key = hashlib.sha256('\n'.join(sorted(participants[chat_id])).encode()).hexdigest()
+        if key in seen:
+            continue
+        seen.add(key)
+        Chat.objects.filter(id=chat_id).update(pair_key=key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_upload_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='pair_key',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+        migrations.RunPython(backfill_pair_key, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 3.2.16 on 2026-10-18 11:05
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+def backfill_counters(apps, schema_editor):
+    # Reads were never tracked, existing chats start with nothing unread
+    User = apps.get_model('chat', 'User')
+    Chat = apps.get_model('chat', 'Chat')
+    ChatReadState = apps.get_model('chat', 'ChatReadState')
+    Participant = Chat.participants.through
+
+    rows = Participant.objects.values_list('chat_id', 'user_id')
+    batch = []
+    for chat_id, user_id in rows.iterator():
+        batch.append(ChatReadState(chat_id=chat_id, user_id=user_id))
+        if len(batch) >= 1000:
+            ChatReadState.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    ChatReadState.objects.bulk_create(batch, ignore_conflicts=True)
+
+    chat_counts = (
+        Participant.objects.filter(user_id=OuterRef('pk'))
+        .order_by().values('user_id').annotate(total=Count('id')).values('total')
+    )
+    User.objects.update(inbox_count=Coalesce(Subquery(chat_counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_chat_pair_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='inbox_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='ChatReadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='chat.chat')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='chat.user')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='chatreadstate',
+            constraint=models.UniqueConstraint(fields=('user', 'chat'), name='unique_chat_read_state'),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
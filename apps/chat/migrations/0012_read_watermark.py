@@ -0,0 +1,37 @@
+# Generated by Django 3.2.16 on 2026-10-18 11:07
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+
+def backfill_watermarks(apps, schema_editor):
+    # Place each watermark so that exactly unread_count messages of the others lie after it
+    Message = apps.get_model('chat', 'Message')
+    ChatReadState = apps.get_model('chat', 'ChatReadState')
+
+    latest = Message.objects.filter(chat_id=OuterRef('chat_id')).order_by('-id').values('id')[:1]
+    ChatReadState.objects.filter(unread_count=0).update(last_read_message_id=Subquery(latest))
+
+    for state in ChatReadState.objects.filter(unread_count__gt=0).iterator():
+        watermark = (
+            Message.objects.filter(chat_id=state.chat_id).exclude(sender_id=state.user_id)
+            .order_by('-id').values_list('id', flat=True)[state.unread_count:state.unread_count + 1]
+        )
+        ChatReadState.objects.filter(id=state.id).update(last_read_message_id=next(iter(watermark), None))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_chat_read_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatreadstate',
+            name='last_read_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message'),
+        ),
+        migrations.RunPython(backfill_watermarks, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+from django.db import IntegrityError, migrations, transaction
+from django.db.models import Count
+
+
+def backfill_poll_votes(apps, schema_editor):
+    # Votes cast before 0006 only hang off PollOption.votes, with poll NULL the
+    # (poll, voter) constraint can't see them: link them and recount
+    Poll = apps.get_model('chat', 'Poll')
+    PollOption = apps.get_model('chat', 'PollOption')
+    PollVote = apps.get_model('chat', 'PollVote')
+
+    legacy_options = PollOption.objects.filter(votes__option__isnull=True).distinct().prefetch_related('poll_options')
+    for option in legacy_options.iterator():
+        poll = next(iter(option.poll_options.all()), None)
+        for vote_id in option.votes.filter(option__isnull=True).values_list('id', flat=True):
+            try:
+                with transaction.atomic():
+                    PollVote.objects.filter(id=vote_id).update(poll=poll, option=option)
+            except IntegrityError:
+                # The voter already has a ballot in this poll
+                pass
+
+    for model in (PollOption, Poll):
+        stale = []
+        for obj in model.objects.annotate(counted=Count('ballots')).iterator():
+            if obj.vote_count != obj.counted:
+                obj.vote_count = obj.counted
+                stale.append(obj)
+        model.objects.bulk_update(stale, ['vote_count'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0012_read_watermark'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_poll_votes, migrations.RunPython.noop),
+    ]
@@ -1,11 +1,22 @@
 from django.db import models
+from django.utils import timezone
+
+# Attachments are written to storage in the background, see apps/chat/uploads.py
+upload_status_choices = (
+    ('pending', 'Pending'),
+    ('ready', 'Ready'),
+    ('failed', 'Failed'),
+)
+
 
 class User(models.Model):
     uuid = models.CharField(max_length=256, unique=True)
     username = models.CharField(max_length=256, blank=True, null=True)
-    is_online = models.BooleanField(default=False)
+    is_online = models.BooleanField(default=False, db_index=True)
     is_in_call = models.BooleanField(default=False)
     is_chatbot = models.BooleanField(default=False)
+    # Denormalized number of chats the user takes part in, see apps/chat/counters.py
+    inbox_count = models.PositiveIntegerField(default=0)
     # add any other user-related fields as needed
 
 
@@ -14,21 +25,51 @@ class Stream(models.Model):
     is_active = models.BooleanField(default=True)
     # add any other stream-related fields as needed
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'is_active'], name='stream_user_active_idx'),
+        ]
+
 
 class Chat(models.Model):
     name = models.CharField(max_length=256)
     participants = models.ManyToManyField(User, related_name='chats')
-    room_name = models.CharField(max_length=255, blank=True, null=True)
+    room_name = models.CharField(max_length=255, blank=True, null=True, unique=True)
     room_group_name = models.CharField(max_length=255, blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     connected_users = models.ManyToManyField(User, blank=True, related_name='connected_chats')
     stream = models.ManyToManyField(Stream)
+    last_activity = models.DateTimeField(default=timezone.now)
+    # sha256 of the two participants for one-to-one chats, see apps/chat/conversations.py
+    pair_key = models.CharField(max_length=64, unique=True, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-last_activity', '-id'], name='chat_last_activity_idx'),
+        ]
 
     def get_last_message(self):
+        # Inbox querysets annotate the last message, avoid one query per chat
+        if hasattr(self, 'last_message_content'):
+            return self.last_message_content
         last_message = self.messages.order_by('-timestamp').first()
         return last_message.content if last_message else None
 
 
+class ChatReadState(models.Model):
+    # One row per participant, counters are maintained by apps/chat/counters.py
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_states')
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='read_states')
+    unread_count = models.PositiveIntegerField(default=0)
+    # Read watermark: every message of the chat up to this one is read by the user
+    last_read_message = models.ForeignKey('Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'chat'], name='unique_chat_read_state'),
+        ]
+
+
 class BreakoutRoom(models.Model):
     name = models.CharField(max_length=256)
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='breakout_rooms')
@@ -44,25 +85,32 @@ class Poll(models.Model):
     question = models.CharField(max_length=255)
     options = models.ManyToManyField('PollOption', related_name='poll_options')
     voters = models.ManyToManyField(User, related_name='poll_voters')
+    # Denormalized counter, incremented with F() expressions on every vote
+    vote_count = models.PositiveIntegerField(default=0)
 
     def total_votes_count(self):
-        total_votes = 0
-        for option in self.options.all():
-            total_votes += option.votes.count()
-        return total_votes
+        return self.vote_count
 
 class PollOption(models.Model):
     option = models.CharField(max_length=255)
     votes = models.ManyToManyField('PollVote', related_name='votes')
+    vote_count = models.PositiveIntegerField(default=0)
 
     def votes_count(self):
-        return self.votes.count()
+        return self.vote_count
 
 class PollVote(models.Model):
     voter = models.ForeignKey(User, related_name='poll_votes', on_delete=models.CASCADE)
+    poll = models.ForeignKey(Poll, related_name='ballots', on_delete=models.CASCADE, null=True, blank=True)
+    option = models.ForeignKey(PollOption, related_name='ballots', on_delete=models.CASCADE, null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['poll', 'voter'], name='unique_poll_voter'),
+        ]
 
     def __str__(self):
-        return f'{self.voter} voted for {self.poll_option}'
+        return f'{self.voter} voted for {self.option}'
 
 
 class GIF(models.Model):
@@ -106,6 +154,12 @@ class Message(models.Model):
     type = models.CharField(max_length=10, choices=[('text', 'Text'), ('image', 'Image'), ('video', 'Video'), ('audio', 'Audio')], default='text')
     encryption = models.CharField(max_length=30, choices=encryption_choices, default='none')
     created_at = models.DateTimeField(auto_now_add=True)
+    voice_message_status = models.CharField(max_length=10, choices=upload_status_choices, default='ready')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['chat', 'timestamp', 'id'], name='message_chat_keyset_idx'),
+        ]
 
 
 class File(models.Model):
@@ -115,6 +169,7 @@ class File(models.Model):
     mime_type = models.CharField(max_length=255)
     file = models.FileField(upload_to='message_sent_files/')
     created_at = models.DateTimeField(auto_now_add=True)
+    status = models.CharField(max_length=10, choices=upload_status_choices, default='ready')
 
     def __str__(self):
         return self.name
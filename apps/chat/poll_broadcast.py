@@ -0,0 +1,80 @@
+import heapq
+import threading
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+
+from .models import Poll, PollOption
+
+
+def send_poll_counts(poll_id, group_name):
+    """
+    Sends one compact `poll_counts` event instead of the whole message per
+    vote. Counts are read back from the counter columns, so the latest event
+    always carries the latest totals; sockets that fall behind only keep that
+    one (ChatConsumer's Coalesce('poll_id') outbound policy).
+    """
+    total = Poll.objects.filter(id=poll_id).values_list('vote_count', flat=True).first() or 0
+    options = [
+        {'id': option_id, 'votes_count': count}
+        for option_id, count in PollOption.objects.filter(poll_options=poll_id).values_list('id', 'vote_count')
+    ]
+    async_to_sync(get_channel_layer().group_send)(group_name, {
+        'type': 'poll_counts',
+        'poll_id': poll_id,
+        'total_votes_count': total,
+        'options': options,
+    })
+
+
+class PollCountsFlusher:
+    """
+    Sends the pending `poll_counts` events when their window is over, from one
+    daemon thread started on first use. Polls waiting for a flush sit in a heap
+    ordered by due time.
+    """
+
+    def __init__(self):
+        self._due = []
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def schedule(self, poll_id, group_name, delay):
+        with self._condition:
+            heapq.heappush(self._due, (time.monotonic() + delay, poll_id, group_name))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name='poll-counts', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._due or self._due[0][0] > time.monotonic():
+                    self._condition.wait(self._due[0][0] - time.monotonic() if self._due else None)
+                _, poll_id, group_name = heapq.heappop(self._due)
+            try:
+                send_poll_counts(poll_id, group_name)
+            except Exception as e:
+                print(f"Poll counts flush failed for poll {poll_id}: {e}")
+            finally:
+                close_old_connections()
+
+
+poll_counts_flusher = PollCountsFlusher()
+
+
+def schedule_poll_counts(poll_id, group_name):
+    # Called after the vote committed. The first vote of a window takes the
+    # flush key (SET NX PX, so across workers) and schedules the flush for when
+    # the key expires; later votes in the window committed before that and are
+    # read back by the same flush.
+    window = settings.POLL_VOTE_BROADCAST_WINDOW
+    if window <= 0:
+        send_poll_counts(poll_id, group_name)
+    elif cache.add(f'poll-counts-flush:{poll_id}', 1, window):
+        poll_counts_flusher.schedule(poll_id, group_name, window)
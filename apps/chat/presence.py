@@ -0,0 +1,276 @@
+import asyncio
+import os
+import socket
+import time
+import uuid
+
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from redis.exceptions import RedisError
+
+from .models import User
+
+
+class InMemoryPresenceStore:
+    # Online / in-call members per room with an expiry timestamp, one process only
+
+    def __init__(self):
+        self.rooms = {}
+
+    def touch(self, room, kind, user_ids, expires_at):
+        members = self.rooms.setdefault((room, kind), {})
+        for user_id in user_ids:
+            members[user_id] = expires_at
+
+    def remove(self, room, kind, user_id):
+        # True when no worker holds the user anymore, always the case with one process
+        members = self.rooms.get((room, kind), {})
+        members.pop(user_id, None)
+        if not members:
+            self.rooms.pop((room, kind), None)
+        return True
+
+    def members(self, room, kind, now):
+        members = self.rooms.get((room, kind), {})
+        return {user_id for user_id, expires_at in members.items() if expires_at > now}
+
+    def expire(self, room, kind, now):
+        members = self.rooms.get((room, kind), {})
+        expired = [user_id for user_id, expires_at in members.items() if expires_at <= now]
+        for user_id in expired:
+            del members[user_id]
+        return expired
+
+
+class RedisPresenceStore:
+    """
+    Same structure kept in sorted sets (score = expiry) so every worker sees
+    it. Members are "<user_id>|<worker>": a user connected on two workers is
+    held twice, and only goes offline once neither holds them.
+    """
+
+    def __init__(self):
+        from django_redis import get_redis_connection
+        self.redis = get_redis_connection('default')
+        self.worker = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+    def key(self, room, kind):
+        return f'presence:{room}:{kind}'
+
+    def member(self, user_id):
+        return f'{user_id}|{self.worker}'
+
+    def users(self, members):
+        return {member.decode().rsplit('|', 1)[0] for member in members}
+
+    def touch(self, room, kind, user_ids, expires_at):
+        if user_ids:
+            key = self.key(room, kind)
+            pipe = self.redis.pipeline()
+            pipe.zadd(key, {self.member(user_id): expires_at for user_id in user_ids})
+            pipe.expire(key, int(settings.PRESENCE_TTL * 2))
+            pipe.execute()
+
+    def remove(self, room, kind, user_id):
+        # Removal and the read run in one MULTI, so of two workers dropping
+        # the same user at once the last one always sees nobody left
+        pipe = self.redis.pipeline()
+        pipe.zrem(self.key(room, kind), self.member(user_id))
+        pipe.zrangebyscore(self.key(room, kind), time.time(), '+inf')
+        _, live = pipe.execute()
+        return user_id not in self.users(live)
+
+    def members(self, room, kind, now):
+        return self.users(self.redis.zrangebyscore(self.key(room, kind), now, '+inf'))
+
+    def expire(self, room, kind, now):
+        # Users whose every member ran out, e.g. all their sockets were on a dead worker
+        key = self.key(room, kind)
+        pipe = self.redis.pipeline()
+        pipe.zrangebyscore(key, '-inf', now)
+        pipe.zremrangebyscore(key, '-inf', now)
+        pipe.zrangebyscore(key, now, '+inf')
+        expired, _, live = pipe.execute()
+        return list(self.users(expired) - self.users(live))
+
+
+def merge_diffs(previous, data):
+    # One presence_diff with the effect of applying previous then data, for sockets that fell behind
+    merged = dict(data)
+    for added, removed in (('online', 'offline'), ('joined_call', 'left_call')):
+        merged[added] = sorted((set(previous[added]) - set(data[removed])) | set(data[added]))
+        merged[removed] = sorted((set(previous[removed]) - set(data[added])) | set(data[removed]))
+    return merged
+
+
+class PresenceService:
+    """
+    Keeps online / in-call state per room and publishes it as batched
+    `presence_diff` events once per tick instead of full participant lists.
+    Sockets of this process are heartbeated by the tick loop, members of a
+    dead worker fall out once their TTL runs out. User.is_online and
+    User.is_in_call are only written every PRESENCE_PERSIST_INTERVAL.
+    Store errors never fail a socket: they are counted, this worker's
+    members are re-added by the next heartbeat and stale ones expire.
+    """
+
+    ONLINE = 'online'
+    IN_CALL = 'call'
+
+    def __init__(self, store):
+        self.store = store
+        # room -> {user_id: open sockets in this process}
+        self.local = {}
+        self.local_calls = {}
+        self.groups = {}
+        # room -> {kind: {user_id: True (joined) / False (left)}}
+        self.diffs = {}
+        # user_id -> {field: value} waiting to be persisted
+        self.dirty = {}
+        self.errors = 0
+        self._task = None
+        self._last_heartbeat = 0
+        self._last_persist = time.monotonic()
+
+    def ensure_started(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self.run())
+
+    async def call_store(self, method, *args):
+        try:
+            return await sync_to_async(method, thread_sensitive=False)(*args)
+        except RedisError as e:
+            self.errors += 1
+            print(f'Presence store error: {e}')
+            return None
+
+    def mark(self, room, kind, user_id, joined):
+        self.diffs.setdefault(room, {}).setdefault(kind, {})[user_id] = joined
+        field = 'is_online' if kind == self.ONLINE else 'is_in_call'
+        self.dirty.setdefault(user_id, {})[field] = joined
+
+    async def connect(self, room, group_name, user_id):
+        self.ensure_started()
+        self.groups[room] = group_name
+        sockets = self.local.setdefault(room, {})
+        sockets[user_id] = sockets.get(user_id, 0) + 1
+        if sockets[user_id] == 1:
+            await self.call_store(self.store.touch, room, self.ONLINE, [user_id], time.time() + settings.PRESENCE_TTL)
+            self.mark(room, self.ONLINE, user_id, True)
+
+    async def disconnect(self, room, user_id):
+        sockets = self.local.get(room, {})
+        if user_id not in sockets:
+            return
+        sockets[user_id] -= 1
+        if sockets[user_id] > 0:
+            return
+        del sockets[user_id]
+        if not sockets:
+            del self.local[room]
+        if user_id in self.local_calls.get(room, set()):
+            await self.leave_call(room, user_id)
+        # Still online through another worker: no offline diff. On a store
+        # error the member is left to expire, which reports it then.
+        if await self.call_store(self.store.remove, room, self.ONLINE, user_id):
+            self.mark(room, self.ONLINE, user_id, False)
+
+    async def join_call(self, room, user_id):
+        self.local_calls.setdefault(room, set()).add(user_id)
+        await self.call_store(self.store.touch, room, self.IN_CALL, [user_id], time.time() + settings.PRESENCE_TTL)
+        self.mark(room, self.IN_CALL, user_id, True)
+
+    async def leave_call(self, room, user_id):
+        calls = self.local_calls.get(room, set())
+        calls.discard(user_id)
+        if not calls:
+            self.local_calls.pop(room, None)
+        if await self.call_store(self.store.remove, room, self.IN_CALL, user_id):
+            self.mark(room, self.IN_CALL, user_id, False)
+
+    async def snapshot(self, room):
+        def load():
+            now = time.time()
+            return self.store.members(room, self.ONLINE, now), self.store.members(room, self.IN_CALL, now)
+        loaded = await self.call_store(load)
+        if loaded is None:
+            return []
+        online, in_call = loaded
+        return [
+            {'uuid': user_id, 'is_online': True, 'is_in_call': user_id in in_call}
+            for user_id in sorted(online)
+        ]
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(settings.PRESENCE_TICK)
+            try:
+                await self.tick()
+            except Exception as e:
+                print(f'Presence tick failed: {e}')
+
+    async def tick(self):
+        now = time.time()
+        if time.monotonic() - self._last_heartbeat > settings.PRESENCE_TTL / 3:
+            self._last_heartbeat = time.monotonic()
+            members = {
+                room: (list(sockets), list(self.local_calls.get(room, ())))
+                for room, sockets in self.local.items()
+            }
+            # Diffs still go out below when the store is down
+            for room, kind, user_id in await self.call_store(self.heartbeat, members, now) or ():
+                self.mark(room, kind, user_id, False)
+
+        diffs, self.diffs = self.diffs, {}
+        channel_layer = get_channel_layer()
+        for room, kinds in diffs.items():
+            online = kinds.get(self.ONLINE, {})
+            calls = kinds.get(self.IN_CALL, {})
+            await channel_layer.group_send(self.groups[room], {
+                'type': 'presence_diff',
+                'online': [user_id for user_id, joined in online.items() if joined],
+                'offline': [user_id for user_id, joined in online.items() if not joined],
+                'joined_call': [user_id for user_id, joined in calls.items() if joined],
+                'left_call': [user_id for user_id, joined in calls.items() if not joined],
+            })
+
+        if time.monotonic() - self._last_persist > settings.PRESENCE_PERSIST_INTERVAL:
+            self._last_persist = time.monotonic()
+            dirty, self.dirty = self.dirty, {}
+            if dirty:
+                await self.persist(dirty)
+
+        # Rooms whose last local socket left and whose diff went out
+        for room in [room for room in self.groups if room not in self.local and room not in self.diffs]:
+            del self.groups[room]
+
+    def heartbeat(self, members, now):
+        # Refresh this process' members and collect the ones a dead worker left behind
+        expires_at = now + settings.PRESENCE_TTL
+        expired = []
+        for room, (online, in_call) in members.items():
+            self.store.touch(room, self.ONLINE, online, expires_at)
+            self.store.touch(room, self.IN_CALL, in_call, expires_at)
+            for kind in (self.ONLINE, self.IN_CALL):
+                expired.extend((room, kind, user_id) for user_id in self.store.expire(room, kind, now))
+        return expired
+
+    @database_sync_to_async
+    def persist(self, dirty):
+        # At most four UPDATE statements per interval, whatever the traffic
+        for field in ('is_online', 'is_in_call'):
+            for value in (True, False):
+                user_ids = [user_id for user_id, fields in dirty.items() if fields.get(field) is value]
+                if user_ids:
+                    User.objects.filter(uuid__in=user_ids).update(**{field: value})
+
+
+def build_store():
+    if settings.PRESENCE_BACKEND == 'redis':
+        return RedisPresenceStore()
+    return InMemoryPresenceStore()
+
+
+presence = PresenceService(build_store())
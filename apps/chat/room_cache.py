@@ -0,0 +1,113 @@
+import threading
+import uuid
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import DEFAULT_DB_ALIAS
+
+from .models import Chat, Stream
+
+
+class RoomContext:
+    # What ChatConsumer needs about its room besides the chat's content
+
+    def __init__(self, chat_id, room_name, room_group_name, participants, streams):
+        self.chat_id = chat_id
+        self.room_name = room_name
+        self.room_group_name = room_group_name
+        # {user uuid: user pk}
+        self.participants = participants
+        # {stream id: user uuid} of the room's active streams
+        self.streams = streams
+
+    def chat(self):
+        # A Chat with only id and room names loaded, enough for related managers and helpers
+        return Chat.from_db(
+            DEFAULT_DB_ALIAS, ['id', 'room_name', 'room_group_name'],
+            [self.chat_id, self.room_name, self.room_group_name],
+        )
+
+    def stream_of(self, user_id):
+        return next((stream_id for stream_id, owner in self.streams.items() if owner == user_id), None)
+
+
+class RoomCache:
+    """
+    Per-process RoomContext of every room with a connected socket. Loaded
+    once when the first socket connects and dropped with the last one, so
+    the per-message path needs no database read to know the room. Changes
+    to participants or streams are announced to the room group as a
+    room_changed event (see signals.py), every process then reloads.
+    """
+
+    def __init__(self):
+        self.rooms = {}
+        self.sockets = {}
+        # Last room_changed applied per room, each socket relays the same one
+        self.changes = {}
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def acquire(self, room_name):
+        with self.lock:
+            self.sockets[room_name] = self.sockets.get(room_name, 0) + 1
+
+    def release(self, room_name):
+        with self.lock:
+            self.sockets[room_name] = self.sockets.get(room_name, 0) - 1
+            if self.sockets[room_name] <= 0:
+                self.sockets.pop(room_name, None)
+                self.rooms.pop(room_name, None)
+                self.changes.pop(room_name, None)
+
+    def get(self, room_name):
+        # Sync, loads from the database on a miss; raises Chat.DoesNotExist for unknown rooms
+        with self.lock:
+            context = self.rooms.get(room_name)
+            if context is not None:
+                self.stats['hits'] += 1
+                return context
+            self.stats['misses'] += 1
+        context = self.load(room_name)
+        with self.lock:
+            # A room whose last socket left meanwhile isn't kept
+            if room_name in self.sockets:
+                self.rooms[room_name] = context
+        return context
+
+    def load(self, room_name):
+        chat = Chat.objects.values('id', 'room_group_name').get(room_name=room_name)
+        participants = dict(Chat.participants.through.objects.filter(chat_id=chat['id']).values_list('user__uuid', 'user_id'))
+        streams = dict(
+            Stream.objects.filter(chat__id=chat['id'], is_active=True).values_list('id', 'user__uuid')
+        )
+        return RoomContext(chat['id'], room_name, chat['room_group_name'], participants, streams)
+
+    def invalidate(self, room_name, change_id=None):
+        with self.lock:
+            if change_id is not None:
+                if self.changes.get(room_name) == change_id:
+                    return
+                if room_name in self.sockets:
+                    self.changes[room_name] = change_id
+            if self.rooms.pop(room_name, None) is not None:
+                self.stats['invalidations'] += 1
+
+    def metrics(self):
+        with self.lock:
+            return {'rooms': len(self.rooms), 'sockets': sum(self.sockets.values()), **self.stats}
+
+
+def send_room_changed(room_names):
+    # Every process with a socket in the room drops its RoomContext
+    async def send_all():
+        channel_layer = get_channel_layer()
+        for room_name in room_names:
+            await channel_layer.group_send(f'chat_{room_name}', {
+                'type': 'room_changed',
+                'change_id': uuid.uuid4().hex,
+            })
+    async_to_sync(send_all)()
+
+
+room_cache = RoomCache()
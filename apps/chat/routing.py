@@ -1,9 +1,15 @@
-from django.urls import re_path
+from django.urls import path, re_path
 
-from .consumers import InboxConsumer, ChatConsumer, VideoCallConsumer
+from .consumers import InboxConsumer, ChatConsumer, VideoCallConsumer, ExportMessagesConsumer
 
 websocket_urlpatterns = [
     re_path(r'^ws/inbox/(?P<room_name>[^/]+)/$', InboxConsumer.as_asgi()),
     re_path(r'^ws/chat/(?P<room_name>[^/]+)/$', ChatConsumer.as_asgi()),
     re_path(r'^ws/call/(?P<room_name>[^/]+)/$', VideoCallConsumer.as_asgi()),
-]
\ No newline at end of file
+]
+
+# Served by consumers instead of Django views, everything else falls through to Django.
+# They authenticate the Authorization header themselves, like the REST views.
+http_urlpatterns = [
+    path('api/chat/export/<str:room_name>/<str:room_group_name>/', ExportMessagesConsumer.as_asgi()),
+]
@@ -42,6 +42,21 @@ class ChatSerializer(serializers.ModelSerializer):
             'created_at',
             'stream',
         ]
+
+
+class InboxSerializer(ChatSerializer):
+    last_message_sender = serializers.CharField(allow_null=True)
+    last_message_timestamp = serializers.DateTimeField(allow_null=True)
+    # Annotated by inbox_queryset(), a chat summary without a user has nothing unread
+    unread_count = serializers.IntegerField(default=0)
+    class Meta(ChatSerializer.Meta):
+        fields = ChatSerializer.Meta.fields + [
+            'last_activity',
+            'last_message_sender',
+            'last_message_timestamp',
+            'unread_count',
+        ]
+
     
 class BreakoutRoomSerializer(serializers.ModelSerializer):
     participants = UserSerializer(many=True)
@@ -72,7 +87,7 @@ class FileSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = File
-        fields = ['id', 'message','file', 'name', 'size', 'mime_type', 'created_at']
+        fields = ['id', 'message','file', 'name', 'size', 'mime_type', 'created_at', 'status']
 
 
 class ReactionSerializer(serializers.ModelSerializer):
@@ -94,15 +109,23 @@ class PollOptionSerializer(serializers.ModelSerializer):
 class PollSerializer(serializers.ModelSerializer):
     options = PollOptionSerializer(many=True)
     total_votes_count=serializers.CharField()
-    voters=UserSerializer(many=True)
+    voters=serializers.SerializerMethodField()
     class Meta:
         model = Poll
         fields = ('id', 'question', 'options', 'total_votes_count', 'voters')
 
+    def get_voters(self, obj):
+        # Voters come from the (poll, voter) ballots, one query per poll unless prefetched
+        if 'ballots' in getattr(obj, '_prefetched_objects_cache', {}):
+            ballots = obj.ballots.all()
+        else:
+            ballots = obj.ballots.select_related('voter')
+        return UserSerializer([ballot.voter for ballot in ballots], many=True).data
+
 
 class MessageSerializer(serializers.ModelSerializer):
     sender = UserSerializer()
-    read_by = UserSerializer(many=True)
+    read_by = serializers.SerializerMethodField()
     files = FileSerializer(many=True)
     public_key = FileSerializer()
     gif = GIFSerializer()
@@ -116,6 +139,7 @@ class MessageSerializer(serializers.ModelSerializer):
             'sender',
             'content',
             'voice_message',
+            'voice_message_status',
             'public_key',
             'timestamp',
             'read_by',
@@ -127,4 +151,23 @@ class MessageSerializer(serializers.ModelSerializer):
             'encryption',
             'gif',
             'poll',
-        ]
\ No newline at end of file
+        ]
+
+    def get_read_by(self, obj):
+        # Everyone but the sender whose read watermark reached this message,
+        # from context['read_states'] when the caller loaded them for the batch
+        read_states = self.context.get('read_states')
+        if read_states is None:
+            states = ChatReadState.objects.filter(chat_id=obj.chat_id, last_read_message_id__gte=obj.id).select_related('user')
+            readers = [state.user for state in states]
+        else:
+            readers = [user for last_read_id, user in read_states.get(obj.chat_id, ()) if last_read_id >= obj.id]
+        return UserSerializer([user for user in readers if user.id != obj.sender_id], many=True).data
+
+
+class MessagePayloadSerializer(MessageSerializer):
+    # The cached payload: read_by changes on every read, clients derive it
+    # from the read watermarks of the page and the messages_read events
+
+    class Meta(MessageSerializer.Meta):
+        fields = [field for field in MessageSerializer.Meta.fields if field != 'read_by']
@@ -0,0 +1,38 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .message_cache import invalidate_message_payload
+from .models import Chat, File, Message
+from .room_cache import send_room_changed
+
+
+@receiver(post_save, sender=Message)
+def message_saved(sender, instance, created, **kwargs):
+    if not created:
+        invalidate_message_payload(instance.id)
+
+
+@receiver(post_save, sender=File)
+@receiver(post_delete, sender=File)
+def message_file_changed(sender, instance, **kwargs):
+    invalidate_message_payload(instance.message_id)
+
+
+@receiver(m2m_changed, sender=Chat.participants.through)
+@receiver(m2m_changed, sender=Chat.stream.through)
+def chat_membership_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # Consumers cache participants and streams per room, see room_cache.py.
+    # A reverse clear (user.chats.clear()) only knows its chats before it runs.
+    if not reverse and action in ('post_add', 'post_remove', 'post_clear'):
+        room_names = [instance.room_name]
+    elif reverse and action in ('post_add', 'post_remove'):
+        room_names = list(Chat.objects.filter(id__in=pk_set).values_list('room_name', flat=True))
+    elif reverse and action == 'pre_clear':
+        chat_ids = sender.objects.filter(**{sender._meta.get_field(instance._meta.model_name).attname: instance.pk})
+        room_names = list(Chat.objects.filter(id__in=chat_ids.values('chat_id')).values_list('room_name', flat=True))
+    else:
+        return
+    room_names = [room_name for room_name in room_names if room_name]
+    if room_names:
+        transaction.on_commit(lambda: send_room_changed(room_names))
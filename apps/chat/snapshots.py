@@ -0,0 +1,129 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from urllib.parse import parse_qs
+
+from django.conf import settings
+
+from core.codecs import JSONCodec
+
+# List fields of a serialized Chat that are diffed item by item, by their key
+KEYED_FIELDS = {'participants': 'uuid', 'stream': 'id'}
+
+
+def wants_compact(scope):
+    # Clients that apply chat_diff frames and user tables opt in with ?compact=1
+    query = parse_qs(scope.get('query_string', b'').decode())
+    return query.get('compact', ['0'])[0] in ('1', 'true')
+
+
+def describe(chat):
+    # (size, digest) of a serialized Chat, computed once where it's serialized
+    encoded = JSONCodec().encode(chat).encode()
+    return len(encoded), hashlib.blake2b(encoded, digest_size=8).hexdigest()
+
+
+def diff_chat(base, chat):
+    # Scalar fields that changed, plus upserted and removed participants / streams
+    diff = {'id': chat['id'], 'room_name': chat['room_name']}
+    for field, value in chat.items():
+        if field not in KEYED_FIELDS and base.get(field) != value:
+            diff[field] = value
+    for field, key in KEYED_FIELDS.items():
+        before = {item[key]: item for item in base.get(field) or ()}
+        after = {item[key]: item for item in chat.get(field) or ()}
+        upsert = [item for item_key, item in after.items() if before.get(item_key) != item]
+        remove = [item_key for item_key in before if item_key not in after]
+        if upsert or remove:
+            diff[field] = {'upsert': upsert, 'remove': remove}
+    return diff
+
+
+def compact_chats(chats):
+    # One users table for a page of chats, participants and stream owners become uuids
+    users = {}
+    compacted = []
+    for chat in chats:
+        chat = dict(chat)
+        for user in chat.get('participants') or ():
+            users[user['uuid']] = user
+        chat['participants'] = [user['uuid'] for user in chat.get('participants') or ()]
+        streams = []
+        for stream in chat.get('stream') or ():
+            users[stream['user']['uuid']] = stream['user']
+            streams.append({**stream, 'user': stream['user']['uuid']})
+        chat['stream'] = streams
+        compacted.append(chat)
+    return compacted, users
+
+
+class ChatSnapshots:
+    """
+    Recent Chat snapshots of the process by digest. A socket only remembers
+    the digest of the last snapshot it got, the snapshot itself is shared
+    here; when a base has been evicted the socket gets a full snapshot again.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.snapshots = OrderedDict()
+        # (base digest, digest) -> (diff, bytes saved), every socket on the same base shares it
+        self.diffs = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'full': 0, 'diffs': 0, 'bytes_saved': 0}
+
+    def add(self, digest, chat):
+        with self.lock:
+            self.snapshots[digest] = chat
+            self.snapshots.move_to_end(digest)
+            if len(self.snapshots) > self.size:
+                self.snapshots.popitem(last=False)
+
+    def get(self, digest):
+        with self.lock:
+            return self.snapshots.get(digest)
+
+    def diff(self, base_digest, chat, size, digest):
+        key = (base_digest, digest)
+        with self.lock:
+            cached = self.diffs.get(key)
+        if cached is None:
+            base = self.get(base_digest)
+            if base is None:
+                return None
+            diff = {**diff_chat(base, chat), 'base': base_digest, 'digest': digest}
+            cached = (diff, size - len(JSONCodec().encode(diff)))
+            with self.lock:
+                self.diffs[key] = cached
+                if len(self.diffs) > self.size:
+                    self.diffs.popitem(last=False)
+        return cached
+
+    def frame_fields(self, chat, size, digest, base_digest, compact):
+        """
+        Returns (fields carrying the chat in an outbound frame, frame variant):
+        'chat' with the full snapshot, or 'chat_diff' against base_digest when
+        the socket opted in, the snapshot is over CHAT_SNAPSHOT_BUDGET and the
+        diff is smaller than it.
+        """
+        if digest is None:
+            return {'chat': chat}, None
+        self.add(digest, chat)
+        budget = settings.CHAT_SNAPSHOT_BUDGET
+        cached = None
+        if compact and budget and size > budget and base_digest:
+            cached = self.diff(base_digest, chat, size, digest)
+        # No base to diff against, or a diff no smaller than the snapshot itself
+        if cached is None or cached[1] <= 0:
+            self.stats['full'] += 1
+            return {'chat': chat, 'chat_digest': digest}, None
+        diff, saved = cached
+        self.stats['diffs'] += 1
+        self.stats['bytes_saved'] += saved
+        return {'chat_diff': diff}, f'diff:{base_digest}'
+
+    def metrics(self):
+        return {'snapshots': len(self.snapshots), **self.stats}
+
+
+chat_snapshots = ChatSnapshots(settings.CHAT_SNAPSHOT_CACHE_SIZE)
@@ -1,3 +1,1262 @@
-from django.test import TestCase
+import asyncio
+import importlib
+import json
+import os
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import jwt
+from django.apps import apps
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import HttpCommunicator, WebsocketCommunicator
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from redis.exceptions import RedisError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from rest_framework_api.views import StandardAPIView
+
+from core.asgi import application
+from core.authentication import verify_token
+from core.channel_layers import ShardedRedisChannelLayer, jump_hash
+from core.codecs import RawJSON, codecs, negotiate
+from core.outbound import SLOW_CONSUMER_CLOSE_CODE
+from core.producer import EventProducer, InMemoryBroker
+
+from .call_registry import InMemoryCallRegistry
+from .consumers import get_scope_user_id
+from .conversations import get_or_create_direct_chat, upsert_users
+from .counters import add_participants, mark_read
+from .db_executor import DatabaseExecutor
+from .events import EventProcessor, InMemoryConsumer
+from .history import encode_cursor, get_message_page, load_export_chunk, parse_cursor
+from .management.commands.loadtest_slow_client import slow_application
+from .message_cache import _payload_key, get_message_payload, get_message_payloads
+from .models import Chat, ChatReadState, File, Message, Poll, PollOption, PollVote, User
+from .presence import InMemoryPresenceStore, PresenceService, merge_diffs
+from .room_cache import room_cache
+from .snapshots import ChatSnapshots, compact_chats, describe, wants_compact
+from .uploads import staged_path, upload
+from .views import publish_message_created
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def access_token(user_id):
+    return jwt.encode({'user_id': user_id, 'token_type': 'access', 'exp': time.time() + 60}, settings.SECRET_KEY, algorithm='HS256')
+
+
+def group_events(group, action, idle=0.1):
+    # Runs the sync action with a channel in the group, returns its result and what the group got
+    async def run():
+        channel_layer = get_channel_layer()
+        channel = await channel_layer.new_channel()
+        await channel_layer.group_add(group, channel)
+        result = await sync_to_async(action)()
+        events = []
+        while True:
+            try:
+                events.append(await asyncio.wait_for(channel_layer.receive(channel), idle))
+            except asyncio.TimeoutError:
+                break
+        await channel_layer.group_discard(group, channel)
+        return result, events
+    return async_to_sync(run)()
+
+
+class CallRegistryTests(SimpleTestCase):
+    # The in-memory registry stands in for the Redis one, both answer first / last socket the same way
+
+    def setUp(self):
+        self.registry = InMemoryCallRegistry()
+
+    def test_first_socket_of_a_user_joins(self):
+        self.assertTrue(self.registry.join('room', 'alice', 'channel-1'))
+        self.assertFalse(self.registry.join('room', 'alice', 'channel-2'))
+        self.assertTrue(self.registry.join('room', 'bob', 'channel-3'))
+        self.assertEqual(self.registry.channels('room'), {
+            'channel-1': 'alice',
+            'channel-2': 'alice',
+            'channel-3': 'bob',
+        })
+
+    def test_last_socket_of_a_user_leaves(self):
+        self.registry.join('room', 'alice', 'channel-1')
+        self.registry.join('room', 'alice', 'channel-2')
+        self.assertFalse(self.registry.leave('room', 'alice', 'channel-1'))
+        self.assertTrue(self.registry.leave('room', 'alice', 'channel-2'))
+        self.assertEqual(self.registry.channels('room'), {})
+
+    def test_unknown_channel_leave_is_ignored(self):
+        self.registry.join('room', 'alice', 'channel-1')
+        self.assertFalse(self.registry.leave('room', 'alice', 'channel-9'))
+        self.assertFalse(self.registry.leave('other', 'alice', 'channel-1'))
+        self.assertEqual(self.registry.channels('room'), {'channel-1': 'alice'})
+
+    def test_rooms_are_independent(self):
+        self.assertTrue(self.registry.join('room-a', 'alice', 'channel-1'))
+        self.assertTrue(self.registry.join('room-b', 'alice', 'channel-2'))
+        self.assertTrue(self.registry.leave('room-a', 'alice', 'channel-1'))
+        self.assertEqual(self.registry.channels('room-b'), {'channel-2': 'alice'})
+
+    def test_empty_room_is_dropped(self):
+        self.registry.join('room', 'alice', 'channel-1')
+        self.registry.leave('room', 'alice', 'channel-1')
+        self.assertEqual(self.registry.members, {})
+        self.assertEqual(self.registry.rooms, {})
+
+
+class VerifyTokenTests(SimpleTestCase):
+
+    def token(self, **claims):
+        return jwt.encode({'user_id': 'alice', 'exp': time.time() + 60, **claims}, settings.SECRET_KEY, algorithm='HS256')
+
+    def test_access_token_is_accepted(self):
+        self.assertEqual(verify_token(self.token(token_type='access'))['user_id'], 'alice')
+
+    def test_refresh_token_is_rejected(self):
+        with self.assertRaises(jwt.InvalidTokenError):
+            verify_token(self.token(token_type='refresh'))
+
+    def test_token_without_type_is_rejected(self):
+        with self.assertRaises(jwt.InvalidTokenError):
+            verify_token(self.token())
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+@override_settings(CACHES=LOCMEM_CACHES)
+class LoadMessagesViewTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(uuid='alice', username='alice')
+        self.chat = Chat.objects.create(name='chat', room_name='room', room_group_name='chat_room')
+        self.chat.participants.add(self.user)
+        for i in range(3):
+            Message.objects.create(chat=self.chat, sender=self.user, content=f'message {i}')
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {access_token(self.user.uuid)}'
+
+    def load(self, query=''):
+        response = self.client.get(f'/api/chat/load_conversation_messages/room/chat_room/{query}')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_paginated_envelope_is_the_default(self):
+        body = self.load()
+        self.assertIn('next', body)
+        self.assertIn('previous', body)
+        self.assertNotIn('older_cursor', body)
+        self.assertEqual(len(body['results']), 3)
+
+    def test_keyset_envelope_when_asked_for(self):
+        body = self.load('?count=2')
+        self.assertNotIn('next', body)
+        self.assertEqual([message['content'] for message in body['results']], ['message 1', 'message 2'])
+        older = self.load(f'?before={body["older_cursor"]}')
+        self.assertEqual([message['content'] for message in older['results']], ['message 0'])
+
+    def test_envelopes_match_standard_api_view(self):
+        # The spliced envelopes are what paginate_response / send_response render for the decoded payloads
+        messages = list(self.chat.messages.order_by('timestamp', 'id'))
+        results = [json.loads(payload) for payload in get_message_payloads(messages)]
+        query = '?p=2&page_size=2'
+        request = Request(APIRequestFactory().get(f'/api/chat/load_conversation_messages/room/chat_room/{query}'))
+        expected = json.loads(JSONRenderer().render(StandardAPIView().paginate_response(request, results).data))
+        body = self.load(query)
+        self.assertEqual(body.pop('read_states'), [])
+        self.assertEqual(body, expected)
+        self.assertEqual(list(body), list(expected))
+
+        body = self.load('?count=3')
+        for key in ('count', 'older_cursor', 'newer_cursor', 'read_states'):
+            body.pop(key)
+        self.assertEqual(body, StandardAPIView().send_response(results).data)
+
+    def test_reads_come_as_watermarks_not_in_payloads(self):
+        bob = User.objects.create(uuid='bob', username='bob')
+        self.chat.participants.add(bob)
+        ChatReadState.objects.create(chat=self.chat, user=bob, unread_count=3)
+        before = self.load('?count=3')
+        first = self.chat.messages.order_by('id').first()
+        self.assertEqual(mark_read('bob', self.chat, first.id), first.id)
+        after = self.load('?count=3')
+        self.assertNotIn('read_by', after['results'][0])
+        self.assertEqual(after['results'], before['results'])
+        self.assertEqual(after['read_states'], [{'user_id': 'bob', 'last_read_message_id': first.id}])
+        self.assertEqual(ChatReadState.objects.get(user=bob).unread_count, 2)
+        # The watermark never moves backwards
+        self.assertIsNone(mark_read('bob', self.chat, first.id))
+
+
+class StoredUpload:
+    # Every key counts as uploaded, 5 bytes long
+
+    def size(self, key):
+        return 5
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+@mock.patch('apps.chat.views.get_direct_upload', StoredUpload)
+class ConfirmUploadViewTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(uuid='alice', username='alice')
+        self.chat = Chat.objects.create(name='chat', room_name='room', room_group_name='chat_room')
+        self.chat.participants.add(self.user)
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {access_token(self.user.uuid)}'
+        cache.clear()
+
+    def confirm(self, uploads):
+        return self.client.post('/api/chat/uploads/confirm/', {
+            'roomName': 'room', 'roomGroupName': 'chat_room', 'uploads': uploads,
+        }, content_type='application/json')
+
+    def upload_id(self, name):
+        return signing.dumps(
+            {'k': f'files/{name}', 'n': name, 's': 5, 'm': 'text/plain', 'c': self.chat.id, 'u': self.user.uuid},
+            salt='chat.upload',
+        )
+
+    def test_upload_id_is_single_use(self):
+        upload_id = self.upload_id('a.txt')
+        self.assertEqual(self.confirm([upload_id]).status_code, 200)
+        self.assertEqual(self.confirm([upload_id]).status_code, 409)
+        self.assertEqual(File.objects.count(), 1)
+
+    def test_rejected_confirmation_releases_the_other_uploads(self):
+        used = self.upload_id('a.txt')
+        self.confirm([used])
+        fresh = self.upload_id('b.txt')
+        self.assertEqual(self.confirm([fresh, used]).status_code, 409)
+        self.assertEqual(self.confirm([fresh]).status_code, 200)
+
+    def test_uploads_must_be_a_list(self):
+        self.assertEqual(self.confirm('not a list').status_code, 400)
+        self.assertEqual(self.confirm([1, 2]).status_code, 400)
+
+
+class EventProducerTests(SimpleTestCase):
+    # The in-memory broker plugs in where confluent_kafka.Producer would
+
+    def setUp(self):
+        self.broker = InMemoryBroker(keep=2)
+        self.producer = EventProducer(lambda: self.broker)
+        self.addCleanup(self.producer.close)
+
+    def test_delivered_messages_are_bounded(self):
+        for i in range(3):
+            self.assertTrue(self.producer.publish('message_created', {'message_id': i}, topic='events'))
+        self.assertEqual(self.producer.close(), 0)
+        self.assertEqual(self.broker.delivered_count, 3)
+        self.assertEqual([json.loads(message.value())['message_id'] for message in self.broker.delivered], [1, 2])
+        metrics = self.producer.metrics()
+        self.assertEqual((metrics['produced'], metrics['delivered'], metrics['errors']), (3, 3, 0))
+
+    def test_message_created_event(self):
+        message = SimpleNamespace(id=7, timestamp=None)
+        chat = SimpleNamespace(id=3, room_name='room')
+        with mock.patch('apps.chat.views.producer', self.producer):
+            publish_message_created(message, chat, 'alice')
+        self.producer.close()
+        event = self.broker.delivered[-1]
+        self.assertEqual(event.key(), b'"message_created"')
+        self.assertEqual(json.loads(event.value()), {
+            'message_id': 7, 'chat_id': 3, 'room_name': 'room', 'sender': 'alice', 'timestamp': None,
+        })
+
+
+@override_settings(EVENT_MAX_RETRIES=2, EVENT_RETRY_BACKOFF=0)
+class EventProcessorTests(SimpleTestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.consumer = InMemoryConsumer()
+        self.processor = EventProcessor(self.consumer, batch_size=10, workers=2, mode='thread')
+        self.addCleanup(self.processor.pool.shutdown)
+
+    def record(self, events):
+        self.calls.append(events)
+
+    def fail(self, events):
+        raise RuntimeError('handler failed')
+
+    def test_keys_sharing_a_handler_run_as_one_ordered_group(self):
+        with mock.patch.dict('apps.chat.events.handlers', {'registered': self.record, 'updated': self.record}):
+            self.consumer.append('registered', {'user_id': 'alice', 'username': 'old'})
+            self.consumer.append('updated', {'user_id': 'alice', 'username': 'new'})
+            self.consumer.append('registered', {'user_id': 'bob', 'username': 'bob'})
+            self.processor.run(stop_when_idle=True)
+        self.assertEqual([[event['username'] for event in events] for events in self.calls], [['old', 'new', 'bob']])
+        self.assertEqual(self.consumer.committed, 3)
+
+    def test_failing_batch_goes_to_the_dead_letter_topic(self):
+        broker = InMemoryBroker()
+        dead_letters = EventProducer(lambda: broker)
+        self.addCleanup(dead_letters.close)
+        with mock.patch.dict('apps.chat.events.handlers', {'broken': self.fail, 'fine': self.record}), \
+                mock.patch('apps.chat.events.producer', dead_letters):
+            self.consumer.append('broken', {'id': 1})
+            self.consumer.append('fine', {'id': 2})
+            self.processor.run(stop_when_idle=True)
+        dead_letters.close()
+        # The first try and two retries, then the broken events are parked and the batch committed
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(self.consumer.committed, 2)
+        self.assertEqual(self.processor.dead_lettered, 1)
+        self.assertEqual([(message.topic(), message.key()) for message in broker.delivered], [
+            (settings.EVENT_DEAD_LETTER_TOPIC, b'"broken"'),
+        ])
+
+
+class AddParticipantsTests(TestCase):
+
+    def test_existing_participants_are_not_counted_again(self):
+        alice = User.objects.create(uuid='alice')
+        bob = User.objects.create(uuid='bob')
+        chat = Chat.objects.create(name='chat', room_name='room', room_group_name='chat_room')
+        add_participants(chat, [alice.id])
+        add_participants(chat, [alice.id, bob.id, bob.id])
+        counts = dict(User.objects.values_list('uuid', 'inbox_count'))
+        self.assertEqual(counts, {'alice': 1, 'bob': 1})
+
+
+class DirectChatTests(TestCase):
+
+    def test_users_are_upserted_with_model_defaults(self):
+        User.objects.create(uuid='alice', username='old', inbox_count=3)
+        ids = upsert_users({'alice': 'alice', 'bob': 'bob'})
+        users = {user.uuid: user for user in User.objects.all()}
+        self.assertEqual(ids, {uuid: user.id for uuid, user in users.items()})
+        self.assertEqual((users['alice'].username, users['alice'].inbox_count), ('alice', 3))
+        self.assertEqual(
+            (users['bob'].username, users['bob'].is_online, users['bob'].is_in_call, users['bob'].is_chatbot, users['bob'].inbox_count),
+            ('bob', False, False, False, 0),
+        )
+
+    def test_fallback_without_on_conflict(self):
+        User.objects.create(uuid='alice', username='old')
+        with mock.patch.object(connection, 'vendor', 'mysql'):
+            ids = upsert_users({'alice': 'alice', 'bob': 'bob'})
+        self.assertEqual(ids, dict(User.objects.values_list('uuid', 'id')))
+        self.assertEqual(dict(User.objects.values_list('uuid', 'username')), {'alice': 'alice', 'bob': 'bob'})
+
+    def test_either_side_finds_the_chat(self):
+        chat, created = get_or_create_direct_chat('alice', 'alice', 'bob', 'bob')
+        self.assertTrue(created)
+        self.assertEqual(get_or_create_direct_chat('bob', 'bob', 'alice', 'alice'), (chat, False))
+        self.assertEqual(sorted(chat.participants.values_list('uuid', flat=True)), ['alice', 'bob'])
+        self.assertEqual(dict(User.objects.values_list('uuid', 'inbox_count')), {'alice': 1, 'bob': 1})
+
+    def test_losing_the_pair_key_race_returns_the_winners_chat(self):
+        chat, _ = get_or_create_direct_chat('alice', 'alice', 'bob', 'bob')
+        # The lookup misses, as for a request that ran before the other one committed
+        with mock.patch.object(Chat.objects, 'filter', return_value=Chat.objects.none()):
+            self.assertEqual(get_or_create_direct_chat('bob', 'bob', 'alice', 'alice'), (chat, False))
+        self.assertEqual(Chat.objects.count(), 1)
+        self.assertEqual(dict(User.objects.values_list('uuid', 'inbox_count')), {'alice': 1, 'bob': 1})
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ChatConsumerTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(uuid='alice', username='alice')
+        self.chat = Chat.objects.create(name='chat', room_name='room', room_group_name='chat_room')
+        self.chat.participants.add(self.user)
+
+    def communicator(self, room_name, query=''):
+        return WebsocketCommunicator(application, f'/ws/chat/{room_name}/?token={access_token(self.user.uuid)}{query}')
+
+    async def test_unknown_room_is_refused(self):
+        communicator = self.communicator('missing')
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+        self.assertNotIn('missing', room_cache.sockets)
+
+    def events(self, messages):
+        return [
+            {'type': 'chat_message', 'payload': payload, 'cursor': encode_cursor(message)}
+            for message, payload in zip(messages, get_message_payloads(messages))
+        ]
+
+    def add_messages(self, count):
+        Message.objects.bulk_create([Message(chat=self.chat, sender=self.user, content=f'message {i}') for i in range(count)])
+        return list(self.chat.messages.order_by('timestamp', 'id'))
+
+    async def receive(self, communicator):
+        return json.loads(await communicator.receive_from(5))
+
+    async def test_resume_drops_live_messages_already_replayed(self):
+        messages = await asyncio.to_thread(self.add_messages, 10)
+        token = signing.dumps({'r': 'room', 'u': 'alice', 'c': encode_cursor(messages[4])}, salt='chat.resume')
+        communicator = self.communicator('room', f'&resume={token}')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        resumed = await self.receive(communicator)
+        self.assertEqual(resumed['type'], 'resumed')
+        self.assertEqual([message['id'] for message in resumed['messages']], [message.id for message in messages[5:]])
+        self.assertEqual((await self.receive(communicator))['type'], 'online_participants')
+
+        # Sent while the socket resumed: the first two are in the replay, the last one is new
+        newer = await asyncio.to_thread(self.add_messages, 1)
+        for event in await asyncio.to_thread(self.events, messages[8:] + newer[-1:]):
+            await get_channel_layer().group_send('chat_room', event)
+        live = await self.receive(communicator)
+        self.assertEqual(live['message']['id'], newer[-1].id)
+        self.assertTrue(await communicator.receive_nothing(0.2))
+        await communicator.disconnect()
+
+    @override_settings(OUTBOUND_HIGH_WATER=10, OUTBOUND_QUEUE_LIMIT=20)
+    async def test_slow_consumer_misses_nothing_after_resume(self):
+        messages = await asyncio.to_thread(self.add_messages, 200)
+        events = await asyncio.to_thread(self.events, messages)
+        slow = WebsocketCommunicator(
+            slow_application(application, 0.005),
+            f'/ws/chat/room/?token={access_token(self.user.uuid)}',
+        )
+        self.assertTrue((await slow.connect())[0])
+        for event in events:
+            await get_channel_layer().group_send('chat_room', event)
+            await asyncio.sleep(0)
+
+        received, token = set(), None
+        while True:
+            output = await slow.receive_output(5)
+            if output['type'] == 'websocket.close':
+                self.assertEqual(output['code'], SLOW_CONSUMER_CLOSE_CODE)
+                break
+            data = json.loads(output['text'])
+            if data['type'] == 'chat_message':
+                received.add(data['message']['id'])
+            elif data['type'] == 'slow_consumer':
+                token = data['resume_token']
+        self.assertIsNotNone(token)
+        # What the server sends the application once it closed the socket
+        await slow.disconnect()
+
+        again = self.communicator('room', f'&resume={token}')
+        self.assertTrue((await again.connect())[0])
+        resumed = await self.receive(again)
+        self.assertEqual(resumed['type'], 'resumed')
+        replayed = [message['id'] for message in resumed['messages']]
+        cursor = resumed['newer_cursor']
+        while cursor is not None:
+            page = await asyncio.to_thread(get_message_page, self.chat, after=parse_cursor(cursor))
+            replayed += [json.loads(payload)['id'] for payload in page['results']]
+            cursor = page['newer_cursor']
+        await again.disconnect()
+
+        self.assertEqual(len(replayed), len(set(replayed)))
+        self.assertEqual({message.id for message in messages} - received - set(replayed), set())
+
+    async def test_known_room_is_joined(self):
+        communicator = self.communicator('room')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(room_cache.metrics()['rooms'], 1)
+        await communicator.disconnect()
+        self.assertEqual(room_cache.metrics()['rooms'], 0)
+
+
+class ScopeUserTests(SimpleTestCase):
+
+    def test_legacy_user_param_is_refused_by_default(self):
+        self.assertIsNone(get_scope_user_id({'query_string': b'user=alice'}))
+        self.assertEqual(get_scope_user_id({'query_string': b'user=alice', 'user_id': 'bob'}), 'bob')
+
+    @override_settings(WEBSOCKET_REQUIRE_TOKEN=False)
+    def test_legacy_user_param_with_other_params(self):
+        self.assertEqual(get_scope_user_id({'query_string': b'user=alice&resume=a%3Db'}), 'alice')
+        self.assertEqual(get_scope_user_id({'query_string': b'resume=x&user=alice'}), 'alice')
+        self.assertIsNone(get_scope_user_id({'query_string': b''}))
+        # A token that failed verification doesn't fall back to ?user=
+        self.assertIsNone(get_scope_user_id({'query_string': b'token=bad&user=alice'}))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class UploadWorkerTests(TransactionTestCase):
+    # The worker's job run inline, the way the upload pool runs it after commit
+
+    def setUp(self):
+        staging, media = tempfile.TemporaryDirectory(), tempfile.TemporaryDirectory()
+        self.addCleanup(staging.cleanup)
+        self.addCleanup(media.cleanup)
+        settings_override = override_settings(UPLOAD_STAGING_DIR=staging.name, MEDIA_ROOT=media.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.media = media.name
+
+        user = User.objects.create(uuid='alice')
+        chat = Chat.objects.create(name='chat', room_name='room', room_group_name='chat_room')
+        self.message = Message.objects.create(chat=chat, sender=user)
+        self.key = 'files/0123456789abcdef/a.txt'
+        self.file = File.objects.create(name='a.txt', size=5, message=self.message, status='pending')
+        os.makedirs(os.path.dirname(staged_path(self.key)))
+        with open(staged_path(self.key), 'wb') as staged:
+            staged.write(b'hello')
+
+    async def run_upload(self):
+        channel_layer = get_channel_layer()
+        channel = await channel_layer.new_channel()
+        await channel_layer.group_add('chat_room', channel)
+        await asyncio.to_thread(upload, 'file', self.file.id, self.message.id, self.key, 'chat_room')
+        return await channel_layer.receive(channel)
+
+    async def test_uploaded_file_becomes_ready(self):
+        event = await self.run_upload()
+        self.assertEqual((event['type'], event['status'], event['file_id']), ('file_ready', 'ready', self.file.id))
+        file_obj = await asyncio.to_thread(File.objects.get, id=self.file.id)
+        self.assertEqual(file_obj.status, 'ready')
+        with open(os.path.join(self.media, file_obj.file.name), 'rb') as stored:
+            self.assertEqual(stored.read(), b'hello')
+        self.assertFalse(os.path.exists(staged_path(self.key)))
+
+    async def test_failed_upload_keeps_the_staged_copy(self):
+        with mock.patch('apps.chat.uploads.default_storage.save', side_effect=OSError('storage down')):
+            event = await self.run_upload()
+        self.assertEqual((event['status'], event['url']), ('failed', None))
+        file_obj = await asyncio.to_thread(File.objects.get, id=self.file.id)
+        self.assertEqual(file_obj.status, 'failed')
+        self.assertTrue(os.path.exists(staged_path(self.key)))
+
+
+class StubRedis:
+    # The few sorted set commands ShardedRedisChannelLayer's group_add / group_send use
+
+    def __init__(self):
+        self.zsets = {}
+
+    async def zadd(self, key, score, member):
+        self.zsets.setdefault(key, {})[member] = score
+
+    async def expire(self, key, seconds):
+        pass
+
+    async def zremrangebyscore(self, key, min, max):
+        pass
+
+    async def zrange(self, key, start, stop):
+        return [member.encode() for member in self.zsets.get(key, {})]
+
+    def pipeline(self):
+        return StubPipeline()
+
+    async def eval(self, script, keys, args):
+        # channels_redis' group_send script: add to every key still under its capacity
+        over = 0
+        for i, key in enumerate(keys):
+            messages = self.zsets.setdefault(key, {})
+            if len(messages) < args[i + len(keys)]:
+                messages[args[i]] = args[-2]
+            else:
+                over += 1
+        return over
+
+
+class StubPipeline:
+    # Queued expiry trims, nothing expires within a test
+
+    def zremrangebyscore(self, key, min, max):
+        pass
+
+    async def execute(self):
+        pass
+
+
+class StubConnection:
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    async def __aenter__(self):
+        return self.redis
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+class ShardedChannelLayerTests(SimpleTestCase):
+
+    def layer(self, shards, **config):
+        layer = ShardedRedisChannelLayer(hosts=[f'redis://shard-{i}:6379' for i in range(shards)], **config)
+        layer.shards = [StubRedis() for _ in range(shards)]
+        layer.connection = lambda index: StubConnection(layer.shards[index])
+        return layer
+
+    def test_jump_hash_spreads_evenly_and_moves_little(self):
+        keys = range(20000)
+        before = [jump_hash(key, 4) for key in keys]
+        counts = [before.count(bucket) for bucket in range(4)]
+        self.assertTrue(all(4500 < count < 5500 for count in counts), counts)
+        after = [jump_hash(key, 5) for key in keys]
+        moved = [(old, new) for old, new in zip(before, after) if old != new]
+        # Only about 1 / 5 of the keys move, and only onto the new bucket
+        self.assertAlmostEqual(len(moved) / len(keys), 0.2, delta=0.02)
+        self.assertTrue(all(new == 4 for _, new in moved))
+
+    async def test_group_lives_on_its_shard(self):
+        layer = self.layer(3)
+        await layer.group_add('chat_room', 'socket-1')
+        group_key = layer._group_key('chat_room')
+        holders = [i for i, shard in enumerate(layer.shards) if group_key in shard.zsets]
+        self.assertEqual(holders, [layer.consistent_hash('chat_room')])
+
+    async def test_group_capacity_applies_per_pattern(self):
+        layer = self.layer(1, capacity=100, group_capacity={'chat_*': 2})
+        for channel in ('socket-1', 'socket-2'):
+            await layer.group_add('chat_room', channel)
+            await layer.group_add('inbox_alice', channel)
+        for i in range(3):
+            await layer.group_send('chat_room', {'type': 'chat_message', 'n': i})
+        for i in range(3):
+            await layer.group_send('inbox_alice', {'type': 'inbox_bump', 'n': i})
+        queued = layer.shards[0].zsets[layer.prefix + 'socket-1']
+        # The chat_* limit caps the socket's queue at two messages for chat events,
+        # inbox events still get the channel capacity
+        self.assertEqual(len(queued), 5)
+        events = [layer.deserialize(message) for message in queued]
+        self.assertEqual(sorted(event['type'] for event in events), ['chat_message'] * 2 + ['inbox_bump'] * 3)
+        self.assertTrue(all('event_id' in event for event in events))
+
+
+@override_settings(CACHES=LOCMEM_CACHES, POLL_VOTE_BROADCAST_WINDOW=0)
+class MessagePayloadTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(uuid='alice', username='alice')
+        self.chat = Chat.objects.create(name='chat', room_name='room', room_group_name='chat_room')
+        self.chat.participants.add(self.user)
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {access_token(self.user.uuid)}'
+
+    def send(self, content):
+        return self.client.post('/api/chat/send_message/', {
+            'roomName': 'room', 'roomGroupName': 'chat_room', 'message': content, 'mood': 'none', 'encryption': 'none',
+        })
+
+    def test_message_is_cached_and_broadcast_after_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            response, events = group_events('chat_room', lambda: self.send('hello'))
+        self.assertEqual(response.status_code, 200)
+        message = Message.objects.get(chat=self.chat)
+        self.assertEqual(events, [])
+        self.assertIsNone(cache.get(_payload_key(message.id, 0)))
+
+        _, events = group_events('chat_room', lambda: [callback() for callback in callbacks])
+        sent = [event for event in events if event['type'] == 'chat_message']
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(json.loads(sent[0]['payload'])['id'], message.id)
+        self.assertEqual(sent[0]['cursor'], encode_cursor(message))
+
+    def test_edits_and_votes_refresh_the_payload(self):
+        option = PollOption.objects.create(option='yes')
+        poll = Poll.objects.create(question='?')
+        poll.options.add(option)
+        message = Message.objects.create(chat=self.chat, sender=self.user, content='first', poll=poll)
+        first = get_message_payload(message)
+        self.assertEqual(get_message_payload(message), first)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            message.content = 'edited'
+            message.save()
+        edited = get_message_payload(message)
+        self.assertEqual(json.loads(edited)['content'], 'edited')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/chat/vote_poll/', {
+                'chat': self.chat.id, 'poll': poll.id, 'option': option.id,
+            }, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        voted = json.loads(get_message_payload(message))['poll']
+        self.assertEqual((voted['total_votes_count'], voted['options'][0]['votes_count']), ('1', '1'))
+        self.assertEqual([voter['uuid'] for voter in voted['voters']], ['alice'])
+
+
+@override_settings(CACHES=LOCMEM_CACHES, POLL_VOTE_BROADCAST_WINDOW=0)
+class PollVoteTests(TestCase):
+
+    def setUp(self):
+        self.users = [User.objects.create(uuid=uuid) for uuid in ('alice', 'bob')]
+        self.chat = Chat.objects.create(name='chat', room_name='room', room_group_name='chat_room')
+        self.chat.participants.add(*self.users)
+        self.yes, self.no = PollOption.objects.create(option='yes'), PollOption.objects.create(option='no')
+        self.poll = Poll.objects.create(question='?')
+        self.poll.options.add(self.yes, self.no)
+        Message.objects.create(chat=self.chat, sender=self.users[0], poll=self.poll)
+
+    def vote(self, user, option):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/api/chat/vote_poll/', {
+                'chat': self.chat.id, 'poll': self.poll.id, 'option': option.id,
+            }, content_type='application/json', HTTP_AUTHORIZATION=f'Bearer {access_token(user.uuid)}')
+
+    def counts(self):
+        return (
+            Poll.objects.get(id=self.poll.id).vote_count,
+            PollOption.objects.get(id=self.yes.id).vote_count,
+            PollOption.objects.get(id=self.no.id).vote_count,
+        )
+
+    def test_votes_bump_the_counters(self):
+        self.assertEqual(self.vote(self.users[0], self.yes).status_code, 200)
+        self.assertEqual(self.vote(self.users[1], self.no).status_code, 200)
+        self.assertEqual(self.counts(), (2, 1, 1))
+
+    def test_second_vote_of_a_user_is_rejected(self):
+        self.vote(self.users[0], self.yes)
+        response = self.vote(self.users[0], self.no)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.counts(), (1, 1, 0))
+        self.assertEqual(PollVote.objects.count(), 1)
+
+    def test_migration_links_legacy_votes(self):
+        # Before 0006 a vote only hung off PollOption.votes
+        legacy = [PollVote.objects.create(voter=self.users[0]) for _ in range(2)] + [PollVote.objects.create(voter=self.users[1])]
+        self.yes.votes.add(*legacy)
+        migration = importlib.import_module('apps.chat.migrations.0013_backfill_poll_votes')
+        migration.backfill_poll_votes(apps, None)
+        self.assertEqual(PollVote.objects.filter(poll=self.poll).count(), 2)
+        self.assertEqual(self.counts(), (2, 2, 0))
+        # The backfilled ballot now blocks a second vote
+        self.assertEqual(self.vote(self.users[0], self.no).status_code, 400)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, POLL_VOTE_BROADCAST_WINDOW=0.2)
+class PollBroadcastWindowTests(TransactionTestCase):
+    # The flush runs on its own thread and connection, so the votes have to be committed
+
+    def setUp(self):
+        cache.clear()
+        # Rows are recreated per test, fresh uuids keep views.user_pk_cache from pointing at old ones
+        self.users = [User.objects.create(uuid=f'{name}-{self._testMethodName}') for name in ('alice', 'bob', 'carol')]
+        self.chat = Chat.objects.create(name='chat', room_name='room', room_group_name='chat_room')
+        self.chat.participants.add(*self.users)
+        self.yes, self.no = PollOption.objects.create(option='yes'), PollOption.objects.create(option='no')
+        self.poll = Poll.objects.create(question='?')
+        self.poll.options.add(self.yes, self.no)
+        Message.objects.create(chat=self.chat, sender=self.users[0], poll=self.poll)
+
+    def vote(self, user, option):
+        return self.client.post('/api/chat/vote_poll/', {
+            'chat': self.chat.id, 'poll': self.poll.id, 'option': option.id,
+        }, content_type='application/json', HTTP_AUTHORIZATION=f'Bearer {access_token(user.uuid)}')
+
+    def test_votes_in_one_window_send_one_counts_event(self):
+        def vote_all():
+            return [self.vote(user, option).status_code for user, option in zip(self.users, (self.yes, self.yes, self.no))]
+
+        statuses, events = group_events('chat_room', vote_all, idle=0.5)
+        self.assertEqual(statuses, [200, 200, 200])
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]['type'], 'poll_counts')
+        self.assertEqual(events[0]['total_votes_count'], 3)
+        self.assertEqual(
+            sorted((option['id'], option['votes_count']) for option in events[0]['options']),
+            [(self.yes.id, 2), (self.no.id, 1)],
+        )
+
+    def test_next_window_sends_again(self):
+        _, first = group_events('chat_room', lambda: self.vote(self.users[0], self.yes), idle=0.5)
+        _, second = group_events('chat_room', lambda: self.vote(self.users[1], self.no), idle=0.5)
+        self.assertEqual([event['total_votes_count'] for event in first + second], [1, 2])
+
+
+class FailingPresenceStore(InMemoryPresenceStore):
+
+    def touch(self, room, kind, user_ids, expires_at):
+        raise RedisError('down')
+
+
+@override_settings(PRESENCE_PERSIST_INTERVAL=0, PRESENCE_TTL=30)
+class PresenceServiceTests(TransactionTestCase):
+    # The tick is driven by hand, the service's own loop would sleep PRESENCE_TICK
+
+    def setUp(self):
+        self.store = InMemoryPresenceStore()
+        self.service = PresenceService(self.store)
+        self.service.ensure_started = lambda: None
+
+    async def tick(self):
+        # Runs one tick with a channel in the room group, returns the presence diffs it sent
+        channel_layer = get_channel_layer()
+        channel = await channel_layer.new_channel()
+        await channel_layer.group_add('chat_room', channel)
+        await self.service.tick()
+        diffs = []
+        while True:
+            try:
+                diffs.append(await asyncio.wait_for(channel_layer.receive(channel), 0.1))
+            except asyncio.TimeoutError:
+                break
+        await channel_layer.group_discard('chat_room', channel)
+        return [{key: diff[key] for key in ('online', 'offline', 'joined_call', 'left_call')} for diff in diffs]
+
+    async def test_second_socket_of_a_user_sends_no_diff(self):
+        await self.service.connect('room', 'chat_room', 'alice')
+        await self.service.connect('room', 'chat_room', 'alice')
+        self.assertEqual(await self.tick(), [{'online': ['alice'], 'offline': [], 'joined_call': [], 'left_call': []}])
+
+        await self.service.disconnect('room', 'alice')
+        self.assertEqual(await self.tick(), [])
+        self.assertEqual(await self.service.snapshot('room'), [{'uuid': 'alice', 'is_online': True, 'is_in_call': False}])
+
+        await self.service.disconnect('room', 'alice')
+        self.assertEqual(await self.tick(), [{'online': [], 'offline': ['alice'], 'joined_call': [], 'left_call': []}])
+        self.assertEqual(await self.service.snapshot('room'), [])
+        # The room is forgotten once its last diff went out
+        self.assertNotIn('room', self.service.groups)
+
+    async def test_diffs_are_batched_per_tick(self):
+        await self.service.connect('room', 'chat_room', 'alice')
+        await self.service.connect('room', 'chat_room', 'bob')
+        await self.service.join_call('room', 'bob')
+        await self.service.disconnect('room', 'alice')
+        # Alice joined and left within the tick, the last state wins
+        self.assertEqual(await self.tick(), [{'online': ['bob'], 'offline': ['alice'], 'joined_call': ['bob'], 'left_call': []}])
+        self.assertEqual(await self.service.snapshot('room'), [{'uuid': 'bob', 'is_online': True, 'is_in_call': True}])
+
+    async def test_leaving_the_room_leaves_the_call(self):
+        await self.service.connect('room', 'chat_room', 'alice')
+        await self.service.join_call('room', 'alice')
+        await self.tick()
+        await self.service.disconnect('room', 'alice')
+        self.assertEqual(await self.tick(), [{'online': [], 'offline': ['alice'], 'joined_call': [], 'left_call': ['alice']}])
+
+    async def test_members_of_a_dead_worker_expire(self):
+        await self.service.connect('room', 'chat_room', 'alice')
+        await self.tick()
+        # Bob's worker stopped heartbeating, his member ran out
+        self.store.touch('room', PresenceService.ONLINE, ['bob'], time.time() - 1)
+        # Heartbeats run every PRESENCE_TTL / 3, make the next tick one
+        self.service._last_heartbeat = 0
+        self.assertEqual(await self.tick(), [{'online': [], 'offline': ['bob'], 'joined_call': [], 'left_call': []}])
+
+    async def test_online_state_is_persisted_in_batches(self):
+        await asyncio.to_thread(lambda: [User.objects.create(uuid=uuid) for uuid in ('alice', 'bob')])
+        await self.service.connect('room', 'chat_room', 'alice')
+        await self.service.connect('room', 'chat_room', 'bob')
+        await self.service.join_call('room', 'bob')
+        await self.tick()
+        users = await asyncio.to_thread(lambda: dict(User.objects.values_list('uuid', 'is_in_call')))
+        self.assertEqual(users, {'alice': False, 'bob': True})
+        online = await asyncio.to_thread(lambda: set(User.objects.filter(is_online=True).values_list('uuid', flat=True)))
+        self.assertEqual(online, {'alice', 'bob'})
+
+    async def test_store_errors_do_not_fail_the_socket(self):
+        self.service = PresenceService(FailingPresenceStore())
+        self.service.ensure_started = lambda: None
+        await self.service.connect('room', 'chat_room', 'alice')
+        self.assertEqual(self.service.errors, 1)
+        # The diff still goes out, the next heartbeat re-adds the member
+        self.assertEqual(await self.tick(), [{'online': ['alice'], 'offline': [], 'joined_call': [], 'left_call': []}])
+
+    def test_merged_diff_applies_both_in_order(self):
+        previous = {'online': ['alice', 'bob'], 'offline': ['carol'], 'joined_call': ['bob'], 'left_call': []}
+        data = {'type': 'presence_diff', 'online': ['carol'], 'offline': ['bob'], 'joined_call': [], 'left_call': ['bob']}
+        self.assertEqual(merge_diffs(previous, data), {
+            'type': 'presence_diff',
+            'online': ['alice', 'carol'],
+            'offline': ['bob'],
+            'joined_call': [],
+            'left_call': ['bob'],
+        })
+
+
+@override_settings(ICE_BATCH_WINDOW=0.05)
+class VideoCallConsumerTests(SimpleTestCase):
+    # Call membership lives in the in-memory registry, each test uses its own room
+
+    async def join(self, room, user_id):
+        communicator = WebsocketCommunicator(application, f'/ws/call/{room}/?token={access_token(user_id)}')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(json.loads(await communicator.receive_from(5))['type'], 'update_users_list')
+        return communicator
+
+    async def receive(self, communicator):
+        return json.loads(await communicator.receive_from(5))
+
+    async def test_peers_get_the_delta_only_for_a_users_first_socket(self):
+        alice = await self.join('call-delta', 'alice')
+        bob = await self.join('call-delta', 'bob')
+        self.assertEqual(await self.receive(alice), {'type': 'user_joined_call', 'user_id': 'bob'})
+        second = await self.join('call-delta', 'bob')
+        self.assertTrue(await alice.receive_nothing(0.1))
+
+        await second.disconnect()
+        self.assertTrue(await alice.receive_nothing(0.1))
+        await bob.disconnect()
+        self.assertEqual(await self.receive(alice), {'type': 'user_left_call', 'user_id': 'bob'})
+        await alice.disconnect()
+
+    async def test_ice_candidates_are_batched_per_target(self):
+        alice = await self.join('call-ice', 'alice')
+        bob = await self.join('call-ice', 'bob')
+        await self.receive(alice)
+        for candidate in ('c1', 'c2', 'c3'):
+            await alice.send_json_to({'type': 'ice_candidate', 'candidate': candidate, 'to_user_id': 'bob'})
+        self.assertEqual(await self.receive(bob), {'type': 'ice_candidates', 'candidates': ['c1', 'c2', 'c3'], 'from_user_id': 'alice'})
+        self.assertTrue(await bob.receive_nothing(0.1))
+
+        # A lone candidate keeps the single candidate frame
+        await alice.send_json_to({'type': 'ice_candidate', 'candidate': 'c4', 'to_user_id': 'bob'})
+        self.assertEqual(await self.receive(bob), {'type': 'ice_candidate', 'candidate': 'c4', 'from_user_id': 'alice'})
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_pending_candidates_are_flushed_on_disconnect(self):
+        alice = await self.join('call-flush', 'alice')
+        bob = await self.join('call-flush', 'bob')
+        await self.receive(alice)
+        with override_settings(ICE_BATCH_WINDOW=60):
+            await alice.send_json_to({'type': 'ice_candidate', 'candidate': 'c1', 'to_user_id': 'bob'})
+            self.assertTrue(await bob.receive_nothing(0.1))
+            await alice.disconnect()
+        self.assertEqual(await self.receive(bob), {'type': 'ice_candidate', 'candidate': 'c1', 'from_user_id': 'alice'})
+        await bob.disconnect()
+
+    async def test_invalid_or_missing_token_is_refused(self):
+        for query in ('token=bad', 'user=alice', f'user=alice&token={access_token("alice")}x'):
+            communicator = WebsocketCommunicator(application, f'/ws/call/call-refused/?{query}')
+            connected, _ = await communicator.connect()
+            self.assertFalse(connected)
+
+    async def test_signalling_goes_to_the_target_only(self):
+        alice = await self.join('call-peer', 'alice')
+        bob = await self.join('call-peer', 'bob')
+        carol = await self.join('call-peer', 'carol')
+        # Skip the joined deltas
+        for communicator in (alice, alice, bob):
+            await self.receive(communicator)
+
+        await alice.send_json_to({'type': 'offer', 'offer': 'sdp', 'to_user_id': 'bob'})
+        self.assertEqual(await self.receive(bob), {'type': 'offer', 'offer': 'sdp', 'from_user_id': 'alice'})
+        await bob.send_json_to({'type': 'answer', 'answer': 'sdp', 'to_user_id': 'alice'})
+        self.assertEqual(await self.receive(alice), {'type': 'answer', 'answer': 'sdp', 'from_user_id': 'bob', 'to_user_id': 'alice'})
+        self.assertTrue(await carol.receive_nothing(0.1))
+
+        # No target: the whole room gets it
+        await alice.send_json_to({'type': 'offer', 'offer': 'sdp'})
+        self.assertEqual((await self.receive(bob))['from_user_id'], 'alice')
+        self.assertEqual((await self.receive(carol))['from_user_id'], 'alice')
+        for communicator in (alice, bob, carol):
+            await communicator.disconnect()
+
+
+class RoomNameMigrationTests(TransactionTestCase):
+    # 0007 makes Chat.room_name unique, run it against rows written before
+
+    def migrate(self, target):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate([('chat', target)])
+        return executor.loader.project_state([('chat', target)]).apps
+
+    def setUp(self):
+        latest = MigrationExecutor(connection).loader.graph.leaf_nodes('chat')[0][1]
+        self.addCleanup(self.migrate, latest)
+        self.old_apps = self.migrate('0006_poll_vote_counters')
+
+    def test_blank_room_names_become_null(self):
+        Chat = self.old_apps.get_model('chat', 'Chat')
+        Chat.objects.create(name='a', room_name='')
+        Chat.objects.create(name='b', room_name='')
+        Chat.objects.create(name='c', room_name='room')
+        new_apps = self.migrate('0007_hot_path_indexes')
+        Chat = new_apps.get_model('chat', 'Chat')
+        self.assertEqual(sorted(Chat.objects.values_list('name', 'room_name')), [('a', None), ('b', None), ('c', 'room')])
+
+    def test_duplicate_room_names_stop_the_migration(self):
+        Chat = self.old_apps.get_model('chat', 'Chat')
+        Chat.objects.create(name='a', room_name='room')
+        Chat.objects.create(name='b', room_name='room')
+        with self.assertRaisesMessage(RuntimeError, 'used by more than one chat, rename or merge them and migrate again: room'):
+            self.migrate('0007_hot_path_indexes')
+        Chat.objects.filter(name='b').update(room_name='room-b')
+        self.migrate('0007_hot_path_indexes')
+
+
+@override_settings(MESSAGE_EXPORT_CHUNK_SIZE=2)
+class ExportMessagesTests(TransactionTestCase):
+    # Served by ExportMessagesConsumer on the http router, not by a Django view
+
+    def setUp(self):
+        self.user = User.objects.create(uuid='alice', username='alice')
+        self.chat = Chat.objects.create(name='chat', room_name='room', room_group_name='chat_room')
+        self.chat.participants.add(self.user)
+        Message.objects.bulk_create([Message(chat=self.chat, sender=self.user, content=f'message {i}') for i in range(5)])
+        self.messages = list(self.chat.messages.order_by('timestamp', 'id'))
+
+    def export(self, path='/api/chat/export/room/chat_room/', token=None):
+        token = access_token(self.user.uuid) if token is None else token
+        headers = [(b'authorization', f'Bearer {token}'.encode())] if token else []
+        return async_to_sync(HttpCommunicator(application, 'GET', path, headers=headers).get_response)(5)
+
+    def lines(self, response):
+        return [json.loads(line) for line in response['body'].decode().splitlines()]
+
+    def test_history_is_streamed_in_chunks(self):
+        response = self.export()
+        self.assertEqual(response['status'], 200)
+        self.assertIn((b'Content-Type', b'application/x-ndjson'), response['headers'])
+        self.assertEqual([line['content'] for line in self.lines(response)], [f'message {i}' for i in range(5)])
+
+    def test_after_resumes_from_a_cursor(self):
+        response = self.export(f'/api/chat/export/room/chat_room/?after={encode_cursor(self.messages[2])}')
+        self.assertEqual([line['id'] for line in self.lines(response)], [message.id for message in self.messages[3:]])
+        self.assertEqual(self.export('/api/chat/export/room/chat_room/?after=bad')['status'], 400)
+
+    def test_empty_chat_exports_nothing(self):
+        Chat.objects.create(name='empty', room_name='empty', room_group_name='chat_empty').participants.add(self.user)
+        response = self.export('/api/chat/export/empty/chat_empty/')
+        self.assertEqual((response['status'], response['body']), (200, b''))
+
+    def test_access_is_checked_like_the_rest_views(self):
+        self.assertEqual(self.export(token='')['status'], 401)
+        response = self.export(token='bad')
+        self.assertEqual(response['status'], 401)
+        self.assertEqual(json.loads(response['body']), {'success': False, 'status': 401, 'error': 'Token is invalid.'})
+        # A ?token= in the query is not a credential for the REST views either
+        self.assertEqual(self.export(f'/api/chat/export/room/chat_room/?token={access_token("alice")}', token='')['status'], 401)
+        self.assertEqual(self.export('/api/chat/export/missing/chat_room/')['status'], 404)
+        User.objects.create(uuid='bob', username='bob')
+        response = self.export(token=access_token('bob'))
+        self.assertEqual(response['status'], 403)
+        self.assertEqual(json.loads(response['body'])['error'], 'You do not have access to this chat')
+
+    def test_load_export_chunk_pages_on_the_cursor(self):
+        lines, cursor = load_export_chunk(self.chat.id, count=3)
+        self.assertEqual([json.loads(line)['id'] for line in lines], [message.id for message in self.messages[:3]])
+        lines, cursor = load_export_chunk(self.chat.id, cursor, count=3)
+        self.assertEqual(len(lines), 2)
+        # Exhausted: no lines, the cursor stays where it was
+        self.assertEqual(load_export_chunk(self.chat.id, cursor, count=3), ([], cursor))
+        self.assertEqual(load_export_chunk(self.chat.id + 1), ([], None))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class InboxEventTests(TestCase):
+    # What lands in a user's inbox_<uuid> group, only once the request's transaction committed
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create(uuid='alice', username='alice')
+        self.bob = User.objects.create(uuid='bob', username='bob')
+        self.chat = Chat.objects.create(name='chat', room_name='room', room_group_name='chat_room')
+        self.chat.participants.add(self.alice, self.bob)
+        add_participants(self.chat, [self.alice.id, self.bob.id])
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {access_token(self.alice.uuid)}'
+
+    def send(self, content):
+        return self.client.post('/api/chat/send_message/', {
+            'roomName': 'room', 'roomGroupName': 'chat_room', 'message': content, 'mood': 'none', 'encryption': 'none',
+        })
+
+    def test_new_message_bumps_and_counts_after_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            response, events = group_events('inbox_bob', lambda: self.send('hello'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(events, [])
+
+        _, events = group_events('inbox_bob', lambda: [callback() for callback in callbacks])
+        message = Message.objects.get(chat=self.chat)
+        by_type = {event['type']: event for event in events}
+        self.assertEqual(sorted(by_type), ['inbox_bump', 'unread_changed'])
+        self.assertEqual(
+            {key: by_type['inbox_bump'][key] for key in ('chat_id', 'message_id', 'last_message', 'last_message_sender')},
+            {'chat_id': self.chat.id, 'message_id': message.id, 'last_message': 'hello', 'last_message_sender': 'alice'},
+        )
+        self.assertEqual((by_type['unread_changed']['chat_id'], by_type['unread_changed']['unread_count']), (self.chat.id, 1))
+
+    def test_sender_is_bumped_but_not_counted(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.send('hello')
+        _, events = group_events('inbox_alice', lambda: [callback() for callback in callbacks])
+        self.assertEqual([event['type'] for event in events], ['inbox_bump'])
+
+    def test_new_conversation_is_upserted_into_both_inboxes(self):
+        def start():
+            with self.captureOnCommitCallbacks() as callbacks:
+                response = self.client.post('/api/chat/start_conversation/', {
+                    'to_user': 'carol', 'to_user_username': 'carol', 'from_user_username': 'alice',
+                })
+            return response, callbacks
+
+        (response, callbacks), events = group_events('inbox_carol', start)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(events, [])
+        for group in ('inbox_alice', 'inbox_carol'):
+            _, events = group_events(group, lambda: [callback() for callback in callbacks])
+            self.assertEqual([event['type'] for event in events], ['inbox_upsert'])
+            self.assertEqual(events[0]['chat']['room_name'], response.json()['results']['room_name'])
+
+        # Starting it again finds the chat, nobody's inbox changes
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post('/api/chat/start_conversation/', {
+                'to_user': 'carol', 'to_user_username': 'carol', 'from_user_username': 'alice',
+            })
+        self.assertEqual(callbacks, [])
+
+
+class DatabaseExecutorTests(SimpleTestCase):
+
+    async def test_queued_counts_calls_waiting_for_a_thread(self):
+        executor = DatabaseExecutor(1)
+        self.addCleanup(executor.pool.shutdown)
+        release = threading.Event()
+        running = asyncio.ensure_future(executor.run(release.wait, 5))
+        waiting = [asyncio.ensure_future(executor.run(lambda: None)) for _ in range(2)]
+        await asyncio.sleep(0.1)
+        self.assertEqual(executor.metrics()['queued'], 2)
+
+        # A call cancelled before a thread picked it up leaves the queue
+        waiting[0].cancel()
+        await asyncio.sleep(0.1)
+        self.assertEqual(executor.metrics()['queued'], 1)
+
+        release.set()
+        await running
+        await waiting[1]
+        metrics = executor.metrics()
+        self.assertEqual((metrics['queued'], metrics['calls'], metrics['errors']), (0, 2, 0))
+
+
+class CodecNegotiationTests(SimpleTestCase):
+
+    def scope(self, subprotocols=(), query=b''):
+        return {'subprotocols': list(subprotocols), 'query_string': query}
+
+    def test_offered_subprotocol_wins(self):
+        self.assertEqual(negotiate(self.scope(['msgpack', 'json'])), (codecs['msgpack'], 'msgpack'))
+        self.assertEqual(negotiate(self.scope(['json', 'msgpack'])), (codecs['json'], 'json'))
+        self.assertEqual(negotiate(self.scope(['msgpack'], b'codec=json')), (codecs['msgpack'], 'msgpack'))
+
+    def test_unknown_subprotocols_are_skipped(self):
+        self.assertEqual(negotiate(self.scope(['v2.chat', 'msgpack'])), (codecs['msgpack'], 'msgpack'))
+        # Nothing known offered: JSON, and no subprotocol is accepted
+        self.assertEqual(negotiate(self.scope(['v2.chat'])), (codecs['json'], None))
+        self.assertEqual(negotiate(self.scope(['v2.chat'], b'codec=msgpack')), (codecs['msgpack'], None))
+        self.assertEqual(negotiate(self.scope(query=b'codec=cbor')), (codecs['json'], None))
+
+    @override_settings(WEBSOCKET_CODECS=['json'])
+    def test_disabled_codecs_are_not_picked(self):
+        self.assertEqual(negotiate(self.scope(['msgpack'], b'codec=msgpack')), (codecs['json'], None))
+
+    def test_raw_json_is_spliced_or_converted(self):
+        raw = RawJSON('{"id": 1, "content": "hello"}')
+        self.assertEqual(codecs['json'].encode(raw), raw)
+        self.assertEqual(codecs['msgpack'].decode(codecs['msgpack'].encode(raw)), {'id': 1, 'content': 'hello'})
+        # Text frames on a msgpack socket are read as JSON
+        self.assertEqual(codecs['msgpack'].decode('{"type": "offer"}'), {'type': 'offer'})
+
+    async def connect(self, room, user_id, subprotocols):
+        communicator = WebsocketCommunicator(application, f'/ws/call/{room}/?token={access_token(user_id)}', subprotocols=subprotocols)
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator, subprotocol
+
+    async def test_sockets_get_frames_in_their_codec(self):
+        json_socket, accepted = await self.connect('codec-room', 'alice', ['v2.chat'])
+        self.assertIsNone(accepted)
+        self.assertEqual(json.loads(await json_socket.receive_from(5))['type'], 'update_users_list')
+
+        msgpack_socket, accepted = await self.connect('codec-room', 'bob', ['v2.chat', 'msgpack'])
+        self.assertEqual(accepted, 'msgpack')
+        frame = await msgpack_socket.receive_output(5)
+        self.assertEqual(codecs['msgpack'].decode(frame['bytes'])['type'], 'update_users_list')
+        self.assertEqual(json.loads(await json_socket.receive_from(5)), {'type': 'user_joined_call', 'user_id': 'bob'})
+
+        # Both directions in MessagePack
+        await msgpack_socket.send_to(bytes_data=codecs['msgpack'].encode({'type': 'offer', 'offer': 'sdp', 'to_user_id': 'alice'}))
+        self.assertEqual(json.loads(await json_socket.receive_from(5)), {'type': 'offer', 'offer': 'sdp', 'from_user_id': 'bob'})
+        await json_socket.send_json_to({'type': 'answer', 'answer': 'sdp', 'to_user_id': 'bob'})
+        frame = await msgpack_socket.receive_output(5)
+        self.assertEqual(codecs['msgpack'].decode(frame['bytes'])['from_user_id'], 'alice')
+        await json_socket.disconnect()
+        await msgpack_socket.disconnect()
+
+
+@override_settings(CHAT_SNAPSHOT_BUDGET=10)
+class ChatSnapshotTests(SimpleTestCase):
+
+    def setUp(self):
+        self.snapshots = ChatSnapshots(2)
+        self.base = {
+            'id': 1, 'room_name': 'room', 'name': 'chat', 'last_message': 'x' * 200,
+            'participants': [{'uuid': 'alice', 'username': 'alice'}, {'uuid': 'bob', 'username': 'bob'}],
+            'stream': [],
+        }
+        self.size, self.digest = describe(self.base)
+        self.snapshots.add(self.digest, self.base)
+        self.chat = dict(
+            self.base, name='renamed',
+            participants=[{'uuid': 'alice', 'username': 'alice2'}, {'uuid': 'carol', 'username': 'carol'}],
+        )
+
+    def frame(self, base_digest, compact=True):
+        size, digest = describe(self.chat)
+        return self.snapshots.frame_fields(self.chat, size, digest, base_digest, compact)
+
+    def test_opted_in_socket_gets_a_diff_against_its_base(self):
+        fields, variant = self.frame(self.digest)
+        self.assertEqual(variant, f'diff:{self.digest}')
+        self.assertEqual(fields['chat_diff'], {
+            'id': 1, 'room_name': 'room', 'name': 'renamed',
+            'participants': {'upsert': [{'uuid': 'alice', 'username': 'alice2'}, {'uuid': 'carol', 'username': 'carol'}], 'remove': ['bob']},
+            'base': self.digest, 'digest': describe(self.chat)[1],
+        })
+        # Sockets on the same base share the diff
+        self.assertIs(self.frame(self.digest)[0]['chat_diff'], fields['chat_diff'])
+        self.assertEqual(self.snapshots.metrics()['diffs'], 2)
+        self.assertGreater(self.snapshots.metrics()['bytes_saved'], 0)
+
+    def test_diff_larger_than_the_snapshot_is_not_sent(self):
+        self.chat = dict(self.chat, last_message='y')
+        fields, variant = self.frame(self.digest)
+        self.assertEqual((fields, variant), ({'chat': self.chat, 'chat_digest': describe(self.chat)[1]}, None))
+
+    def test_missing_base_falls_back_to_the_full_snapshot(self):
+        fields, variant = self.frame('0123456789abcdef')
+        self.assertEqual(fields, {'chat': self.chat, 'chat_digest': describe(self.chat)[1]})
+        self.assertIsNone(variant)
+
+        # The base was evicted by newer snapshots
+        for name in ('a', 'b'):
+            chat = dict(self.base, name=name)
+            self.snapshots.add(describe(chat)[1], chat)
+        self.assertIsNone(self.snapshots.get(self.digest))
+        self.assertIn('chat', self.frame(self.digest)[0])
+        self.assertEqual(self.snapshots.metrics()['full'], 2)
+
+    def test_full_snapshot_without_opt_in_or_under_budget(self):
+        self.assertEqual(self.frame(self.digest, compact=False)[0]['chat'], self.chat)
+        with override_settings(CHAT_SNAPSHOT_BUDGET=0):
+            self.assertEqual(self.frame(self.digest)[0]['chat'], self.chat)
+        with override_settings(CHAT_SNAPSHOT_BUDGET=10 ** 6):
+            self.assertEqual(self.frame(self.digest)[0]['chat'], self.chat)
+        # The new snapshot is kept, it's the next frame's base
+        self.assertEqual(self.snapshots.get(describe(self.chat)[1]), self.chat)
+
+    def test_compact_page_shares_one_users_table(self):
+        stream = {'id': 7, 'user': {'uuid': 'dave', 'username': 'dave'}}
+        chats, users = compact_chats([self.base, dict(self.chat, stream=[stream])])
+        self.assertEqual([chat['participants'] for chat in chats], [['alice', 'bob'], ['alice', 'carol']])
+        self.assertEqual(chats[1]['stream'], [{'id': 7, 'user': 'dave'}])
+        self.assertEqual(sorted(users), ['alice', 'bob', 'carol', 'dave'])
+        # The latest version of a user wins
+        self.assertEqual(users['alice']['username'], 'alice2')
+
+    def test_compact_is_opt_in(self):
+        self.assertTrue(wants_compact({'query_string': b'token=x&compact=1'}))
+        self.assertTrue(wants_compact({'query_string': b'compact=true'}))
+        self.assertFalse(wants_compact({'query_string': b'compact=0'}))
+        self.assertFalse(wants_compact({}))
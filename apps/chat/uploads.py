@@ -0,0 +1,103 @@
+import os
+import posixpath
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.files import File as DjangoFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+
+from .message_cache import invalidate_message_payload
+from .models import File, Message
+
+# Uploads outlive the request, so they get their own small pool
+executor = ThreadPoolExecutor(max_workers=settings.UPLOAD_WORKERS, thread_name_prefix='chat-upload')
+
+
+def staged_path(key):
+    return os.path.join(settings.UPLOAD_STAGING_DIR, key)
+
+
+def build_key(name, upload_to):
+    prefix = posixpath.join(upload_to, uuid.uuid4().hex[:16], '')
+    # Keep the key within the FileField's 100 characters, extension included
+    root, ext = os.path.splitext(os.path.basename(name))
+    return prefix + root[:max(1, 100 - len(prefix) - len(ext))] + ext
+
+
+def stage(uploaded, upload_to):
+    """
+    Copies an uploaded file to the local staging dir and returns the storage
+    key it will be written to. Nothing leaves the machine during the request.
+    """
+    key = build_key(uploaded.name, upload_to)
+    path = staged_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as staged:
+        for chunk in uploaded.chunks():
+            staged.write(chunk)
+    return key
+
+
+def stage_file(message, uploaded):
+    # Same as File.objects.create(file=uploaded), but the content is uploaded later
+    file_obj = File(
+        name=uploaded.name,
+        size=uploaded.size,
+        mime_type=uploaded.content_type,
+        message=message,
+        status='pending',
+    )
+    file_obj.file.name = stage(uploaded, File._meta.get_field('file').upload_to)
+    file_obj.save()
+    schedule(message, 'file', file_obj.id, file_obj.file.name)
+    return file_obj
+
+
+def stage_voice_message(message, uploaded):
+    message.voice_message.name = stage(uploaded, '')
+    message.voice_message_status = 'pending'
+    message.save(update_fields=['voice_message', 'voice_message_status'])
+    schedule(message, 'voice_message', message.id, message.voice_message.name)
+
+
+def schedule(message, kind, object_id, key):
+    # Only once the rows are committed, the worker reads and updates them
+    group_name = f'chat_{message.chat.room_name}'
+    transaction.on_commit(lambda: executor.submit(upload, kind, object_id, message.id, key, group_name))
+
+
+def upload(kind, object_id, message_id, key, group_name):
+    path = staged_path(key)
+    try:
+        with open(path, 'rb') as staged:
+            name = default_storage.save(key, DjangoFile(staged))
+        status = 'ready'
+    except Exception as e:
+        print(f'Upload of {key} failed: {e}')
+        name, status = key, 'failed'
+
+    try:
+        if kind == 'file':
+            File.objects.filter(id=object_id).update(file=name, status=status)
+        else:
+            Message.objects.filter(id=object_id).update(voice_message=name, voice_message_status=status)
+        invalidate_message_payload(message_id)
+
+        async_to_sync(get_channel_layer().group_send)(group_name, {
+            'type': 'file_ready',
+            'message_id': message_id,
+            'file_id': object_id if kind == 'file' else None,
+            'field': kind,
+            'status': status,
+            'url': default_storage.url(name) if status == 'ready' else None,
+        })
+    finally:
+        # A failed upload keeps its staged copy so resume_uploads can retry it
+        if status == 'ready':
+            os.remove(path)
+            os.rmdir(os.path.dirname(path))
+        connection.close()
@@ -5,8 +5,13 @@ app_name = "chat"
 
 urlpatterns = [
     path('start_conversation/', StartConversationView.as_view()),
+    path('inbox/', InboxView.as_view()),
     path('send_message/', SendMessageView.as_view()),
     path('load_conversation/<str:room_name>/<str:room_group_name>/', LoadConversationView.as_view()),
     path('load_conversation_messages/<str:room_name>/<str:room_group_name>/', LoadMessagesView.as_view()),
+    path('mark_read/', MarkReadView.as_view()),
+    path('uploads/presign/', PresignUploadView.as_view()),
+    path('uploads/confirm/', ConfirmUploadView.as_view()),
+    path('uploads/local/<str:token>/', LocalUploadView.as_view(), name='local_upload'),
     path('vote_poll/', VotePollView.as_view()),
 ]
\ No newline at end of file
@@ -6,15 +6,33 @@ from rest_framework.exceptions import ValidationError
 from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
 from django.db.models.query_utils import Q
 from django.db.models import F
+from django.db import IntegrityError, transaction
 from rest_framework_api.views import StandardAPIView
+from rest_framework_api.pagination import CustomPagination
+from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
 import base64
 import binascii
 import bleach
 from core.producer import producer
+from core.authentication import LRUCache, verify_token
 from .serializers import *
+from .counters import count_unread, mark_read
+from .inbox import get_inbox_page, parse_cursor, send_inbox_bump, send_inbox_upsert, INBOX_PAGE_SIZE
+from .history import encode_cursor, get_message_page, parse_cursor as parse_message_cursor, read_watermarks
+from .message_cache import get_message_payload, get_message_payloads, invalidate_message_payload
+from .poll_broadcast import schedule_poll_counts
+from .conversations import get_or_create_direct_chat
+from .uploads import build_key, stage_file, stage_voice_message
+from core.storage_backends import get_direct_upload
+from django.core import signing
+from django.core.cache import cache
+from django.core.files import File as DjangoFile
+from django.core.files.storage import default_storage
+from django.core.handlers.wsgi import LimitedStream
 import uuid
 import requests
+import time
 import json
 import jwt
 from django.conf import settings
@@ -24,10 +42,14 @@ from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 
 def validate_token(request):
+    # CachedJWTAuthentication already verified the header, reuse its claims
+    if isinstance(request.auth, dict):
+        return request.auth
+
     token = request.META.get('HTTP_AUTHORIZATION').split()[1]
 
     try:
-        payload = jwt.decode(token, secret_key, algorithms=['HS256'])
+        payload = verify_token(token)
     except jwt.ExpiredSignatureError:
         return Response({"error": "Token has expired."}, status=status.HTTP_401_UNAUTHORIZED)
     except jwt.DecodeError:
@@ -38,6 +60,17 @@ def validate_token(request):
     return payload
 
 
+# uuid -> primary key, kept for USER_PK_CACHE_TTL so deleted or re-created users are picked up
+user_pk_cache = LRUCache(settings.JWT_CACHE_SIZE)
+
+def get_user_pk(user_id):
+    pk = user_pk_cache.get(user_id)
+    if pk is None:
+        pk = get_object_or_404(User.objects.values_list('pk', flat=True), uuid=user_id)
+        user_pk_cache.set(user_id, pk, time.time() + settings.USER_PK_CACHE_TTL)
+    return pk
+
+
 ALLOWED_TAGS = [    'a', 'abbr', 'acronym', 'b', 'blockquote', 'br', 'code', 'div', 'em', 'hr', 'i', 'li', 'ol', 'p', 'pre', 'span', 'strong', 'ul']
 ALLOWED_ATTRIBUTES = {
     '*': ['style', 'class'],
@@ -63,33 +96,34 @@ def process_message(message):
 
 
 
+def publish_message_created(message, chat, user_id):
+    # Published once the request's transaction commits, never for rolled back rows
+    transaction.on_commit(lambda: producer.publish('message_created', {
+        'message_id': message.id,
+        'chat_id': chat.id,
+        'room_name': chat.room_name,
+        'sender': user_id,
+        'timestamp': message.timestamp,
+    }))
+
+
+class RawJSONAPIView(StandardAPIView):
+    # StandardAPIView's envelope around results that are already JSON text
+    # (cached message payloads), spliced in as is instead of decoded and rendered again
+
+    def send_raw_json_response(self, results, status=status.HTTP_200_OK, **envelope):
+        # envelope: fields between "status" and "results", in paginate_response's order
+        fields = ''.join(', %s: %s' % (json.dumps(key), json.dumps(value)) for key, value in envelope.items())
+        body = '{"success": true, "status": %d%s, "results": [%s]}' % (status, fields, ', '.join(results))
+        return HttpResponse(body, status=status, content_type='application/json')
+
+
 class StartConversationView(StandardAPIView):
     permission_classes = (permissions.AllowAny,)
 
-    def get_inboxes(self, user_id, start=0, count=20):
-        chats = Chat.objects.filter(participants__uuid=user_id).order_by('-created_at').prefetch_related('participants')[start:start+count]
-        serialized_chats = ChatSerializer(chats, many=True).data
-        serialized_chats = self._add_participants_to_serialized_chats(serialized_chats)
-        return serialized_chats
-
-    def _add_participants_to_serialized_chats(self, serialized_chats):
-            user_ids = set()
-            for chat in serialized_chats:
-                for participant in chat['participants']:
-                    user_ids.add(participant['uuid'])
-            
-            users = User.objects.filter(uuid__in=user_ids)
-            user_map = {user.uuid: user for user in users}
-            
-            for chat in serialized_chats:
-                chat['participants'] = [UserSerializer(user_map[participant['uuid']]).data for participant in chat['participants']]
-            
-            return serialized_chats
-
     def post(self, request, format=None):
         payload = validate_token(request)
         data = self.request.data
-        uuid_str = str(uuid.uuid4())
 
         # Participants
         to_user = str(data['to_user'])
@@ -98,52 +132,34 @@ class StartConversationView(StandardAPIView):
         from_user = str(payload['user_id'])
         from_user_username = str(data['from_user_username'])
 
-        # Check if a chat already exists between the two users
-        chats = Chat.objects.filter(participants__uuid=from_user).filter(participants__uuid=to_user)
-        if chats.exists():
-            chat = chats.first()
-        else:
-            # Room and group name
-            name = 'conversation'
-            room_name = uuid_str
-            room_group_name = f'chat_{room_name}'
-
-            # Get or create users with provided uuid and update username if necessary
-            from_user_obj, created = User.objects.get_or_create(uuid=from_user)
-            if not created and from_user_obj.username != from_user_username:
-                from_user_obj.username = from_user_username
-                from_user_obj.save()
-
-            to_user_obj, created = User.objects.get_or_create(uuid=to_user)
-            if not created and to_user_obj.username != to_user_username:
-                to_user_obj.username = to_user_username
-                to_user_obj.save()
-
-            chat, created = Chat.objects.get_or_create(
-                name=name,
-                room_name=room_name,
-                room_group_name=room_group_name
-            )
-            chat.participants.add(from_user_obj, to_user_obj)
-
-        # Get channel layer and group names
-        channel_layer = get_channel_layer()
-        # Send inboxes to WebSocket group for TO USER
-        group_name_to_user = f'inbox_{to_user}'
-        to_user_inboxes = self.get_inboxes(to_user)
-        async_to_sync(channel_layer.group_send)(group_name_to_user, {
-            'type': 'send_inboxes_from_view',
-            'data': to_user_inboxes,
-        })
-        
-        group_name_from_user = f'inbox_{from_user}'
-        from_user_inboxes = self.get_inboxes(from_user)
-        async_to_sync(channel_layer.group_send)(group_name_from_user, {
-            'type': 'send_inboxes_from_view',
-            'data': from_user_inboxes,
-        })
+        # One lookup on the pair key, or an upsert of both users and the chat
+        chat, created = get_or_create_direct_chat(from_user, from_user_username, to_user, to_user_username)
+
+        # Both inboxes get the new chat's summary, nothing changes for an existing one
+        if created:
+            send_inbox_upsert(chat, [from_user, to_user])
 
         return self.send_response(ChatSerializer(chat).data, status=status.HTTP_201_CREATED)
+
+
+class InboxView(StandardAPIView):
+    permission_classes = (permissions.AllowAny,)
+
+    def get(self, request, *args, **kwargs):
+        payload = validate_token(request)
+        user_id = payload['user_id']
+
+        # Keyset cursor: (last_activity, chat_id) of the last chat in the previous page
+        try:
+            cursor = parse_cursor(
+                request.query_params.get('last_activity'),
+                request.query_params.get('chat_id'),
+            )
+            count = int(request.query_params.get('count', INBOX_PAGE_SIZE))
+        except ValueError as e:
+            return self.send_error(str(e), status=status.HTTP_400_BAD_REQUEST)
+
+        return self.send_response(get_inbox_page(user_id, cursor, count), status=status.HTTP_200_OK)
     
 
 class LoadConversationView(StandardAPIView):
@@ -161,7 +177,7 @@ class LoadConversationView(StandardAPIView):
         return self.send_response(serializer.data, status=status.HTTP_200_OK)
 
 
-class LoadMessagesView(StandardAPIView):
+class LoadMessagesView(RawJSONAPIView):
     permission_classes = (permissions.AllowAny,)
 
     def get(self, request, room_name, room_group_name, *args, **kwargs):
@@ -179,13 +195,44 @@ class LoadMessagesView(StandardAPIView):
         if not chat.participants.filter(uuid=user_id).exists():
             return self.send_error("You do not have access to this chat", status=status.HTTP_403_FORBIDDEN)
 
-        # Get the latest 20 messages of the chat and serialize them
-        messages = chat.messages.order_by('-timestamp')[:20][::-1]
-        
-        serializer = MessageSerializer(messages, many=True)
+        if not any(param in request.query_params for param in ('before', 'after', 'count')):
+            # Legacy envelope and page numbers over the latest 20 messages, still the default
+            messages = chat.messages.order_by('-timestamp', '-id')[:20][::-1]
+            return self.paginate_payloads(request, get_message_payloads(messages), read_watermarks(chat.id))
+
+        # Keyset cursors: ?before= scrolls back, ?after= catches up, ?count= sets the page size
+        try:
+            page = get_message_page(
+                chat,
+                before=parse_message_cursor(request.query_params.get('before')),
+                after=parse_message_cursor(request.query_params.get('after')),
+                count=request.query_params.get('count'),
+            )
+        except ValueError as e:
+            return self.send_error(str(e), status=status.HTTP_400_BAD_REQUEST)
+
+        return self.send_raw_json_response(
+            page['results'],
+            count=len(page['results']),
+            older_cursor=page['older_cursor'],
+            newer_cursor=page['newer_cursor'],
+            read_states=page['read_states'],
+        )
 
-        # Return the serialized messages
-        return self.paginate_response(request, serializer.data)
+    def paginate_payloads(self, request, payloads, read_states):
+        # paginate_response over the pre-serialized message payloads, plus the read watermarks
+        try:
+            paginator = CustomPagination()
+            page = paginator.paginate_data(payloads, request)
+        except Exception as e:
+            return self.send_error(str(e), status=status.HTTP_400_BAD_REQUEST)
+        return self.send_raw_json_response(
+            page,
+            count=paginator.count,
+            next=paginator.get_next_link(),
+            previous=paginator.get_previous_link(),
+            read_states=read_states,
+        )
     
 
 class SendMessageView(StandardAPIView):
@@ -194,7 +241,7 @@ class SendMessageView(StandardAPIView):
     def post(self, request, format=None):
         payload = validate_token(request)
         user_id = payload['user_id']
-        sender = get_object_or_404(User, uuid=user_id)
+        sender_id = get_user_pk(user_id)
         # Get the chat object based on room name and group name
         room_name = request.data.get('roomName')
         room_group_name = request.data.get('roomGroupName')
@@ -216,24 +263,20 @@ class SendMessageView(StandardAPIView):
         if message_public_key:
             message = Message.objects.create(
                 chat=chat,
-                sender=sender,
+                sender_id=sender_id,
                 content=message_content if message_content.strip() != '<p><br></p>' else None,
                 mood=message_mood,
                 encryption=encryption,
             )
-            # Create public key file object and attach it to message
-            file_obj = File.objects.create(
-                name=message_public_key.name,
-                size=message_public_key.size,
-                mime_type=message_public_key.content_type,
-                file=message_public_key,
-                message=message,  # Set the message field to the current Message object
-            )
+            # Create public key file object and attach it to message, the
+            # content is written to storage after the request (file_ready event)
+            file_obj = stage_file(message, message_public_key)
             message.public_key = file_obj
+            message.save(update_fields=['public_key'])
         else:
             message = Message.objects.create(
                 chat=chat,
-                sender=sender,
+                sender_id=sender_id,
                 content=message_content if message_content.strip() != '<p><br></p>' else None,
                 mood=message_mood,
                 public_key=None,
@@ -241,8 +284,7 @@ class SendMessageView(StandardAPIView):
 
         if 'voice_message' in request.FILES:
             voice_message = request.FILES['voice_message']
-            message.voice_message = voice_message
-            message.save()
+            stage_voice_message(message, voice_message)
 
         # Create the poll object if the poll data was included in the request
         poll_data = request.data.get('poll')
@@ -258,19 +300,13 @@ class SendMessageView(StandardAPIView):
                     option_obj = PollOption.objects.create(option=option)
                     poll.options.add(option_obj)
             message.poll = poll
-            message.save()
+            message.save(update_fields=['poll'])
 
         # Add the files to the message
         files = request.FILES.getlist('files')
         if files:
             for file in files:
-                file_obj = File.objects.create(
-                    name=file.name,
-                    size=file.size,
-                    mime_type=file.content_type,
-                    file=file,
-                    message=message,  # Associate the file with the current Message object
-                )
+                stage_file(message, file)
 
         # Parse the GIF data from the request and create a new GIF object
         gif_data = request.data.get('gif')
@@ -285,57 +321,242 @@ class SendMessageView(StandardAPIView):
                 rating=gif_data.get('rating', None)
             )
             message.gif=gif
-            message.save()
-
-        # Notify ChatGroup and send message to group
-        channel_layer = get_channel_layer()
-
-        # Send message to WebSocket group for TO USER
-        group_name_to_user = f'chat_{str(chat.room_name)}'
-        async_to_sync(channel_layer.group_send)(group_name_to_user, {
-            'type': 'chat_message',
-            'message': MessageSerializer(message).data,
-        })
+            message.save(update_fields=['gif'])
+
+        # Bump the chat to the top of every participant's inbox
+        Chat.objects.filter(id=chat.id).update(last_activity=message.timestamp)
+
+        def broadcast():
+            # Once committed: the payload is cached and sent only for a row every reader can see
+            async_to_sync(get_channel_layer().group_send)(f'chat_{str(chat.room_name)}', {
+                'type': 'chat_message',
+                'payload': get_message_payload(message),
+                # History position, sockets disconnected as slow consumers resume after it
+                'cursor': encode_cursor(message),
+            })
+        transaction.on_commit(broadcast)
+        count_unread(message, chat)
+        send_inbox_bump(message, chat, user_id)
+        publish_message_created(message, chat, user_id)
 
         return self.send_response('Test', status=status.HTTP_200_OK)
     
 
 
+class MarkReadView(StandardAPIView):
+    permission_classes = (permissions.AllowAny,)
+    def post(self, request, format=None):
+        payload = validate_token(request)
+        user_id = payload['user_id']
+        chat = Chat.objects.filter(
+            room_name=request.data.get('roomName'),
+            room_group_name=request.data.get('roomGroupName'),
+            participants__uuid=user_id,
+        ).first()
+        if chat is None:
+            return self.send_error("Chat not found", status=status.HTTP_404_NOT_FOUND)
+
+        # Without messageId everything up to the latest message is read
+        message_id = request.data.get('messageId')
+        try:
+            last_read_message_id = mark_read(user_id, chat, int(message_id) if message_id is not None else None)
+        except ValueError as e:
+            return self.send_error(str(e), status=status.HTTP_400_BAD_REQUEST)
+
+        return self.send_response({'last_read_message_id': last_read_message_id}, status=status.HTTP_200_OK)
+
+
+class PresignUploadView(StandardAPIView):
+    permission_classes = (permissions.AllowAny,)
+    def post(self, request, format=None):
+        payload = validate_token(request)
+        user_id = payload['user_id']
+        room_name = request.data.get('roomName')
+        room_group_name = request.data.get('roomGroupName')
+        chat = Chat.objects.filter(room_name=room_name, room_group_name=room_group_name, participants__uuid=user_id).first()
+        if chat is None:
+            return self.send_error("Chat not found", status=status.HTTP_404_NOT_FOUND)
+
+        # [{name, size, mime_type}], the content goes straight to storage
+        files = request.data.get('files') or []
+        if not isinstance(files, list):
+            return self.send_error("files must be a list", status=status.HTTP_400_BAD_REQUEST)
+
+        direct_upload = get_direct_upload()
+        uploads = []
+        for file in files:
+            try:
+                name = str(file['name'])
+                size = int(file['size'])
+                mime_type = str(file.get('mime_type') or 'application/octet-stream')
+            except (KeyError, TypeError, ValueError):
+                return self.send_error("Each file needs a name and a size", status=status.HTTP_400_BAD_REQUEST)
+            if not 0 < size <= settings.DIRECT_UPLOAD_MAX_SIZE:
+                return self.send_error(f"{name} is too large", status=status.HTTP_400_BAD_REQUEST)
+
+            key = build_key(name, File._meta.get_field('file').upload_to)
+            upload_id = signing.dumps(
+                {'k': key, 'n': name, 's': size, 'm': mime_type, 'c': chat.id, 'u': user_id},
+                salt='chat.upload',
+            )
+            uploads.append({
+                'upload_id': upload_id,
+                'name': name,
+                'upload': direct_upload.presign(key, mime_type, size, request),
+            })
+
+        return self.send_response(uploads, status=status.HTTP_200_OK)
+
+
+class ConfirmUploadView(StandardAPIView):
+    permission_classes = (permissions.AllowAny,)
+    def post(self, request, format=None):
+        payload = validate_token(request)
+        user_id = payload['user_id']
+        room_name = request.data.get('roomName')
+        room_group_name = request.data.get('roomGroupName')
+        chat = Chat.objects.filter(room_name=room_name, room_group_name=room_group_name, participants__uuid=user_id).first()
+        if chat is None:
+            return self.send_error("Chat not found", status=status.HTTP_404_NOT_FOUND)
+
+        # Check every upload before writing anything
+        direct_upload = get_direct_upload()
+        public_key_id = request.data.get('publicKey')
+        upload_ids = request.data.get('uploads') or []
+        if not isinstance(upload_ids, list) or not all(isinstance(upload_id, str) for upload_id in upload_ids):
+            return self.send_error("uploads must be a list of upload ids", status=status.HTTP_400_BAD_REQUEST)
+        if public_key_id and not isinstance(public_key_id, str):
+            return self.send_error("publicKey must be an upload id", status=status.HTTP_400_BAD_REQUEST)
+        uploads = []
+        for upload_id in upload_ids + ([public_key_id] if public_key_id else []):
+            try:
+                upload = signing.loads(upload_id, salt='chat.upload', max_age=settings.DIRECT_UPLOAD_EXPIRY)
+            except signing.BadSignature:
+                return self.send_error("Invalid or expired upload", status=status.HTTP_400_BAD_REQUEST)
+            if upload['c'] != chat.id or upload['u'] != user_id:
+                return self.send_error("Upload belongs to another chat", status=status.HTTP_403_FORBIDDEN)
+            size = direct_upload.size(upload['k'])
+            if size is None:
+                return self.send_error(f"{upload['n']} has not been uploaded", status=status.HTTP_400_BAD_REQUEST)
+            uploads.append((upload_id, upload, size))
+        if not uploads:
+            return self.send_error("No uploads to confirm", status=status.HTTP_400_BAD_REQUEST)
+
+        message_id = request.data.get('messageId')
+        if message_id:
+            # Attach to a message the user already sent
+            message = Message.objects.filter(id=message_id, chat=chat, sender__uuid=user_id).first()
+            if message is None:
+                return self.send_error("Message not found", status=status.HTTP_404_NOT_FOUND)
+
+        # A signed upload id is good for one confirmation only
+        claimed = []
+        for upload_id, upload, size in uploads:
+            if not cache.add(f'upload-confirmed:{upload_id}', 1, settings.DIRECT_UPLOAD_EXPIRY):
+                cache.delete_many([f'upload-confirmed:{claimed_id}' for claimed_id in claimed])
+                return self.send_error(f"{upload['n']} has already been confirmed", status=status.HTTP_409_CONFLICT)
+            claimed.append(upload_id)
+
+        if not message_id:
+            message_content = process_message(request.data.get('message') or '')
+            message = Message.objects.create(
+                chat=chat,
+                sender_id=get_user_pk(user_id),
+                content=message_content if message_content.strip() not in ('', '<p><br></p>') else None,
+                mood=request.data.get('mood') or 'none',
+                encryption=request.data.get('encryption') or 'none',
+            )
+
+        for upload_id, upload, size in uploads:
+            file_obj = File(name=upload['n'], size=size, mime_type=upload['m'], message=message)
+            file_obj.file.name = upload['k']
+            file_obj.save()
+            if upload_id == public_key_id:
+                message.public_key = file_obj
+                message.save(update_fields=['public_key'])
+
+        if not message_id:
+            # Bump the chat to the top of every participant's inbox
+            Chat.objects.filter(id=chat.id).update(last_activity=message.timestamp)
+            count_unread(message, chat)
+            send_inbox_bump(message, chat, user_id)
+            publish_message_created(message, chat, user_id)
+        else:
+            invalidate_message_payload(message.id)
+
+        def broadcast():
+            # Once committed, so the payload is rebuilt after the invalidation above
+            event = {
+                'type': 'chat_message',
+                'payload': get_message_payload(message),
+            }
+            if not message_id:
+                # Edits aren't a new history position
+                event['cursor'] = encode_cursor(message)
+            async_to_sync(get_channel_layer().group_send)(f'chat_{chat.room_name}', event)
+        transaction.on_commit(broadcast)
+
+        return self.send_response({'message_id': message.id}, status=status.HTTP_200_OK)
+
+
+class LocalUploadView(StandardAPIView):
+    # Stand-in for the bucket when DIRECT_UPLOAD_BACKEND is 'local', the signed token is the credential
+    permission_classes = (permissions.AllowAny,)
+    authentication_classes = []
+
+    def put(self, request, token, format=None):
+        try:
+            upload = signing.loads(token, salt='chat.local-upload', max_age=settings.DIRECT_UPLOAD_EXPIRY)
+        except signing.BadSignature:
+            return self.send_error("Invalid or expired upload", status=status.HTTP_403_FORBIDDEN)
+        if int(request.META.get('CONTENT_LENGTH') or 0) > upload['s']:
+            return self.send_error("Upload is larger than announced", status=status.HTTP_400_BAD_REQUEST)
+        if default_storage.exists(upload['k']):
+            return self.send_error("Already uploaded", status=status.HTTP_409_CONFLICT)
+        # Chunked bodies carry no Content-Length, never read past the announced size
+        default_storage.save(upload['k'], DjangoFile(LimitedStream(request.stream, upload['s'])))
+        return self.send_response({'key': upload['k']}, status=status.HTTP_201_CREATED)
+
+
 class VotePollView(StandardAPIView):
     permission_classes = (permissions.AllowAny,)
     def post(self, request, format=None):
         payload = validate_token(request)
         user_id = payload['user_id']
-        user = get_object_or_404(User, uuid=user_id)
+        user_pk = get_user_pk(user_id)
         chat = get_object_or_404(Chat, id=request.data.get('chat'))
         poll = get_object_or_404(Poll, id=request.data.get('poll'))
 
-        if poll.voters.filter(uuid=user_id).exists():
-            return self.send_error("You have already voted in this poll", status=status.HTTP_400_BAD_REQUEST)
-
         selected_option_id = request.data.get('option')
-        poll_option = get_object_or_404(PollOption, id=selected_option_id)
-
-        # Create a new PollVote object
-        poll_vote = PollVote.objects.create(
-            voter=user,
-        )
+        poll_option = get_object_or_404(PollOption, id=selected_option_id, poll_options=poll)
 
-        poll_option.votes.add(poll_vote)
-        poll.voters.add(user)
+        # The (poll, voter) unique constraint rejects double votes, counters
+        # are bumped in the same transaction with F() expressions
+        try:
+            with transaction.atomic():
+                PollVote.objects.create(poll=poll, option=poll_option, voter_id=user_pk)
+                PollOption.objects.filter(id=poll_option.id).update(vote_count=F('vote_count') + 1)
+                Poll.objects.filter(id=poll.id).update(vote_count=F('vote_count') + 1)
+        except IntegrityError:
+            return self.send_error("You have already voted in this poll", status=status.HTTP_400_BAD_REQUEST)
+        poll.refresh_from_db(fields=['vote_count'])
 
         # Serialize the poll data and return it in the response
         serializer = PollSerializer(poll)
 
         message = get_object_or_404(Message, poll=poll)
-        # Notify ChatGroup and send message to group
-        channel_layer = get_channel_layer()
+        invalidate_message_payload(message.id)
 
-        # Send message to WebSocket group for TO USER
+        # Broadcast as one compact counts event per POLL_VOTE_BROADCAST_WINDOW,
+        # coalesced again per socket when clients fall behind
         group_name_to_user = f'chat_{str(chat.room_name)}'
-        async_to_sync(channel_layer.group_send)(group_name_to_user, {
-            'type': 'send_poll_vote',
-            'message': MessageSerializer(message).data,
-        })
+        transaction.on_commit(lambda: schedule_poll_counts(poll.id, group_name_to_user))
+        transaction.on_commit(lambda: producer.publish('poll_voted', {
+            'poll_id': poll.id,
+            'option_id': poll_option.id,
+            'message_id': message.id,
+            'chat_id': chat.id,
+            'voter': user_id,
+        }))
 
         return self.send_response(serializer.data, status=status.HTTP_200_OK)
\ No newline at end of file
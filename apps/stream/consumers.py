@@ -1,9 +1,14 @@
-import json
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from core.codecs import CodecConsumerMixin
+from core.outbound import DROP
 
 
-class LiveRoomConsumer(AsyncWebsocketConsumer):
+class LiveRoomConsumer(CodecConsumerMixin, AsyncWebsocketConsumer):
+    # Live room chat isn't stored, viewers that fall behind skip messages instead of queueing them
+    outbound_policies = {
+        'send_message': DROP,
+    }
     
     async def connect(self):
         # Get UserID
@@ -22,8 +27,8 @@ class LiveRoomConsumer(AsyncWebsocketConsumer):
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
 
     # Receive message from WebSocket
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
+        text_data_json = self.decode(text_data, bytes_data)
         message = text_data_json["message"]
 
         # Send message to room group
@@ -34,4 +39,4 @@ class LiveRoomConsumer(AsyncWebsocketConsumer):
     async def send_message(self, event):
         message = event['message']
         # send message to websocket
-        await self.send(text_data=json.dumps({'message':message}))
\ No newline at end of file
+        await self.send_data({'message':message}, event)
\ No newline at end of file
@@ -1,9 +1,12 @@
-import json, os, django
+import os, signal, django
 from confluent_kafka import Consumer
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "core.settings")
 django.setup()
 
+from django.conf import settings
+from apps.chat.events import EventProcessor
+
 consumer1 = Consumer({
     'bootstrap.servers': os.environ.get('KAFKA_BOOTSTRAP_SERVER'),
     'security.protocol': 'SASL_SSL',
@@ -11,33 +14,19 @@ consumer1 = Consumer({
     'sasl.password': os.environ.get('KAFKA_PASSWORD'),
     'sasl.mechanism': 'PLAIN',
     'group.id': 'messages_group',
-    'auto.offset.reset': 'earliest'
+    'auto.offset.reset': 'earliest',
+    # Offsets are committed by EventProcessor once a whole batch is handled
+    'enable.auto.commit': False,
 })
-consumer1.subscribe(['messages'])
-
-while True:
-    msg1 = consumer1.poll(1.0)
-
-    if msg1 is None:
-        continue
-    if msg1.error():
-        print(f"Error: {msg1.error()}")
-        continue
-
-    topic1 = msg1.topic()
-    value1 = msg1.value()
-    print(f"Message: {msg1}")
-
-#     print("Received message: {}".format(msg.value()))
+consumer1.subscribe(settings.EVENT_TOPICS)
 
-    # topic = msg.topic()
-    # value = msg.value()
+processor = EventProcessor(consumer1)
 
-    # if topic == 'transactions':
-    #     # execute logic for user_registered event
-    #     if msg.key() == b'"order_created"':
-    #         print('Add transaction here')
-    #         print(json.loads(value))
-    #         pass
+# Finish the current batch and commit it before exiting
+signal.signal(signal.SIGTERM, lambda signum, frame: processor.stop())
+signal.signal(signal.SIGINT, lambda signum, frame: processor.stop())
 
-consumer1.close()
\ No newline at end of file
+try:
+    processor.run()
+finally:
+    processor.close()
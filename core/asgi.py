@@ -4,13 +4,16 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 from django.core.asgi import get_asgi_application
 django_asgi_app=get_asgi_application()
 
-from channels.auth import AuthMiddlewareStack
+from django.urls import re_path
+from core.authentication import JWTAuthMiddleware
 from channels.routing import ProtocolTypeRouter, URLRouter
 
 import apps.chat.routing as ChatRouting
 application = ProtocolTypeRouter({
-    'http': django_asgi_app,
-    'websocket': AuthMiddlewareStack(
+    'http': URLRouter(
+        ChatRouting.http_urlpatterns + [re_path(r'', django_asgi_app)]
+    ),
+    'websocket': JWTAuthMiddleware(
         URLRouter(
             ChatRouting.websocket_urlpatterns
         )
@@ -0,0 +1,125 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs
+
+import jwt
+from django.conf import settings
+from rest_framework import authentication, exceptions
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+
+class LRUCache:
+    # Bounded, thread safe mapping whose entries carry their own expiry
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires_at=None):
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+token_cache = LRUCache(settings.JWT_CACHE_SIZE)
+
+
+def verify_token(token):
+    """
+    Decodes an HS256 token once and serves the verified claims from memory
+    until the token's `exp`. Raises jwt.InvalidTokenError like jwt.decode,
+    also for anything but an access token (a refresh token is not a login).
+    """
+    key = hashlib.sha256(token.encode()).hexdigest()
+    payload = token_cache.get(key)
+    if payload is None:
+        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=['HS256'])
+        if payload.get(api_settings.TOKEN_TYPE_CLAIM) != AccessToken.token_type:
+            raise jwt.InvalidTokenError('Token has wrong type.')
+        expires_at = payload.get('exp', time.time() + settings.JWT_CACHE_TTL)
+        token_cache.set(key, payload, expires_at)
+    return payload
+
+
+def verify_authorization(header):
+    """
+    Claims of a `Bearer <token>` (or `JWT <token>`) Authorization header,
+    None without one. Raises AuthenticationFailed for a bad token.
+    """
+    header = header.split()
+    if len(header) != 2 or header[0].decode().lower() not in ('bearer', 'jwt'):
+        return None
+    try:
+        return verify_token(header[1].decode())
+    except jwt.ExpiredSignatureError:
+        raise exceptions.AuthenticationFailed('Token has expired.')
+    except jwt.InvalidTokenError:
+        raise exceptions.AuthenticationFailed('Token is invalid.')
+
+
+class CachedJWTAuthentication(authentication.BaseAuthentication):
+    # Sets request.user to a TokenUser and request.auth to the claims, no database access
+
+    keyword = 'Bearer'
+
+    def authenticate(self, request):
+        payload = verify_authorization(authentication.get_authorization_header(request))
+        if payload is None:
+            return None
+        return TokenUser(payload), payload
+
+    def authenticate_header(self, request):
+        return self.keyword
+
+
+class JWTAuthMiddleware:
+    """
+    ASGI middleware that verifies `?token=` (or an Authorization header) once
+    per connection and puts `user_id` and the claims into the scope.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope)
+        token = self.get_token(scope)
+        if token:
+            try:
+                payload = verify_token(token)
+            except jwt.InvalidTokenError:
+                payload = None
+            if payload is not None and 'user_id' in payload:
+                scope['user_id'] = str(payload['user_id'])
+                scope['token_payload'] = payload
+        return await self.inner(scope, receive, send)
+
+    def get_token(self, scope):
+        query = parse_qs(scope.get('query_string', b'').decode())
+        if query.get('token'):
+            return query['token'][0]
+        for name, value in scope.get('headers', []):
+            if name == b'authorization':
+                parts = value.decode().split()
+                if len(parts) == 2:
+                    return parts[1]
+        return None
@@ -0,0 +1,80 @@
+import contextvars
+import uuid
+import zlib
+
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer as BaseInMemoryChannelLayer
+from channels_redis.core import RedisChannelLayer
+
+from .outbound import outbound_metrics
+
+# Group being fanned out by the current group_send, read back by get_capacity
+_sending_group = contextvars.ContextVar('sending_group', default=None)
+
+
+def jump_hash(key, buckets):
+    # Jump consistent hash (Lamping & Veach): growing the ring from n to n + 1
+    # nodes only moves 1 / (n + 1) of the groups to the new node.
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+def stamp_event(message):
+    # One id per group_send, consumers reuse the frame they encoded for it (core/codecs.py)
+    if 'event_id' in message:
+        return message
+    return dict(message, event_id=uuid.uuid4().hex)
+
+
+class InMemoryChannelLayer(BaseInMemoryChannelLayer):
+    # Single worker fallback, stamps group events like the Redis layer
+
+    async def group_send(self, group, message):
+        # channels' fan-out, but messages dropped at channel capacity are counted
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Invalid group name"
+        message = stamp_event(message)
+        self._clean_expired()
+        for channel in self.groups.get(group, set()):
+            try:
+                await self.send(channel, message)
+            except ChannelFull:
+                outbound_metrics.layer_dropped += 1
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    """
+    Redis channel layer that spreads groups (chat_<room>, inbox_<uuid>, ...)
+    over several Redis nodes with a consistent hash, and allows capacity
+    limits per group pattern on top of the per channel ones.
+    """
+
+    def __init__(self, group_capacity=None, **kwargs):
+        super().__init__(**kwargs)
+        self.group_capacity = self.compile_capacities(group_capacity or {})
+
+    def consistent_hash(self, value):
+        if self.ring_size == 1:
+            return 0
+        if isinstance(value, str):
+            value = value.encode('utf8')
+        return jump_hash(zlib.crc32(value), self.ring_size)
+
+    def get_capacity(self, channel):
+        group = _sending_group.get()
+        if group is not None:
+            for pattern, capacity in self.group_capacity:
+                if pattern.match(group):
+                    return capacity
+        return super().get_capacity(channel)
+
+    async def group_send(self, group, message):
+        token = _sending_group.set(group)
+        try:
+            await super().group_send(group, stamp_event(message))
+        finally:
+            _sending_group.reset(token)
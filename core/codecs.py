@@ -0,0 +1,191 @@
+import asyncio
+import json
+from collections import OrderedDict
+from urllib.parse import parse_qs
+
+from django.conf import settings
+
+from .outbound import KEEP, SLOW_CONSUMER_CLOSE_CODE, OutboundQueue, outbound_metrics
+from .payload_meter import payload_meter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class RawJSON(str):
+    # Already serialized JSON (e.g. a cached message payload), spliced as is into text frames
+    pass
+
+
+class JSONCodec:
+    name = 'json'
+    binary = False
+
+    def encode(self, data):
+        if isinstance(data, RawJSON):
+            return str(data)
+        if orjson is not None:
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode()
+        return json.dumps(data)
+
+    def decode(self, frame):
+        if orjson is not None:
+            return orjson.loads(frame)
+        return json.loads(frame)
+
+
+class MsgPackCodec:
+    name = 'msgpack'
+    binary = True
+
+    def encode(self, data):
+        if isinstance(data, RawJSON):
+            data = JSONCodec().decode(str(data))
+        return msgpack.packb(data, use_bin_type=True)
+
+    def decode(self, frame):
+        if isinstance(frame, str):
+            # Text frames on a msgpack socket are still taken as JSON
+            return JSONCodec().decode(frame)
+        return msgpack.unpackb(frame, raw=False)
+
+
+codecs = {'json': JSONCodec()}
+if msgpack is not None:
+    codecs['msgpack'] = MsgPackCodec()
+
+
+def negotiate(scope):
+    """
+    Returns (codec, subprotocol to accept). The codec is picked from the
+    WebSocket subprotocols the client offered (e.g. 'msgpack', 'json'), then
+    from ?codec=, and defaults to JSON text frames.
+    """
+    for subprotocol in scope.get('subprotocols') or ():
+        if subprotocol in codecs and subprotocol in settings.WEBSOCKET_CODECS:
+            return codecs[subprotocol], subprotocol
+    query = parse_qs(scope.get('query_string', b'').decode())
+    name = query.get('codec', ['json'])[0]
+    if name in codecs and name in settings.WEBSOCKET_CODECS:
+        return codecs[name], None
+    return codecs['json'], None
+
+
+class FrameCache:
+    # Encoded frames of the latest group events, per consumer class and codec
+
+    def __init__(self, size):
+        self.size = size
+        self.frames = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def get(self, key, encode):
+        # Returns (frame, whether it was encoded now)
+        frame = self.frames.get(key)
+        if frame is not None:
+            self.stats['hits'] += 1
+            return frame, False
+        self.stats['misses'] += 1
+        frame = self.frames[key] = encode()
+        if len(self.frames) > self.size:
+            self.frames.popitem(last=False)
+        return frame, True
+
+
+frame_cache = FrameCache(settings.WEBSOCKET_FRAME_CACHE_SIZE)
+
+
+class CodecConsumerMixin:
+    """
+    Negotiated framing for AsyncWebsocketConsumer: JSON text frames (orjson
+    when installed) or MessagePack binary frames. A group event reaches every
+    socket of the group in the process, so its frame is encoded once and
+    reused, keyed by the event_id the channel layer stamps on group_send.
+
+    Frames go through a per-socket OutboundQueue written by its own task.
+    Above OUTBOUND_HIGH_WATER queued frames DROP events are dropped; at
+    OUTBOUND_QUEUE_LIMIT the socket is sent a slow_consumer frame with its
+    resume_state() and closed with SLOW_CONSUMER_CLOSE_CODE.
+    """
+
+    # Outbound policy per event type (core/outbound.py), KEEP when not listed
+    outbound_policies = {}
+
+    async def accept(self, subprotocol=None):
+        self.codec, negotiated = negotiate(self.scope)
+        await super().accept(subprotocol or negotiated)
+        self.outbound = OutboundQueue(settings.OUTBOUND_HIGH_WATER, settings.OUTBOUND_QUEUE_LIMIT)
+        self.outbound_closed = False
+        self.writer = asyncio.ensure_future(self.write_frames())
+
+    async def websocket_disconnect(self, message):
+        writer = getattr(self, 'writer', None)
+        if writer is not None:
+            writer.cancel()
+        await super().websocket_disconnect(message)
+
+    def decode(self, text_data=None, bytes_data=None):
+        return getattr(self, 'codec', codecs['json']).decode(text_data if text_data is not None else bytes_data)
+
+    async def send_data(self, data, event=None, variant=None):
+        # Pass the group event only when every recipient gets the same frame,
+        # or those with the same variant when it depends on the socket's state
+        event_type = data.get('type') if isinstance(data, dict) else None
+        event_type = event_type or (event or {}).get('type', 'unknown')
+        outbound = getattr(self, 'outbound', None)
+        if outbound is None:
+            await self.write_frame(event_type, data, event, variant)
+            return
+        if self.outbound_closed:
+            return
+        if not outbound.put(event_type, data, event, variant, self.outbound_policies.get(event_type, KEEP)):
+            await self.disconnect_slow_consumer([event_type, data, event, variant, None])
+
+    async def write_frames(self):
+        while True:
+            event_type, data, event, variant, _ = await self.outbound.get()
+            await self.write_frame(event_type, data, event, variant)
+            outbound_metrics.count(event_type, 'sent')
+            self.frame_written(event_type, event)
+            if self.outbound_closed and not self.outbound:
+                # The slow_consumer frame was the last one queued
+                await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+                return
+
+    async def write_frame(self, event_type, data, event=None, variant=None):
+        codec = getattr(self, 'codec', codecs['json'])
+        if event is not None and 'event_id' in event:
+            frame, encoded = frame_cache.get(
+                (event['event_id'], type(self).__name__, codec.name, variant), lambda: codec.encode(data)
+            )
+        else:
+            frame, encoded = codec.encode(data), True
+        payload_meter.record(event_type, len(frame), encoded)
+        if codec.binary:
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    def frame_written(self, event_type, event):
+        # Hook for consumers tracking what the client has received
+        pass
+
+    async def resume_state(self, undelivered):
+        # Extra fields of the slow_consumer frame, e.g. a token to resume from
+        return {}
+
+    async def disconnect_slow_consumer(self, overflow):
+        # Everything still queued is given up, the client resumes from resume_state()
+        undelivered = [entry for entry in self.outbound.entries if entry[1] is not None] + [overflow]
+        self.outbound.clear()
+        self.outbound_closed = True
+        outbound_metrics.slow_disconnects += 1
+        state = await self.resume_state(undelivered)
+        self.outbound.put('slow_consumer', {'type': 'slow_consumer', **state})
@@ -0,0 +1,138 @@
+import asyncio
+import threading
+import weakref
+from collections import deque
+
+# Close code of sockets disconnected for falling too far behind
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+# Never dropped or merged; a socket that can't keep up with them is disconnected
+KEEP = 'keep'
+# Dropped while the socket's queue is above its high-water mark
+DROP = 'drop'
+
+
+class Coalesce:
+    """
+    Policy for events that only carry the latest state of something (vote
+    counts, an unread counter, a presence diff): a new one replaces the
+    queued one with the same key fields, or is merged into it with
+    merge(previous, data), and goes to the back of the queue.
+    """
+
+    def __init__(self, *fields, merge=None):
+        self.fields = fields
+        self.merge = merge
+
+    def key(self, event_type, data):
+        return (event_type,) + tuple(data.get(field) for field in self.fields)
+
+
+class OutboundMetrics:
+    # Per process: queue depth of the live sockets and what happened to their frames, per event type
+
+    def __init__(self):
+        self.queues = weakref.WeakSet()
+        self.lock = threading.Lock()
+        self.reset_metrics()
+
+    def count(self, event_type, outcome):
+        with self.lock:
+            stats = self.events.get(event_type)
+            if stats is None:
+                stats = self.events[event_type] = {'queued': 0, 'sent': 0, 'coalesced': 0, 'dropped': 0}
+            stats[outcome] += 1
+
+    def depth(self, depth):
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def reset_metrics(self):
+        self.events = {}
+        self.max_depth = 0
+        self.slow_disconnects = 0
+        self.layer_dropped = 0
+
+    def metrics(self):
+        queues = list(self.queues)
+        return {
+            'sockets': len(queues),
+            'depth': sum(len(queue) for queue in queues),
+            'max_depth': self.max_depth,
+            'slow_disconnects': self.slow_disconnects,
+            # Messages the in-memory channel layer dropped at channel capacity
+            'layer_dropped': self.layer_dropped,
+            'events': {event_type: dict(stats) for event_type, stats in self.events.items()},
+        }
+
+
+outbound_metrics = OutboundMetrics()
+
+
+class OutboundQueue:
+    """
+    Frames waiting to be written to one socket. Handlers only enqueue, so a
+    slow client no longer holds up the consumer and its channel layer queue;
+    the policy of the event type decides what happens when it falls behind.
+    Entries are [event_type, data, event, variant, coalesce key], a replaced
+    entry is left in place with its data set to None.
+    """
+
+    def __init__(self, high_water, limit):
+        self.high_water = high_water
+        self.limit = limit
+        self.entries = deque()
+        self.pending = {}
+        self.live = 0
+        self.ready = asyncio.Event()
+        outbound_metrics.queues.add(self)
+
+    def __len__(self):
+        return self.live
+
+    def put(self, event_type, data, event=None, variant=None, policy=KEEP):
+        # False when the socket is too far behind to take the frame
+        key = None
+        if isinstance(policy, Coalesce):
+            key = policy.key(event_type, data)
+            previous = self.pending.pop(key, None)
+            if previous is not None:
+                if policy.merge is not None:
+                    data = policy.merge(previous[1], data)
+                    # Merged frames are this socket's own, never shared through the frame cache
+                    event = None
+                previous[1] = None
+                self.live -= 1
+                outbound_metrics.count(event_type, 'coalesced')
+        elif policy == DROP and self.live >= self.high_water:
+            outbound_metrics.count(event_type, 'dropped')
+            return True
+        if self.live >= self.limit:
+            return False
+        entry = [event_type, data, event, variant, key]
+        if key is not None:
+            self.pending[key] = entry
+        self.entries.append(entry)
+        self.live += 1
+        outbound_metrics.count(event_type, 'queued')
+        outbound_metrics.depth(self.live)
+        self.ready.set()
+        return True
+
+    async def get(self):
+        while True:
+            while self.entries:
+                entry = self.entries.popleft()
+                if entry[1] is None:
+                    continue
+                self.live -= 1
+                if entry[4] is not None:
+                    self.pending.pop(entry[4], None)
+                return entry
+            self.ready.clear()
+            await self.ready.wait()
+
+    def clear(self):
+        self.entries.clear()
+        self.pending.clear()
+        self.live = 0
@@ -0,0 +1,46 @@
+import threading
+
+from django.conf import settings
+
+
+class PayloadMeter:
+    """
+    Sizes of the frames the consumers send, per event type, before the
+    server's permessage-deflate (characters for JSON text frames). Every
+    socket's frame is counted since that's what goes over the wire; frames
+    over WEBSOCKET_FRAME_WARN_BYTES are logged once per encode, not once per
+    recipient.
+    """
+
+    def __init__(self, warn_bytes):
+        self.warn_bytes = warn_bytes
+        self.lock = threading.Lock()
+        self.reset_metrics()
+
+    def record(self, event_type, size, encoded=True):
+        with self.lock:
+            stats = self.events.get(event_type)
+            if stats is None:
+                stats = self.events[event_type] = {'frames': 0, 'bytes': 0, 'max': 0, 'over_budget': 0}
+            stats['frames'] += 1
+            stats['bytes'] += size
+            stats['max'] = max(stats['max'], size)
+            if self.warn_bytes and size > self.warn_bytes:
+                stats['over_budget'] += 1
+            else:
+                return
+        if encoded:
+            print(f'{event_type} frame of {size} bytes is over WEBSOCKET_FRAME_WARN_BYTES ({self.warn_bytes})')
+
+    def reset_metrics(self):
+        self.events = {}
+
+    def metrics(self):
+        with self.lock:
+            return {
+                event_type: {**stats, 'avg': stats['bytes'] / stats['frames']}
+                for event_type, stats in self.events.items()
+            }
+
+
+payload_meter = PayloadMeter(settings.WEBSOCKET_FRAME_WARN_BYTES)
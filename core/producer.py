@@ -1,10 +1,198 @@
-from confluent_kafka import Producer
-import os
-
-producer = Producer({
-    'bootstrap.servers': os.environ.get('KAFKA_BOOTSTRAP_SERVER'),
-    'security.protocol': 'SASL_SSL',
-    'sasl.username': os.environ.get('KAFKA_USERNAME'),
-    'sasl.password': os.environ.get('KAFKA_PASSWORD'),
-    'sasl.mechanism': 'PLAIN',
-})
\ No newline at end of file
+import atexit
+import json
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+class InMemoryBroker:
+    # Stand-in for confluent_kafka.Producer in tests and local runs, delivers on poll()
+    # and keeps only the last `keep` delivered messages, the rest are counted
+
+    def __init__(self, config=None, keep=1000):
+        self.config = config or {}
+        self.pending = []
+        self.delivered = deque(maxlen=keep)
+        self.delivered_count = 0
+        self.lock = threading.Lock()
+
+    def produce(self, topic, value=None, key=None, on_delivery=None):
+        with self.lock:
+            self.pending.append((InMemoryMessage(topic, key, value), on_delivery))
+
+    def poll(self, timeout=0):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        for message, on_delivery in pending:
+            with self.lock:
+                self.delivered.append(message)
+                self.delivered_count += 1
+            if on_delivery is not None:
+                on_delivery(None, message)
+        if not pending and timeout:
+            time.sleep(min(timeout, 0.05))
+        return len(pending)
+
+    def flush(self, timeout=None):
+        self.poll()
+        return len(self)
+
+    def __len__(self):
+        return len(self.pending)
+
+
+class InMemoryMessage:
+    def __init__(self, topic, key, value, partition=0, offset=0):
+        self._topic, self._key, self._value = topic, key, value
+        self._partition, self._offset = partition, offset
+
+    def partition(self):
+        return self._partition
+
+    def offset(self):
+        return self._offset
+
+    def topic(self):
+        return self._topic
+
+    def key(self):
+        return self._key
+
+    def value(self):
+        return self._value
+
+    def error(self):
+        return None
+
+
+class EventProducer:
+    """
+    Publishes domain events without blocking the caller. produce() only
+    enqueues into librdkafka's buffer, which batches by linger / batch size;
+    a daemon thread polls for delivery reports and the buffer is flushed for
+    at most KAFKA_FLUSH_TIMEOUT seconds on shutdown. The underlying producer
+    is created on first use, so importing this module never connects.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._producer = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.stats_lock = threading.Lock()
+        self.stats = {
+            'produced': 0,
+            'delivered': 0,
+            'errors': 0,
+            'dropped': 0,
+            'latency_total': 0.0,
+            'latency_max': 0.0,
+        }
+
+    @property
+    def producer(self):
+        if self._producer is None:
+            with self._lock:
+                if self._producer is None:
+                    self._producer = self.factory()
+                    self._stopped.clear()
+                    self._thread = threading.Thread(target=self.poll_loop, name='kafka-poll', daemon=True)
+                    self._thread.start()
+                    atexit.register(self.close)
+        return self._producer
+
+    def publish(self, event, data, topic=None):
+        # Keys are the JSON-quoted event name, e.g. b'"message_created"'
+        topic = topic or settings.KAFKA_EVENTS_TOPIC
+        value = json.dumps(data, cls=DjangoJSONEncoder).encode()
+        sent_at = time.monotonic()
+
+        def on_delivery(err, msg):
+            self.record_delivery(err, sent_at)
+
+        try:
+            self.producer.produce(topic, value=value, key=json.dumps(event).encode(), on_delivery=on_delivery)
+        except BufferError:
+            # Local queue is full: serve delivery reports once and retry, never wait on the broker
+            self.producer.poll(0)
+            try:
+                self.producer.produce(topic, value=value, key=json.dumps(event).encode(), on_delivery=on_delivery)
+            except BufferError:
+                with self.stats_lock:
+                    self.stats['dropped'] += 1
+                print(f'Kafka queue full, dropped {event} event')
+                return False
+        with self.stats_lock:
+            self.stats['produced'] += 1
+        return True
+
+    def record_delivery(self, err, sent_at):
+        if err is not None:
+            with self.stats_lock:
+                self.stats['errors'] += 1
+            print(f'Kafka delivery failed: {err}')
+            return
+        latency = time.monotonic() - sent_at
+        with self.stats_lock:
+            self.stats['delivered'] += 1
+            self.stats['latency_total'] += latency
+            self.stats['latency_max'] = max(self.stats['latency_max'], latency)
+
+    def poll_loop(self):
+        while not self._stopped.is_set():
+            try:
+                self._producer.poll(settings.KAFKA_POLL_INTERVAL)
+            except Exception as e:
+                print(f'Kafka poll failed: {e}')
+
+    def close(self, timeout=None):
+        if self._producer is None:
+            return 0
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(settings.KAFKA_POLL_INTERVAL * 2)
+        remaining = self._producer.flush(settings.KAFKA_FLUSH_TIMEOUT if timeout is None else timeout)
+        if remaining:
+            print(f'Kafka producer closed with {remaining} undelivered events')
+        self._producer = None
+        return remaining
+
+    def metrics(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        delivered = stats['delivered']
+        return {
+            'queue_depth': len(self._producer) if self._producer is not None else 0,
+            'produced': stats['produced'],
+            'delivered': delivered,
+            'errors': stats['errors'],
+            'dropped': stats['dropped'],
+            'latency_avg_ms': stats['latency_total'] / delivered * 1000 if delivered else 0.0,
+            'latency_max_ms': stats['latency_max'] * 1000,
+        }
+
+
+def build_producer():
+    if settings.KAFKA_PRODUCER_BACKEND == 'memory':
+        return InMemoryBroker()
+
+    from confluent_kafka import Producer
+    return Producer({
+        'bootstrap.servers': settings.KAFKA_BOOTSTRAP_SERVER,
+        'security.protocol': 'SASL_SSL',
+        'sasl.username': settings.KAFKA_USERNAME,
+        'sasl.password': settings.KAFKA_PASSWORD,
+        'sasl.mechanism': 'PLAIN',
+        'linger.ms': settings.KAFKA_LINGER_MS,
+        'batch.size': settings.KAFKA_BATCH_SIZE,
+        'compression.type': settings.KAFKA_COMPRESSION,
+        'queue.buffering.max.messages': settings.KAFKA_QUEUE_MAX_MESSAGES,
+        'enable.idempotence': True,
+    })
+
+
+producer = EventProducer(build_producer)
@@ -1,5 +1,6 @@
 from pathlib import Path
 import os
+import tempfile
 import environ
 import urllib.parse
 
@@ -128,6 +129,8 @@ DATABASES = {
 #     }
 # }
 DATABASES["default"]["ATOMIC_REQUESTS"] = True
+# Seconds a connection is reused, by request threads and the consumers' executor threads alike (0 closes it after every call)
+DATABASES["default"]["CONN_MAX_AGE"] = env.int('CONN_MAX_AGE', default=60)
 
 
 
@@ -154,11 +157,110 @@ CACHES = {
 # }
 
 
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer"
+# Comma separated redis URLs, groups are consistent-hashed across them.
+# Without it we fall back to the in-memory layer (single worker only).
+CHANNEL_REDIS_HOSTS = env.list('CHANNEL_REDIS_HOSTS', default=[])
+
+if CHANNEL_REDIS_HOSTS:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "core.channel_layers.ShardedRedisChannelLayer",
+            "CONFIG": {
+                "hosts": CHANNEL_REDIS_HOSTS,
+                "prefix": env('CHANNEL_LAYER_PREFIX', default='messages'),
+                # Pending messages per channel (one channel per socket)
+                "capacity": env.int('CHANNEL_LAYER_CAPACITY', default=100),
+                # Seconds a message may wait in a channel before it is dropped
+                "expiry": env.int('CHANNEL_LAYER_EXPIRY', default=60),
+                # Seconds a channel stays in a group without being refreshed
+                "group_expiry": env.int('CHANNEL_LAYER_GROUP_EXPIRY', default=86400),
+                # Per group pattern limits, applied to each member of the group
+                "group_capacity": {
+                    "chat_*": env.int('CHANNEL_LAYER_CHAT_CAPACITY', default=200),
+                    "call_*": env.int('CHANNEL_LAYER_CALL_CAPACITY', default=500),
+                    "inbox_*": env.int('CHANNEL_LAYER_INBOX_CAPACITY', default=50),
+                },
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "core.channel_layers.InMemoryChannelLayer"
+        }
     }
-}
+
+# WebSocket framings clients may negotiate (subprotocol or ?codec=), see core/codecs.py
+WEBSOCKET_CODECS = env.list('WEBSOCKET_CODECS', default=['json', 'msgpack'])
+# Encoded frames of recent group events kept per process for the other recipients
+WEBSOCKET_FRAME_CACHE_SIZE = env.int('WEBSOCKET_FRAME_CACHE_SIZE', default=1024)
+# Frames queued per socket above which DROP events are dropped, see core/outbound.py
+OUTBOUND_HIGH_WATER = env.int('OUTBOUND_HIGH_WATER', default=100)
+# Frames queued per socket at which it's disconnected as a slow consumer, with a resume token
+OUTBOUND_QUEUE_LIMIT = env.int('OUTBOUND_QUEUE_LIMIT', default=1000)
+# Seconds a resume token of a disconnected slow consumer stays valid
+OUTBOUND_RESUME_TTL = env.int('OUTBOUND_RESUME_TTL', default=300)
+# Outbound frames larger than this are logged, sizes are metered per event type (core/payload_meter.py)
+WEBSOCKET_FRAME_WARN_BYTES = env.int('WEBSOCKET_FRAME_WARN_BYTES', default=64 * 1024)
+# Chat snapshots larger than this go as ids and diffs to sockets that opted in with ?compact=1, 0 disables
+CHAT_SNAPSHOT_BUDGET = env.int('CHAT_SNAPSHOT_BUDGET', default=4 * 1024)
+# Chat snapshots kept per process as bases for those diffs, see apps/chat/snapshots.py
+CHAT_SNAPSHOT_CACHE_SIZE = env.int('CHAT_SNAPSHOT_CACHE_SIZE', default=256)
+
+# Presence: 'redis' shares online / in-call state between workers, 'memory' is per process
+PRESENCE_BACKEND = env('PRESENCE_BACKEND', default='redis' if CHANNEL_REDIS_HOSTS else 'memory')
+# Seconds before a member whose worker stopped heartbeating is dropped
+PRESENCE_TTL = env.float('PRESENCE_TTL', default=30)
+# Seconds between batched presence_diff events
+PRESENCE_TICK = env.float('PRESENCE_TICK', default=1.0)
+# Seconds between writes of User.is_online / User.is_in_call
+PRESENCE_PERSIST_INTERVAL = env.float('PRESENCE_PERSIST_INTERVAL', default=10)
+
+# Video call membership per room, 'redis' is required for more than one worker
+CALL_REGISTRY_BACKEND = env('CALL_REGISTRY_BACKEND', default='redis' if CHANNEL_REDIS_HOSTS else 'memory')
+# Seconds an idle room's membership hash is kept, guards against crashed workers
+CALL_REGISTRY_TTL = env.int('CALL_REGISTRY_TTL', default=6 * 60 * 60)
+
+# Threads running the chat consumers' database work, see apps/chat/db_executor.py.
+# 0 falls back to channels' database_sync_to_async (one thread-sensitive thread)
+CONSUMER_DB_WORKERS = env.int('CONSUMER_DB_WORKERS', default=8)
+
+# Seconds trickle-ICE candidates are batched before being forwarded
+ICE_BATCH_WINDOW = env.float('ICE_BATCH_WINDOW', default=0.05)
+
+# Kafka event producer, see core/producer.py. 'memory' keeps events in process (tests, local runs)
+KAFKA_BOOTSTRAP_SERVER = env('KAFKA_BOOTSTRAP_SERVER', default=None)
+KAFKA_USERNAME = env('KAFKA_USERNAME', default=None)
+KAFKA_PASSWORD = env('KAFKA_PASSWORD', default=None)
+KAFKA_PRODUCER_BACKEND = env('KAFKA_PRODUCER_BACKEND', default='kafka' if KAFKA_BOOTSTRAP_SERVER else 'memory')
+KAFKA_EVENTS_TOPIC = env('KAFKA_EVENTS_TOPIC', default='messages_events')
+KAFKA_LINGER_MS = env.int('KAFKA_LINGER_MS', default=20)
+KAFKA_BATCH_SIZE = env.int('KAFKA_BATCH_SIZE', default=64 * 1024)
+KAFKA_COMPRESSION = env('KAFKA_COMPRESSION', default='lz4')
+KAFKA_QUEUE_MAX_MESSAGES = env.int('KAFKA_QUEUE_MAX_MESSAGES', default=100000)
+KAFKA_POLL_INTERVAL = env.float('KAFKA_POLL_INTERVAL', default=0.1)
+# Upper bound on the shutdown flush, events still queued after it are lost
+KAFKA_FLUSH_TIMEOUT = env.float('KAFKA_FLUSH_TIMEOUT', default=5)
+
+# consumer.py: events per consume() batch, handler pool ('thread' or 'process'), retry backoff,
+# and the retries in a row before a failing batch's events go to the dead-letter topic
+EVENT_TOPICS = env.list('EVENT_TOPICS', default=['messages'])
+EVENT_BATCH_SIZE = env.int('EVENT_BATCH_SIZE', default=500)
+EVENT_BATCH_TIMEOUT = env.float('EVENT_BATCH_TIMEOUT', default=1.0)
+EVENT_WORKERS = env.int('EVENT_WORKERS', default=4)
+EVENT_WORKER_MODE = env('EVENT_WORKER_MODE', default='thread')
+EVENT_RETRY_BACKOFF = env.float('EVENT_RETRY_BACKOFF', default=1.0)
+EVENT_MAX_RETRIES = env.int('EVENT_MAX_RETRIES', default=5)
+EVENT_DEAD_LETTER_TOPIC = env('EVENT_DEAD_LETTER_TOPIC', default='messages_dead_letter')
+
+# Seconds poll votes are collected before one counts event is sent to the room, 0 sends one per vote
+POLL_VOTE_BROADCAST_WINDOW = env.float('POLL_VOTE_BROADCAST_WINDOW', default=0.25)
+
+# Messages per history page, clients may ask for up to MESSAGE_MAX_PAGE_SIZE with ?count=
+MESSAGE_PAGE_SIZE = env.int('MESSAGE_PAGE_SIZE', default=20)
+MESSAGE_MAX_PAGE_SIZE = env.int('MESSAGE_MAX_PAGE_SIZE', default=100)
+# Messages serialized per query when streaming a chat export
+MESSAGE_EXPORT_CHUNK_SIZE = env.int('MESSAGE_EXPORT_CHUNK_SIZE', default=500)
 
 # CACHES = {
 #     "default": {
@@ -223,12 +325,34 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticatedOrReadOnly'
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'core.authentication.CachedJWTAuthentication',
     ),
 }
 
+# Verified JWT claims kept in memory, keyed by token hash, until the token's exp
+JWT_CACHE_SIZE = env.int('JWT_CACHE_SIZE', default=10000)
+# Lifetime of cached claims for tokens without an exp claim
+JWT_CACHE_TTL = env.int('JWT_CACHE_TTL', default=300)
+# Seconds a resolved user uuid -> primary key is kept by the views
+USER_PK_CACHE_TTL = env.int('USER_PK_CACHE_TTL', default=600)
+# Reject chat / inbox sockets that only send the legacy unverified ?user= parameter,
+# False lets old clients in again (each such socket is logged)
+WEBSOCKET_REQUIRE_TOKEN = env.bool('WEBSOCKET_REQUIRE_TOKEN', default=True)
+
 FILE_UPLOAD_PERMISSIONS = 0o640
 
+# Attachments are staged on local disk and pushed to storage by a background pool
+UPLOAD_STAGING_DIR = env('UPLOAD_STAGING_DIR', default=os.path.join(tempfile.gettempdir(), 'chat-uploads'))
+UPLOAD_WORKERS = env.int('UPLOAD_WORKERS', default=4)
+UPLOAD_MULTIPART_THRESHOLD = env.int('UPLOAD_MULTIPART_THRESHOLD', default=8 * 1024 * 1024)
+UPLOAD_MULTIPART_CHUNKSIZE = env.int('UPLOAD_MULTIPART_CHUNKSIZE', default=8 * 1024 * 1024)
+UPLOAD_MAX_CONCURRENCY = env.int('UPLOAD_MAX_CONCURRENCY', default=8)
+
+# Presigned direct uploads: 's3' posts straight to the media bucket, 'local' emulates it through the app
+DIRECT_UPLOAD_BACKEND = env('DIRECT_UPLOAD_BACKEND', default='local' if DEBUG else 's3')
+DIRECT_UPLOAD_EXPIRY = env.int('DIRECT_UPLOAD_EXPIRY', default=60 * 60)
+DIRECT_UPLOAD_MAX_SIZE = env.int('DIRECT_UPLOAD_MAX_SIZE', default=100 * 1024 * 1024)
+
 EMAIL_BACKEND='django.core.mail.backends.console.EmailBackend'
 
 if not DEBUG:
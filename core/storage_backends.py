@@ -1,3 +1,10 @@
+import posixpath
+
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.core import signing
+from django.core.files.storage import default_storage
 from storages.backends.s3boto3 import S3Boto3Storage
 
 
@@ -8,4 +15,65 @@ class StaticStorage(S3Boto3Storage):
 
 class MediaStore(S3Boto3Storage):
     location = 'media'
-    file_overwrite = False
\ No newline at end of file
+    file_overwrite = False
+
+    def __init__(self, **settings_overrides):
+        super().__init__(**settings_overrides)
+        # Large attachments go up as concurrent multipart uploads
+        self._transfer_config = TransferConfig(
+            multipart_threshold=settings.UPLOAD_MULTIPART_THRESHOLD,
+            multipart_chunksize=settings.UPLOAD_MULTIPART_CHUNKSIZE,
+            max_concurrency=settings.UPLOAD_MAX_CONCURRENCY,
+            use_threads=True,
+        )
+
+
+class S3DirectUpload:
+    # Clients POST straight to the bucket with a presigned policy
+
+    def __init__(self):
+        self.storage = MediaStore()
+
+    def presign(self, key, mime_type, max_size, request):
+        fields = {'Content-Type': mime_type}
+        if self.storage.default_acl:
+            fields['acl'] = self.storage.default_acl
+        conditions = [{name: value} for name, value in fields.items()]
+        conditions.append(['content-length-range', 1, max_size])
+        post = self.storage.bucket.meta.client.generate_presigned_post(
+            self.storage.bucket_name,
+            posixpath.join(self.storage.location, key),
+            Fields=fields,
+            Conditions=conditions,
+            ExpiresIn=settings.DIRECT_UPLOAD_EXPIRY,
+        )
+        return {'method': 'POST', 'url': post['url'], 'fields': post['fields']}
+
+    def size(self, key):
+        # None until the object has been uploaded
+        try:
+            return self.storage.size(key)
+        except ClientError:
+            return None
+
+
+class LocalDirectUpload:
+    # Emulates the bucket for development and tests: clients PUT the raw body to
+    # an app URL carrying the signed upload token, which writes to default_storage
+
+    def presign(self, key, mime_type, max_size, request):
+        from django.urls import reverse
+        token = signing.dumps({'k': key, 's': max_size}, salt='chat.local-upload')
+        url = request.build_absolute_uri(reverse('chat:local_upload', args=[token]))
+        return {'method': 'PUT', 'url': url, 'fields': {}}
+
+    def size(self, key):
+        if not default_storage.exists(key):
+            return None
+        return default_storage.size(key)
+
+
+def get_direct_upload():
+    if settings.DIRECT_UPLOAD_BACKEND == 's3':
+        return S3DirectUpload()
+    return LocalDirectUpload()